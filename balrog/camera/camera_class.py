@@ -3,10 +3,12 @@ import os
 import time
 from datetime import datetime
 from multiprocessing import Event
-from threading import Thread
-from typing import Self
+from pathlib import Path
+from threading import Condition, Thread
+from typing import Self, Optional, Iterator, Callable
 
 import cv2
+import numpy as np
 import pytz
 from cv2.typing import MatLike
 
@@ -14,6 +16,9 @@ from balrog.config import general_config
 from balrog.processor import ImageBuffers
 from balrog.utils import logger, get_resource_path
 
+# Maximum time to wait for the camera thread when stopping; a wedged capture is left behind (it is a daemon thread)
+_CAMERA_JOIN_SECONDS = 10.0
+
 
 class ICamera(abc.ABC):
     def __init__(self, fps: int, frame_buffers: ImageBuffers, stop_event: Event, cleanup_threshold: int):
@@ -22,16 +27,29 @@ class ICamera(abc.ABC):
         self.frame_buffers = frame_buffers
         self.stop_event = stop_event
         self.camera_thread = Thread(target=self.fill_queue, args=(), daemon=True)
+        # Time (monotonic) when the last frame was written to the buffers, to detect a stalled camera
+        self.last_capture_time = time.monotonic()
 
     def __enter__(self):
         self.camera_thread.start()
 
+    def apply_settings(self, fps: int, cleanup_threshold: int) -> None:
+        """
+        Changes the frame rate and the cleanup threshold of the running camera (e.g., after a reload of the config).
+        """
+        self.frame_rate = fps
+        # The cameras that never clean up (-1) keep doing so
+        if self.cleanup_threshold >= 0:
+            self.cleanup_threshold = cleanup_threshold
+
     def __exit__(self, exception_type, exception_value, traceback):
         logger.warning("Stopping camera thread")
         # We set the terminate flag and wait for the thread to terminate gracefully
         if not self.stop_event.is_set():
             self.stop_event.set()
-        self.camera_thread.join()
+        self.camera_thread.join(_CAMERA_JOIN_SECONDS)
+        if self.camera_thread.is_alive():
+            logger.warning(f"Camera thread did not stop in {_CAMERA_JOIN_SECONDS}s; leaving it behind")
 
     @classmethod
     def get_instance(
@@ -40,25 +58,60 @@ class ICamera(abc.ABC):
             frame_buffers: ImageBuffers,
             stop_event: Event,
             cleanup_threshold: int,
+            capture_mode: str = "sequential",
+            replay_source: Optional[str] = None,
+            replay_realtime: bool = True,
             is_debug: bool = False
     ) -> Self:
         if is_debug:
             return DbgCamera(fps, frame_buffers, stop_event)
-        else:
+        elif replay_source is not None:
+            return ReplayCamera(fps, frame_buffers, stop_event, replay_source, replay_realtime)
+        elif capture_mode == "latest":
+            return LatestFrameCamera(fps, frame_buffers, stop_event, cleanup_threshold)
+        elif capture_mode == "sequential":
             return Camera(fps, frame_buffers, stop_event, cleanup_threshold)
+        else:
+            raise Exception(f"Unknown camera capture mode '{capture_mode}'. Please check the configuration file")
 
-    def _write_frame_to_buffer(self, frame_data: MatLike) -> bool:
-        index = self.frame_buffers.get_next_index_for_frame()
+    def _capture_frame_to_buffer(
+            self,
+            capture: Callable[[Optional[np.ndarray]], tuple[bool, Optional[MatLike]]],
+            block: bool = False
+    ) -> bool:
+        """
+        Acquires a buffer and captures a frame into it.
+        :param capture: function that captures the frame; it receives the slot of the buffer (or None if it is not
+        available yet), so the frame can be decoded directly into it (e.g., VideoCapture.read)
+        :param block: if True, waits for a buffer to be released when all of them are in use
+        :return: True if the frame was captured and written to the buffer; False otherwise
+        """
+        if block:
+            index = self.frame_buffers.wait_for_next_index_for_frame(stop_event=self.stop_event)
+        else:
+            index = self.frame_buffers.get_next_index_for_frame()
         if index < 0:
             logger.warning("Could not find a buffer ready to write an image, discarding the frame")
             return False
 
+        success, frame_data = capture(self.frame_buffers.frame_slot(index))
+        if not success or frame_data is None:
+            self.frame_buffers.cancel_frame(index)
+            return False
+
         logger.debug(f"Writing frame to buffer # {index}")
-        next_buffer = self.frame_buffers[index]
-        next_buffer.write_capture_data(frame_data, datetime.now(pytz.timezone(general_config.local_timezone)))
+        self.frame_buffers.write_capture_data(
+            index,
+            frame_data,
+            datetime.now(pytz.timezone(general_config.local_timezone))
+        )
         self.frame_buffers.mark_position_ready_for_cascade(index)
+        self.last_capture_time = time.monotonic()
         return True
 
+    def _write_frame_to_buffer(self, frame_data: MatLike, block: bool = False) -> bool:
+        return self._capture_frame_to_buffer(lambda _: (True, frame_data), block)
+
     @abc.abstractmethod
     def fill_queue(self) -> None:
         pass
@@ -83,6 +136,93 @@ class DbgCamera(ICamera):
                 return
 
 
+class ReplayCamera(ICamera):
+    """
+    Camera class that replays a recorded cat visit, from a video file or from a directory of images (ordered by
+    file name, and timestamped with their modification time). The recording is sampled at the configured frame rate.
+    The replay can be paced in real time (as the live camera would do), or it can feed the frames as fast as the
+    pipeline accepts them; in that mode, the camera waits for a free buffer instead of discarding the frame.
+    """
+    _IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp'}
+
+    def __init__(self, fps: int, frame_buffers: ImageBuffers, stop_event: Event, source: str, realtime: bool):
+        super().__init__(fps, frame_buffers, stop_event, -1)
+        self.source = Path(source)
+        if not self.source.exists():
+            raise Exception(f"Replay source '{source}' does not exist")
+        self.realtime = realtime
+
+    def _iter_video_frames(self) -> Iterator[tuple[float, MatLike]]:
+        video = cv2.VideoCapture(str(self.source))
+        video_fps = video.get(cv2.CAP_PROP_FPS)
+        frame_number = 0
+        try:
+            while video.isOpened():
+                success, frame = video.read()
+                if not success:
+                    return
+                timestamp = video.get(cv2.CAP_PROP_POS_MSEC) / 1000
+                if timestamp <= 0 and video_fps > 0:
+                    # Some containers do not report the position, so we rely on the nominal frame rate
+                    timestamp = frame_number / video_fps
+                frame_number += 1
+                yield timestamp, frame
+        finally:
+            video.release()
+
+    def _iter_image_frames(self) -> Iterator[tuple[float, MatLike]]:
+        image_files = sorted(
+            file for file in self.source.iterdir()
+            if file.is_file() and file.suffix.lower() in ReplayCamera._IMAGE_EXTENSIONS
+        )
+        last_timestamp: Optional[float] = None
+        for image_file in image_files:
+            frame = cv2.imread(str(image_file))
+            if frame is None:
+                logger.warning(f"Could not read replay image '{image_file}', skipping it")
+                continue
+            timestamp = image_file.stat().st_mtime
+            if last_timestamp is not None and timestamp <= last_timestamp:
+                # Copied files may share their modification time; we space them by one frame period instead
+                timestamp = last_timestamp + 1 / self.frame_rate
+            last_timestamp = timestamp
+            yield timestamp, frame
+
+    def fill_queue(self) -> None:
+        frames = self._iter_image_frames() if self.source.is_dir() else self._iter_video_frames()
+        frame_period = 1 / self.frame_rate
+        replayed_frames = 0
+        dropped_frames = 0
+        first_timestamp: Optional[float] = None
+        next_timestamp: Optional[float] = None
+        start_time = time.monotonic()
+        for timestamp, frame in frames:
+            if self.stop_event.is_set():
+                logger.warning("Terminating replay camera thread")
+                return
+
+            if first_timestamp is None:
+                first_timestamp = next_timestamp = timestamp
+            if timestamp < next_timestamp:
+                # We sample the recording at the configured frame rate, as the live camera does
+                continue
+            next_timestamp += frame_period
+
+            if self.realtime:
+                delay = (timestamp - first_timestamp) - (time.monotonic() - start_time)
+                if delay > 0:
+                    time.sleep(delay)
+            if super()._write_frame_to_buffer(frame, block=not self.realtime):
+                replayed_frames += 1
+            else:
+                dropped_frames += 1
+
+        elapsed_time = time.monotonic() - start_time
+        logger.info(f"Replay of '{self.source}' finished: {replayed_frames} frames replayed, "
+                    f"{dropped_frames} frames dropped in {elapsed_time:.2f}s "
+                    f"({replayed_frames / elapsed_time if elapsed_time > 0 else 0:.2f} fps)")
+
+
 class Camera(ICamera):
     def __init__(self, fps: int, frame_buffers: ImageBuffers, stop_event: Event, cleanup_threshold: int):
         super().__init__(fps, frame_buffers, stop_event, cleanup_threshold)
@@ -94,15 +234,21 @@ class Camera(ICamera):
         self.stop_event = stop_event
         self.frame_buffers = frame_buffers
 
+    @staticmethod
+    def _read_frame(camera: cv2.VideoCapture, frame_slot: Optional[np.ndarray]) -> tuple[bool, MatLike]:
+        # When the slot is available, the frame is decoded directly into it
+        return camera.read() if frame_slot is None else camera.read(frame_slot)
+
     def fill_queue(self) -> None:
         while True:
             camera = cv2.VideoCapture(self.stream_url)
 
             i = 0
             while camera.isOpened():
-                success, frame = camera.read()
-                if not success or not super()._write_frame_to_buffer(frame):
-                    # Frame capture was not successful, or it could not be written to the buffer
+                if not super()._capture_frame_to_buffer(lambda slot: Camera._read_frame(camera, slot)):
+                    # Frame capture was not successful, or there was no buffer to write it; we still consume the
+                    # frame (without decoding it), so we do not fall behind the stream
+                    camera.grab()
                     continue
 
                 i += 1
@@ -120,3 +266,175 @@ class Camera(ICamera):
             if self.stop_event.is_set():
                 logger.warning("Terminating camera thread - break B")
                 return
+
+
+class _FrameGrabber:
+    """
+    Drains a video stream in its own thread: it only grabs the frames (no color conversion), so it keeps up with the
+    stream, and the capture always holds the newest frame. A VideoCapture can't grab and retrieve at the same time, so
+    the publisher asks for the capture (see retrieve_newest), and the grabber pauses between two grabs while the
+    newest frame is retrieved.
+    """
+    # Maximum time that the waits block, before checking the stop event again
+    _WAIT_SECONDS = 0.5
+
+    def __init__(self, camera: cv2.VideoCapture, stop_event: Event):
+        self.camera = camera
+        self.stop_event = stop_event
+        self._condition = Condition()
+        self._grabbing = False
+        self._retrieving = False
+        # Number of grabbed frames, and the time (monotonic) when the newest one was grabbed
+        self.grabbed_frames = 0
+        self.grab_time = 0.0
+        self.failed = False
+        self._stopped = False
+        self._thread = Thread(target=self._run, name='camera-grabber', daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        if self._thread.is_alive():
+            # We only wait for the grab in progress
+            self._thread.join(_CAMERA_JOIN_SECONDS)
+
+    @property
+    def running(self) -> bool:
+        return not self.failed and not self._stopped and not self.stop_event.is_set()
+
+    def _run(self) -> None:
+        while self.running:
+            with self._condition:
+                if not self._condition.wait_for(lambda: not self._retrieving, _FrameGrabber._WAIT_SECONDS):
+                    continue
+                self._grabbing = True
+            grabbed = self.camera.grab()
+            with self._condition:
+                self._grabbing = False
+                if grabbed:
+                    self.grabbed_frames += 1
+                    self.grab_time = time.monotonic()
+                else:
+                    self.failed = True
+                self._condition.notify_all()
+
+    def retrieve_newest(
+            self,
+            after_frame: int,
+            retrieve: Callable[[cv2.VideoCapture], bool]
+    ) -> Optional[tuple[int, float, bool]]:
+        """
+        Waits for a frame newer than the given one, and retrieves the newest grabbed frame.
+        :param after_frame: the number of the last retrieved frame
+        :param retrieve: function that retrieves (decodes) the grabbed frame of the capture
+        :return: the number and the grab time of the retrieved frame, and the result of retrieve; None if there is no
+        new frame (e.g., the grabber stopped)
+        """
+        with self._condition:
+            if not self._condition.wait_for(lambda: self.grabbed_frames > after_frame or not self.running,
+                                            _FrameGrabber._WAIT_SECONDS):
+                return None
+            if not self.running:
+                return None
+            self._retrieving = True
+            # The grab in progress (if any) gives an even newer frame
+            self._condition.wait_for(lambda: not self._grabbing)
+            frame_number, grab_time = self.grabbed_frames, self.grab_time
+        try:
+            return frame_number, grab_time, retrieve(self.camera)
+        finally:
+            with self._condition:
+                self._retrieving = False
+                self._condition.notify_all()
+
+
+class LatestFrameCamera(Camera):
+    """
+    Camera class that never falls behind the live stream. A grabber thread drains the stream continuously (see
+    _FrameGrabber), and the camera thread only retrieves (decodes) the newest grabbed frame each time a frame is due
+    according to the configured frame rate; the rest of the frames are dropped without decoding them.
+    """
+    def __init__(self, fps: int, frame_buffers: ImageBuffers, stop_event: Event, cleanup_threshold: int):
+        super().__init__(fps, frame_buffers, stop_event, cleanup_threshold)
+        # Capture statistics, so we can check how far behind the stream we are. The staleness is the time from the
+        # grab of the published frame until it was written to the buffers
+        self.published_frames = 0
+        self.dropped_frames = 0
+        self.last_frame_staleness: Optional[float] = None
+
+    @staticmethod
+    def _retrieve_frame(camera: cv2.VideoCapture, frame_slot: Optional[np.ndarray]) -> tuple[bool, MatLike]:
+        # When the slot is available, the frame is decoded directly into it
+        return camera.retrieve() if frame_slot is None else camera.retrieve(frame_slot)
+
+    def _publish_newest_frame(self, grabber: _FrameGrabber, last_frame: int) -> int:
+        """
+        Retrieves the newest grabbed frame into the buffers.
+        :param grabber: the grabber of the stream
+        :param last_frame: the number of the last published (or dropped) frame
+        :return: the number of the newest frame that was published or dropped
+        """
+        retrieved = grabber.retrieve_newest(
+            last_frame,
+            lambda camera: self._capture_frame_to_buffer(lambda slot: LatestFrameCamera._retrieve_frame(camera, slot))
+        )
+        if retrieved is None:
+            return last_frame
+        frame_number, grab_time, captured = retrieved
+        if not captured:
+            # Frame could not be decoded, or it could not be written to the buffer
+            self.dropped_frames += frame_number - last_frame
+            return frame_number
+
+        self.last_frame_staleness = self.last_capture_time - grab_time
+        self.dropped_frames += frame_number - last_frame - 1
+        self.published_frames += 1
+        logger.debug(f"Camera published frame with staleness: {self.last_frame_staleness:.4f}s, "
+                     f"total dropped frames: {self.dropped_frames}")
+        return frame_number
+
+    def fill_queue(self) -> None:
+        while True:
+            camera = cv2.VideoCapture(self.stream_url)
+            grabber = _FrameGrabber(camera, self.stop_event)
+            if camera.isOpened():
+                grabber.start()
+
+            i = 0
+            last_frame = 0
+            next_publish_time = time.monotonic()
+            while camera.isOpened() and grabber.running:
+                delay = next_publish_time - time.monotonic()
+                if delay > 0 and self.stop_event.wait(delay):
+                    break
+                # The frame rate can change at runtime (see ICamera.apply_settings)
+                frame_period = 1 / self.frame_rate
+                next_publish_time += frame_period
+                if next_publish_time < time.monotonic():
+                    # We fell behind the schedule; we restart it from now instead of publishing a burst of frames
+                    next_publish_time = time.monotonic() + frame_period
+
+                published_frames = self.published_frames
+                last_frame = self._publish_newest_frame(grabber, last_frame)
+                if self.published_frames == published_frames:
+                    continue
+
+                i += 1
+                if 0 < self.cleanup_threshold <= i:
+                    logger.info(f"Camera captures max configured frames; cleaning up and restarting. "
+                                f"Published frames: {self.published_frames}, dropped frames: {self.dropped_frames}")
+                    break
+
+            if grabber.failed:
+                logger.warning("Could not grab a frame from the camera stream; restarting the capture")
+            grabber.stop()
+            camera.release()
+            del camera
+
+            if self.stop_event.is_set():
+                logger.warning("Terminating camera thread - break B")
+                return
@@ -1,7 +1,10 @@
 import logging
-from dataclasses import dataclass
+import os
+from dataclasses import dataclass, fields
 from pathlib import Path
+from threading import Lock
 from tomllib import load
+from typing import Any, Callable
 
 config_file_path = 'config.toml'
 
@@ -10,10 +13,17 @@ config_file_path = 'config.toml'
 class GeneralConfigs:
     max_message_sender_threads: int
     max_frame_processor_threads: int
+    frame_processor_executor: str
+    cascade_batch_size: int
+    cascade_batch_max_wait_seconds: float
     min_aggregation_frames_threshold: int
     max_frame_buffers: int
+    aggregation_reorder_window: int
+    straggler_policy: str
+    straggler_deadline_seconds: float
     local_timezone: str
     timestamp_format: str
+    config_watch_interval_seconds: float
 
 
 @dataclass
@@ -33,6 +43,9 @@ class LoggingConfigs:
 class CameraConfigs:
     camera_fps: int
     camera_cleanup_frames_threshold: int
+    capture_mode: str
+    replay_realtime: bool
+    camera_stall_restart_seconds: float
 
 
 @dataclass
@@ -44,76 +57,317 @@ class ModelConfigs:
     prey_val_hard_threshold: int
 
 
+@dataclass
+class MotionConfigs:
+    enable_motion_gate: bool
+    motion_sensitivity: float
+    motion_pixel_threshold: int
+    motion_hold_frames: int
+    motion_mask_file: str
+
+
+@dataclass
+class TrackingConfigs:
+    enable_tracking: bool
+    tracker_type: str
+    redetect_interval: int
+    max_frame_gap: int
+    tracking_frame_width: int
+
+
+@dataclass
+class InferenceConfigs:
+    models_folder: str
+    cc_engine: str
+    pc_engine: str
+    ff_engine: str
+    eye_engine: str
+    keras_jit_compile: bool
+    pc_variant: str
+    ff_variant: str
+    eye_variant: str
+    model_loader_threads: int
+    warmup_max_iterations: int
+    warmup_stable_iterations: int
+    warmup_tolerance: float
+
+
+@dataclass
+class TelegramConfigs:
+    outbox_capacity: int
+    image_max_width: int
+    jpeg_quality: int
+
+
 @dataclass
 class FlapConfigs:
     let_in_open_seconds: int
+    device_cache_ttl_seconds: float
+    auto_lock_on_prey: bool
+    auto_lock_hold_seconds: int
 
 
-def load_flap_config() -> FlapConfigs:
-    with open(config_file_path, "rb") as config_file:
-        loaded_bytes = load(config_file)
-        return FlapConfigs(
-            loaded_bytes["flap"]["let_in_open_seconds"],
-        )
+def load_flap_config(loaded_bytes: dict[str, Any]) -> FlapConfigs:
+    return FlapConfigs(
+        loaded_bytes["flap"]["let_in_open_seconds"],
+        loaded_bytes["flap"]["device_cache_ttl_seconds"],
+        loaded_bytes["flap"]["auto_lock_on_prey"],
+        loaded_bytes["flap"]["auto_lock_hold_seconds"]
+    )
 
 
-def load_general_config() -> GeneralConfigs:
-    with open(config_file_path, "rb") as config_file:
-        loaded_bytes = load(config_file)
-        return GeneralConfigs(
-            loaded_bytes["general"]["max_message_sender_threads"],
-            loaded_bytes["general"]["max_frame_processor_threads"],
-            loaded_bytes["general"]["min_aggregation_frames_threshold"],
-            loaded_bytes["general"]["max_frame_buffers"],
-            loaded_bytes["general"]["local_timezone"],
-            loaded_bytes["general"]["timestamp_format"]
-        )
+def load_telegram_config(loaded_bytes: dict[str, Any]) -> TelegramConfigs:
+    return TelegramConfigs(
+        loaded_bytes["telegram"]["outbox_capacity"],
+        loaded_bytes["telegram"]["image_max_width"],
+        loaded_bytes["telegram"]["jpeg_quality"]
+    )
 
 
-def load_logging_config() -> LoggingConfigs:
-    with open(config_file_path, "rb") as config_file:
-        loaded_bytes = load(config_file)
-        dbg_images_path = Path(f'{loaded_bytes["logging"]["log_base_folder"]}/dbg-images')
-        dbg_images_path.mkdir(parents=True, exist_ok=True)
-        return LoggingConfigs(
-            loaded_bytes["logging"]["log_base_folder"],
-            loaded_bytes["logging"]["log_file_name"],
-            loaded_bytes["logging"]["log_dbg_file_name"],
-            logging.getLevelName(loaded_bytes["logging"]["stdout_debug_level"]),
-            loaded_bytes["logging"]["enable_cascade_logging"],
-            loaded_bytes["logging"]["enable_circular_buffer_logging"],
-            loaded_bytes["logging"]["max_log_file_size_mb"],
-            loaded_bytes["logging"]["max_log_files_kept"],
-            f'{loaded_bytes["logging"]["log_base_folder"]}/dbg-images',
-        )
-
-
-def load_camera_config() -> CameraConfigs:
-    with open(config_file_path, "rb") as config_file:
-        loaded_bytes = load(config_file)
-        return CameraConfigs(
-            loaded_bytes["camera"]["camera_fps"],
-            loaded_bytes["camera"]["camera_cleanup_frames_threshold"]
-        )
+def load_general_config(loaded_bytes: dict[str, Any]) -> GeneralConfigs:
+    return GeneralConfigs(
+        loaded_bytes["general"]["max_message_sender_threads"],
+        loaded_bytes["general"]["max_frame_processor_threads"],
+        loaded_bytes["general"]["frame_processor_executor"],
+        loaded_bytes["general"]["cascade_batch_size"],
+        loaded_bytes["general"]["cascade_batch_max_wait_seconds"],
+        loaded_bytes["general"]["min_aggregation_frames_threshold"],
+        loaded_bytes["general"]["max_frame_buffers"],
+        loaded_bytes["general"]["aggregation_reorder_window"],
+        loaded_bytes["general"]["straggler_policy"],
+        loaded_bytes["general"]["straggler_deadline_seconds"],
+        loaded_bytes["general"]["local_timezone"],
+        loaded_bytes["general"]["timestamp_format"],
+        loaded_bytes["general"]["config_watch_interval_seconds"]
+    )
+
+
+def load_logging_config(loaded_bytes: dict[str, Any]) -> LoggingConfigs:
+    dbg_images_path = Path(f'{loaded_bytes["logging"]["log_base_folder"]}/dbg-images')
+    dbg_images_path.mkdir(parents=True, exist_ok=True)
+    return LoggingConfigs(
+        loaded_bytes["logging"]["log_base_folder"],
+        loaded_bytes["logging"]["log_file_name"],
+        loaded_bytes["logging"]["log_dbg_file_name"],
+        logging.getLevelName(loaded_bytes["logging"]["stdout_debug_level"]),
+        loaded_bytes["logging"]["enable_cascade_logging"],
+        loaded_bytes["logging"]["enable_circular_buffer_logging"],
+        loaded_bytes["logging"]["max_log_file_size_mb"],
+        loaded_bytes["logging"]["max_log_files_kept"],
+        f'{loaded_bytes["logging"]["log_base_folder"]}/dbg-images',
+    )
+
+
+def load_camera_config(loaded_bytes: dict[str, Any]) -> CameraConfigs:
+    return CameraConfigs(
+        loaded_bytes["camera"]["camera_fps"],
+        loaded_bytes["camera"]["camera_cleanup_frames_threshold"],
+        loaded_bytes["camera"]["capture_mode"],
+        loaded_bytes["camera"]["replay_realtime"],
+        loaded_bytes["camera"]["camera_stall_restart_seconds"]
+    )
+
+
+def load_model_config(loaded_bytes: dict[str, Any]) -> ModelConfigs:
+    return ModelConfigs(
+        loaded_bytes["model"]["event_reset_threshold"],
+        loaded_bytes["model"]["cat_counter_threshold"],
+        loaded_bytes["model"]["cumulus_prey_threshold"],
+        loaded_bytes["model"]["cumulus_no_prey_threshold"],
+        loaded_bytes["model"]["prey_val_hard_threshold"]
+    )
 
 
-def load_model_config() -> ModelConfigs:
+def load_motion_config(loaded_bytes: dict[str, Any]) -> MotionConfigs:
+    return MotionConfigs(
+        loaded_bytes["motion"]["enable_motion_gate"],
+        loaded_bytes["motion"]["motion_sensitivity"],
+        loaded_bytes["motion"]["motion_pixel_threshold"],
+        loaded_bytes["motion"]["motion_hold_frames"],
+        loaded_bytes["motion"]["motion_mask_file"]
+    )
+
+
+def load_inference_config(loaded_bytes: dict[str, Any]) -> InferenceConfigs:
+    return InferenceConfigs(
+        loaded_bytes["inference"]["models_folder"],
+        loaded_bytes["inference"]["cc_engine"],
+        loaded_bytes["inference"]["pc_engine"],
+        loaded_bytes["inference"]["ff_engine"],
+        loaded_bytes["inference"]["eye_engine"],
+        loaded_bytes["inference"]["keras_jit_compile"],
+        loaded_bytes["inference"]["pc_variant"],
+        loaded_bytes["inference"]["ff_variant"],
+        loaded_bytes["inference"]["eye_variant"],
+        loaded_bytes["inference"]["model_loader_threads"],
+        loaded_bytes["inference"]["warmup_max_iterations"],
+        loaded_bytes["inference"]["warmup_stable_iterations"],
+        loaded_bytes["inference"]["warmup_tolerance"]
+    )
+
+
+def load_tracking_config(loaded_bytes: dict[str, Any]) -> TrackingConfigs:
+    return TrackingConfigs(
+        loaded_bytes["tracking"]["enable_tracking"],
+        loaded_bytes["tracking"]["tracker_type"],
+        loaded_bytes["tracking"]["redetect_interval"],
+        loaded_bytes["tracking"]["max_frame_gap"],
+        loaded_bytes["tracking"]["tracking_frame_width"]
+    )
+
+
+@dataclass
+class BalrogConfig:
+    general: GeneralConfigs
+    logging: LoggingConfigs
+    model: ModelConfigs
+    camera: CameraConfigs
+    motion: MotionConfigs
+    inference: InferenceConfigs
+    tracking: TrackingConfigs
+    telegram: TelegramConfigs
+    flap: FlapConfigs
+    # Incremented each time a reload applies some setting
+    version: int
+    # Modification time (in ns) of the config file that was parsed last
+    file_mtime_ns: int
+
+
+# Names of the sections of the config file (and of the fields of BalrogConfig)
+_SECTIONS = ("general", "logging", "model", "camera", "motion", "inference", "tracking", "telegram", "flap")
+# Settings that can be changed without restarting: they are read each time they are used, or the components that keep a
+# copy of them refresh it in a reload listener
+_RUNTIME_SETTINGS: dict[str, set[str]] = {
+    "general": {"cascade_batch_max_wait_seconds", "min_aggregation_frames_threshold", "local_timezone",
+                "timestamp_format"},
+    "logging": {"stdout_debug_level", "max_log_file_size_mb", "max_log_files_kept", "enable_cascade_logging"},
+    "model": {setting.name for setting in fields(ModelConfigs)},
+    "camera": {"camera_fps", "camera_cleanup_frames_threshold", "camera_stall_restart_seconds"},
+    "flap": {setting.name for setting in fields(FlapConfigs)},
+}
+# Settings used by the models (which a soft restart keeps loaded) or by the log files, so they need a restart of the
+# process. The rest are applied by a soft restart, which creates the camera, buffers, processor and bot again
+_PROCESS_SETTINGS: dict[str, set[str]] = {
+    "general": {"frame_processor_executor", "max_frame_processor_threads"},
+    "logging": {"log_base_folder", "log_file_name", "log_dbg_file_name", "log_dbg_img_folder"},
+    "inference": {setting.name for setting in fields(InferenceConfigs)},
+    "tracking": {setting.name for setting in fields(TrackingConfigs)},
+}
+
+
+@dataclass
+class ConfigReloadReport:
+    version: int
+    # The changes that were applied, the ones that need a (soft) restart, and the ones that need a restart of the
+    # process, as "section.setting: old -> new"
+    applied: list[str]
+    needs_restart: list[str]
+    needs_process_restart: list[str]
+
+    def __str__(self) -> str:
+        if not self.applied and not self.needs_restart and not self.needs_process_restart:
+            return f"No changes in the config (version {self.version})"
+        message = f"Config reloaded (version {self.version})"
+        if self.applied:
+            message += "\nApplied:" + "".join(f"\n `{change}`" for change in self.applied)
+        if self.needs_restart:
+            message += "\nNeeds a /restart:" + "".join(f"\n `{change}`" for change in self.needs_restart)
+        if self.needs_process_restart:
+            message += "\nNeeds a /hardrestart:" + "".join(f"\n `{change}`" for change in self.needs_process_restart)
+        return message
+
+
+def config_file_mtime_ns() -> int:
+    return os.stat(config_file_path).st_mtime_ns
+
+
+def load_balrog_config() -> BalrogConfig:
+    """
+    Parses the config file (once for all the sections).
+    """
+    file_mtime_ns = config_file_mtime_ns()
     with open(config_file_path, "rb") as config_file:
         loaded_bytes = load(config_file)
-        return ModelConfigs(
-            loaded_bytes["model"]["event_reset_threshold"],
-            loaded_bytes["model"]["cat_counter_threshold"],
-            loaded_bytes["model"]["cumulus_prey_threshold"],
-            loaded_bytes["model"]["cumulus_no_prey_threshold"],
-            loaded_bytes["model"]["prey_val_hard_threshold"]
-        )
+    return BalrogConfig(
+        load_general_config(loaded_bytes),
+        load_logging_config(loaded_bytes),
+        load_model_config(loaded_bytes),
+        load_camera_config(loaded_bytes),
+        load_motion_config(loaded_bytes),
+        load_inference_config(loaded_bytes),
+        load_tracking_config(loaded_bytes),
+        load_telegram_config(loaded_bytes),
+        load_flap_config(loaded_bytes),
+        1,
+        file_mtime_ns
+    )
+
+
+_reload_lock = Lock()
+_reload_listeners: list[Callable[[], None]] = []
+
+
+def add_reload_listener(listener: Callable[[], None]) -> None:
+    """
+    Registers a function that is called after a reload applies some setting, so the components that keep a copy of the
+    settings (e.g., the frame rate of the camera) can refresh it.
+    """
+    _reload_listeners.append(listener)
+
+
+def remove_reload_listener(listener: Callable[[], None]) -> None:
+    if listener in _reload_listeners:
+        _reload_listeners.remove(listener)
+
+
+def reload_config(soft_restart: bool = False) -> ConfigReloadReport:
+    """
+    Parses the config file again, and applies the settings that can change at runtime in place, so every module that
+    imported a section sees the new values. The rest of the changes are left for the next restart, and reported. If the
+    file can't be parsed, an exception is raised and nothing is changed.
+    :param soft_restart: if True, also applies the settings that only need a soft restart (see Supervisor)
+    :return: the report with the applied changes and the ones that need a restart
+    """
+    with _reload_lock:
+        new_config = load_balrog_config()
+        applied: list[str] = []
+        needs_restart: list[str] = []
+        needs_process_restart: list[str] = []
+        for section_name in _SECTIONS:
+            section = getattr(balrog_config, section_name)
+            new_section = getattr(new_config, section_name)
+            for setting in fields(section):
+                old_value = getattr(section, setting.name)
+                new_value = getattr(new_section, setting.name)
+                if old_value == new_value:
+                    continue
+                change = f"{section_name}.{setting.name}: {old_value!r} -> {new_value!r}"
+                if setting.name in _PROCESS_SETTINGS.get(section_name, set()):
+                    needs_process_restart.append(change)
+                elif soft_restart or setting.name in _RUNTIME_SETTINGS.get(section_name, set()):
+                    setattr(section, setting.name, new_value)
+                    applied.append(change)
+                else:
+                    needs_restart.append(change)
+        balrog_config.file_mtime_ns = new_config.file_mtime_ns
+        if applied:
+            balrog_config.version += 1
+            for listener in _reload_listeners:
+                listener()
+        return ConfigReloadReport(balrog_config.version, applied, needs_restart, needs_process_restart)
 
 
 if not Path(config_file_path).is_file():
     raise Exception(f"Config file '{config_file_path}' was not found. Please make sure you created the config file.")
 
-general_config = load_general_config()
-logging_config = load_logging_config()
-model_config = load_model_config()
-camera_config = load_camera_config()
-flap_config = load_flap_config()
+balrog_config = load_balrog_config()
+# The sections are updated in place by reload_config, so they can be imported directly
+general_config = balrog_config.general
+logging_config = balrog_config.logging
+model_config = balrog_config.model
+camera_config = balrog_config.camera
+motion_config = balrog_config.motion
+inference_config = balrog_config.inference
+tracking_config = balrog_config.tracking
+telegram_config = balrog_config.telegram
+flap_config = balrog_config.flap
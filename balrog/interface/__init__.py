@@ -1,15 +1,32 @@
 from abc import ABC, abstractmethod
+from datetime import datetime
+from enum import IntEnum
 from multiprocessing import Event
-from typing import Self, Optional
+from typing import Self, Optional, TYPE_CHECKING
 
 from cv2.typing import MatLike
 
+if TYPE_CHECKING:
+    from balrog.processor.cascade import EventElement
+
+
+class MessagePriority(IntEnum):
+    """
+    Order in which the pending messages are sent (lower values first).
+    """
+    # Verdicts and cat alerts
+    VERDICT = 0
+    # Replies to the commands
+    TEXT = 1
+    # Live pictures; a new one replaces the pending one
+    LIVE = 2
+
 
 class MessageSender(ABC):
     def __init__(self):
         # Data coming and used form unexpected places (other files)
         self._node_live_img: Optional[MatLike] = None
-        self._node_last_casc_img: Optional[MatLike] = None
+        self._node_last_casc_event: Optional['EventElement'] = None
         self._node_queue_info: Optional[int] = None
         self._node_over_head_info: Optional[float] = None
 
@@ -18,21 +35,38 @@ class MessageSender(ABC):
             cls,
             is_debug: bool = False,
             clean_queue_event: Event = None,
-            stop_event: Event = None
+            stop_event: Event = None,
+            process_restart_event: Event = None
     ) -> Self:
         if is_debug:
             from balrog.interface.telegram_bot import DebugBot
             return DebugBot()
         else:
             from balrog.interface.telegram_bot import BalrogTelegramBot
-            return BalrogTelegramBot(clean_queue_event, stop_event)
+            return BalrogTelegramBot(clean_queue_event, stop_event, process_restart_event)
 
     @abstractmethod
-    def send_text(self, message: str) -> None:
+    def send_text(self, message: str, priority: MessagePriority = MessagePriority.TEXT) -> None:
         pass
 
     @abstractmethod
-    def send_img(self, img: MatLike, caption: str) -> None:
+    def send_img(self, img: MatLike, caption: str, priority: MessagePriority = MessagePriority.VERDICT) -> None:
+        """
+        Sends a picture. The image must not be modified after the call, since it may be sent later.
+        """
+        pass
+
+    def auto_lock_on_prey(self, frame_timestamp: datetime) -> None:
+        """
+        Locks the flap for incoming cats after a prey verdict, without waiting for it.
+        :param frame_timestamp: the capture time of the frame that completed the verdict
+        """
+        pass
+
+    def close(self) -> None:
+        """
+        Gives the pending messages a chance to be sent before exiting.
+        """
         pass
 
     @property
@@ -44,12 +78,12 @@ class MessageSender(ABC):
         self._node_live_img = node_live_img
 
     @property
-    def node_last_casc_img(self) -> MatLike | None:
-        return self._node_last_casc_img
+    def node_last_casc_event(self) -> Optional['EventElement']:
+        return self._node_last_casc_event
 
-    @node_last_casc_img.setter
-    def node_last_casc_img(self, node_last_casc_img: MatLike) -> None:
-        self._node_last_casc_img = node_last_casc_img
+    @node_last_casc_event.setter
+    def node_last_casc_event(self, node_last_casc_event: 'EventElement') -> None:
+        self._node_last_casc_event = node_last_casc_event
 
     @property
     def node_queue_info(self) -> int | None:
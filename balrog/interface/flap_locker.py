@@ -1,39 +1,140 @@
 import asyncio
 import os
+import time
+from collections import deque
 from datetime import datetime
-from typing import Any
+from typing import Any, Optional, Self, Generic, TypeVar, Callable, Awaitable
 
+import aiohttp
 import pytz
 from surepy import Surepy, SurepyEntity, SurepyDevice, EntityType
 from surepy.entities.devices import Flap
 from surepy.entities.pet import Pet
 from surepy.enums import LockState, Location
 
-from balrog.config import general_config
-from balrog.interface import MessageSender
+from balrog.config import general_config, flap_config, add_reload_listener, remove_reload_listener
+from balrog.interface import MessageSender, MessagePriority
 from balrog.utils.utils import logger
 
+T = TypeVar('T')
+# Number of frame-to-lock latencies kept for the statistics
+_LATENCY_HISTORY = 32
+
+
+class _CachedState(Generic[T]):
+    """
+    State fetched from the Surepet API, reused during ttl seconds. Concurrent requests while the state is being fetched
+    share that fetch instead of starting new ones. Must be used from a single event loop.
+    """
+    def __init__(self, fetch: Callable[[], Awaitable[T]], ttl: float):
+        self._fetch = fetch
+        self.ttl = ttl
+        self._value: Optional[T] = None
+        self._fetch_time = 0.0
+        self._fetch_task: Optional[asyncio.Task] = None
+        # Incremented by each invalidation, so a fetch started before it does not store the old state
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def get(self) -> T:
+        if self._value is not None and time.monotonic() - self._fetch_time < self.ttl:
+            self.hits += 1
+            return self._value
+        if self._fetch_task is not None and not self._fetch_task.done():
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            self._fetch_task = asyncio.create_task(self._fetch_value(self._generation))
+        # A cancelled request must not cancel the fetch shared with other requests
+        return await asyncio.shield(self._fetch_task)
+
+    async def _fetch_value(self, generation: int) -> T:
+        fetch_time = time.monotonic()
+        value = await self._fetch()
+        if generation == self._generation:
+            self._value = value
+            self._fetch_time = fetch_time
+        return value
+
+    def invalidate(self) -> None:
+        self._generation += 1
+        self._value = None
+        self._fetch_task = None
+
+    def __str__(self) -> str:
+        return f"{self.hits} hits, {self.misses} misses, {self.coalesced} coalesced"
+
 
 class FlapLocker:
-    def __init__(self):
+    def __init__(self, session: aiohttp.ClientSession):
+        """
+        Use FlapLocker.create() from the event loop that will run the commands (see FlapLockerLoop).
+        :param session: the HTTP session used for all the requests to the Surepet API
+        """
         # user/password authentication (gets a token in background)
         if os.getenv('SUREPET_USER') == "":
             raise Exception("Surepet username not set!. Please set the 'SUREPET_USER' environment variable")
         if os.getenv('SUREPET_PASSWORD') == "":
             raise Exception("Surepet password not set!. Please set the 'SUREPET_PASSWORD' environment variable")
-        self.surepy = Surepy(email=os.getenv('SUREPET_USER'), password=os.getenv('SUREPET_PASSWORD'))
+        # Without a session, surepy opens a new one (and a new connection) for every request
+        self.session = session
+        self.surepy = Surepy(email=os.getenv('SUREPET_USER'), password=os.getenv('SUREPET_PASSWORD'), session=session)
+        # The state of the devices and pets is cached; our own writes invalidate it
+        self._entities = _CachedState(self._fetch_entities, flap_config.device_cache_ttl_seconds)
+        self._pets_status = _CachedState(self.surepy.sac.get_pets, flap_config.device_cache_ttl_seconds)
+        # Lock state to restore after a timed unlock (e.g., /letin) or lock, and the task that restores it
+        self._restore_state: Optional[LockState] = None
+        self._restore_task: Optional[asyncio.Task] = None
+        # Last known ID and lock state of the cat flap, so the auto-lock does not need to wait for a refresh
+        self._cat_flap_id: Optional[int] = None
+        self._known_lock_state: Optional[LockState] = None
+        self.auto_lock_latencies: deque[float] = deque(maxlen=_LATENCY_HISTORY)
+        add_reload_listener(self._apply_config)
+
+    def _apply_config(self) -> None:
+        self._entities.ttl = flap_config.device_cache_ttl_seconds
+        self._pets_status.ttl = flap_config.device_cache_ttl_seconds
+
+    @classmethod
+    async def create(cls, session_factory: Callable[[], aiohttp.ClientSession] = aiohttp.ClientSession) -> Self:
+        """
+        :param session_factory: creates the HTTP session (e.g., one whose requests go to a stand-in of the Surepet API)
+        """
+        # The session must be created inside the event loop that uses it
+        return cls(session_factory())
+
+    async def close(self) -> None:
+        """
+        Restores the lock state of a pending timed unlock right away, and closes the HTTP session.
+        """
+        remove_reload_listener(self._apply_config)
+        if self._restore_task is not None and not self._restore_task.done():
+            self._restore_task.cancel()
+            logger.info(f"Restoring lock state {self._restore_state} before closing")
+            await self._set_moria_lock_state(self._restore_state, None)
+        await self.session.close()
+
+    def cache_stats(self) -> str:
+        """
+        :return: the hit/miss counters of the caches of the Surepet state
+        """
+        return f"devices: {self._entities}; pets: {self._pets_status}"
 
     # Functions used to "introspect" the information about pets and devices
     # to register commands
     async def get_pets_data(self) -> dict[str, int]:
-        registered_pets: list[Pet] = await self.surepy.get_pets()
+        registered_pets: list[Pet] = [
+            entity for entity in (await self._entities.get()).values() if isinstance(entity, Pet)
+        ]
         pets_data: dict[str, int] = dict()
         for registered_pet in registered_pets:
             pets_data[registered_pet.name] = registered_pet.pet_id
         return pets_data
 
     async def get_devices_data(self) -> dict[str, int]:
-        registered_devices: list[SurepyDevice] = await self._get_fresh_devices()
+        registered_devices: list[SurepyDevice] = await self._get_devices()
         devices_data: dict[str, int] = dict()
         for registered_device in registered_devices:
             devices_data[registered_device.name] = registered_device.id
@@ -42,7 +143,7 @@ class FlapLocker:
     # Functions used to send data from surepy to the telegram interface
     async def send_pets_data(self, msg_sender: MessageSender) -> None:
         # list with all pets
-        pets: list[dict[str, Any]] = await self.surepy.sac.get_pets()
+        pets: list[dict[str, Any]] = await self._pets_status.get()
         message = f"I found this:"
         for pet in pets:
             location: Location = Location(pet['status']['activity']['where'])
@@ -53,7 +154,7 @@ class FlapLocker:
         msg_sender.send_text(message)
 
     async def send_device_data(self, msg_sender: MessageSender, device_id: int) -> None:
-        devices: list[SurepyDevice] = await self._get_fresh_devices()
+        devices: list[SurepyDevice] = await self._get_devices()
         for device in devices:
             if device.id == device_id:
                 if isinstance(device, Flap):
@@ -70,10 +171,10 @@ class FlapLocker:
 
     async def list_devices(self, msg_sender: MessageSender) -> None:
         # all entities as id-indexed dict
-        entities: dict[int, SurepyEntity] = await self.surepy.get_entities()
+        entities: dict[int, SurepyEntity] = await self._entities.get()
 
         # list with all devices
-        devices: list[SurepyDevice] = await self._get_fresh_devices()
+        devices: list[SurepyDevice] = await self._get_devices()
         for device in devices:
             msg_sender.send_text(f"{device.name = } | {device.serial = } | {device.battery_level = }")
             msg_sender.send_text(f"{device.type = } | {device.unique_id = } | {device.id = }")
@@ -81,7 +182,7 @@ class FlapLocker:
 
     async def get_lock_state(self) -> LockState:
         try:
-            devices: list[SurepyDevice] = await self._get_fresh_devices()
+            devices: list[SurepyDevice] = await self._get_devices()
             for device in devices:
                 if device.type == EntityType.CAT_FLAP:
                     cat_flap: Flap = device
@@ -92,16 +193,35 @@ class FlapLocker:
             logger.debug('WARNING: We assume that the old state was "LOCKED_OUT"')
             return LockState.LOCKED_OUT
 
-    async def _set_moria_lock_state(self, state: LockState, telegram_bot) -> None:
-        # list with all devices
-        devices: list[SurepyDevice] = await self._get_fresh_devices()
-        for device in devices:
-            # Search for the cat flap
-            if device.type == EntityType.CAT_FLAP:
-                result_lock = await self.surepy.sac._set_lock_state(device.id, state)
-                result_device = await self.surepy.get_device(device.id)
-                if result_lock and result_device:
-                    telegram_bot.send_text('Done')
+    async def _set_moria_lock_state(self, state: LockState, telegram_bot) -> bool:
+        """
+        Changes the lock state of the cat flap.
+        :param state: the new lock state
+        :param telegram_bot: the sender that gets the confirmation (or the failure); None to not send anything
+        :return: whether the flap confirmed the new lock state
+        """
+        # The ID of the cat flap is known since the first fetch of the devices, so this is a single request
+        if self._cat_flap_id is None:
+            await self._get_devices()
+        if self._cat_flap_id is None:
+            logger.error("No cat flap was found")
+            return False
+        try:
+            result_lock = await self.surepy.sac._set_lock_state(self._cat_flap_id, state)
+        finally:
+            # Even if the request failed, we don't know the state of the flap anymore (until it confirms the new one,
+            # or the next fetch)
+            self._entities.invalidate()
+            self._known_lock_state = None
+        if not result_lock:
+            logger.error(f"The flap did not confirm the lock state {state}")
+            if telegram_bot is not None:
+                telegram_bot.send_text(f'The flap did not confirm the lock state {state.name}')
+            return False
+        self._known_lock_state = state
+        if telegram_bot is not None:
+            telegram_bot.send_text('Done')
+        return True
 
     async def unlock_moria(self, msg_sender: MessageSender) -> None:
         await self._set_moria_lock_state(LockState.UNLOCKED, msg_sender)
@@ -125,7 +245,12 @@ class FlapLocker:
         await self._set_moria_lock_state(LockState.CURFEW_UNLOCKED, msg_sender)
 
     async def unlock_for_seconds(self, msg_sender: MessageSender, seconds: int) -> None:
-        old_state = await self.get_lock_state()
+        if self._restore_task is not None and not self._restore_task.done():
+            # Another timed unlock is running: we extend it, and restore the state from before the first one
+            self._restore_task.cancel()
+            old_state = self._restore_state
+        else:
+            old_state = await self.get_lock_state()
         logger.debug(f"Old state = {old_state}")
         if old_state >= LockState.CURFEW:
             new_state = LockState.CURFEW_UNLOCKED
@@ -133,12 +258,61 @@ class FlapLocker:
             new_state = LockState.LOCKED_IN
         logger.debug(f"New state = {new_state}")
         await self._set_moria_lock_state(new_state, msg_sender)
+        self._schedule_restore(old_state, seconds, msg_sender)
+
+    async def lock_out_on_prey(self, msg_sender: MessageSender, seconds: float, frame_timestamp: datetime) -> None:
+        """
+        Fast path of the auto-lock on a prey verdict: locks the flap for incoming cats right away (with the last known
+        state of the flap instead of a refresh), and restores the previous state after the given time.
+        :param msg_sender: the sender that gets the confirmation
+        :param seconds: the time (in seconds) that the flap stays locked
+        :param frame_timestamp: the capture time of the frame that completed the verdict
+        """
+        if self._known_lock_state is None:
+            await self._get_devices()
+        restore_pending = self._restore_task is not None and not self._restore_task.done()
+        if not restore_pending and self._known_lock_state in (LockState.LOCKED_OUT, LockState.LOCKED_ALL):
+            logger.info(f"Auto-lock: the flap is already locked ({self._known_lock_state})")
+            return
+        if restore_pending:
+            # A timed unlock (or lock) is running: after the lock we restore the state from before it
+            self._restore_task.cancel()
+            old_state = self._restore_state
+        else:
+            old_state = self._known_lock_state
+
+        try:
+            locked = await self._set_moria_lock_state(LockState.LOCKED_OUT, None)
+        except Exception:
+            logger.exception("Auto-lock: exception while locking the flap")
+            locked = False
+        if not locked:
+            msg_sender.send_text("Prey detected, but Moria could not be locked for incoming gatos! "
+                                 "Use /lockout to try again", MessagePriority.VERDICT)
+            if restore_pending:
+                # The cancelled restore is still needed, so the state from before the timed unlock comes back
+                self._schedule_restore(old_state, seconds, msg_sender)
+            return
+        latency = (datetime.now(frame_timestamp.tzinfo) - frame_timestamp).total_seconds()
+        self.auto_lock_latencies.append(latency)
+        logger.info(f"Auto-lock: flap locked for incoming cats, frame-to-lock latency: {latency:.3f}s")
+        msg_sender.send_text(f"Prey detected: Moria locked for incoming gatos for {seconds}s "
+                             f"(frame-to-lock: {latency:.2f}s). Use /letin to open it", MessagePriority.VERDICT)
+        if old_state is not None:
+            self._schedule_restore(old_state, seconds, msg_sender)
+
+    def _schedule_restore(self, old_state: LockState, seconds: float, msg_sender: MessageSender) -> None:
+        # The restore is scheduled in the loop, so nobody waits for it
+        self._restore_state = old_state
+        self._restore_task = asyncio.create_task(self._restore_lock_state(old_state, seconds, msg_sender))
+
+    async def _restore_lock_state(self, old_state: LockState, seconds: float, msg_sender: MessageSender) -> None:
         await asyncio.sleep(seconds)
         logger.debug(f"Setting back old state = {old_state}")
         await self._set_moria_lock_state(old_state, msg_sender)
 
     async def switch_pet_location(self, telegram_bot, pet_id: int) -> None:
-        pets: list[dict[str, Any]] = await self.surepy.sac.get_pets()
+        pets: list[dict[str, Any]] = await self._pets_status.get()
         if pets is None:
             telegram_bot.send_text(f"No pet was found int he server")
             return
@@ -159,13 +333,25 @@ class FlapLocker:
             new_location = Location.OUTSIDE
         else:
             new_location = Location.INSIDE
-        await self.surepy.sac.set_pet_location(pet_id, new_location)
+        try:
+            await self.surepy.sac.set_pet_location(pet_id, new_location)
+        finally:
+            self._pets_status.invalidate()
         telegram_bot.send_text(f"Pet with name = '{chosen_pet['name']}' was marked as '{new_location}'")
 
-    # Helper function used to get fresh data from the devices, so the states are NOT cached by surepy library
-    async def _get_fresh_devices(self) -> list[SurepyDevice]:
+    # Helper functions used to get the data of the devices. We always ask surepy for fresh data (so the states are NOT
+    # cached by surepy library), and we reuse it for device_cache_ttl_seconds
+    async def _fetch_entities(self) -> dict[int, SurepyEntity]:
+        entities = dict(await self.surepy.get_entities(refresh=True))
+        for entity in entities.values():
+            if entity.type == EntityType.CAT_FLAP:
+                self._cat_flap_id = entity.id
+                self._known_lock_state = entity.state
+        return entities
+
+    async def _get_devices(self) -> list[SurepyDevice]:
         return [
             device
-            for device in (await self.surepy.get_entities(refresh=True)).values()
+            for device in (await self._entities.get()).values()
             if isinstance(device, SurepyDevice)
         ]
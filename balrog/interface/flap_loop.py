@@ -0,0 +1,72 @@
+import asyncio
+from concurrent.futures import Future
+from threading import Thread
+from typing import Any, Callable, Coroutine, Optional, TypeVar
+
+import aiohttp
+
+from balrog.utils import logger
+from .flap_locker import FlapLocker
+
+T = TypeVar('T')
+
+
+class FlapLockerLoop:
+    """
+    Runs the FlapLocker in a single, long-lived asyncio event loop with its own thread. The FlapLocker (and its HTTP
+    session with the Surepet API) is created in this loop, so every command reuses the same session and login, and the
+    threads of the bot only submit coroutines to it instead of running a new event loop per command.
+    """
+    def __init__(self, session_factory: Callable[[], aiohttp.ClientSession] = aiohttp.ClientSession):
+        """
+        :param session_factory: creates the HTTP session of the FlapLocker (see FlapLocker.create)
+        """
+        self.loop = asyncio.new_event_loop()
+        self._thread = Thread(target=self._run, name='flap-locker-loop', daemon=True)
+        self._thread.start()
+        self.flap_locker: FlapLocker = self.run(FlapLocker.create(session_factory))
+
+    def _run(self) -> None:
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    @staticmethod
+    def _log_exception(future: Future) -> None:
+        if not future.cancelled() and future.exception() is not None:
+            logger.error(f"Exception in flap locker task: {repr(future.exception())}")
+
+    def submit(self, coroutine: Coroutine[Any, Any, T]) -> Future[T]:
+        """
+        Schedules a coroutine in the loop, without waiting for it. Its exceptions are logged.
+        :param coroutine: the coroutine to run
+        :return: the future with the result of the coroutine
+        """
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        future.add_done_callback(FlapLockerLoop._log_exception)
+        return future
+
+    def run(self, coroutine: Coroutine[Any, Any, T], timeout: Optional[float] = None) -> T:
+        """
+        Runs a coroutine in the loop, and waits for its result.
+        :param coroutine: the coroutine to run
+        :param timeout: maximum time (in seconds) to wait for the result; None to wait forever
+        :return: the result of the coroutine
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(timeout)
+
+    def close(self, timeout: float) -> None:
+        """
+        Closes the flap locker (applying the pending lock state changes), stops the loop and closes it.
+        :param timeout: maximum time (in seconds) to wait for the flap locker
+        """
+        try:
+            self.run(self.flap_locker.close(), timeout)
+        except Exception:
+            logger.exception("Exception while closing the flap locker")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout)
+        # A running loop can't be closed; if it is still stuck in a task, we leave it to the daemon thread
+        if self._thread.is_alive():
+            logger.warning("The flap locker loop did not stop; not closing it")
+        else:
+            self.loop.close()
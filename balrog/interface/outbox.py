@@ -0,0 +1,213 @@
+import heapq
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from itertools import count
+from threading import Condition, Thread
+from typing import Optional
+
+import cv2
+from cv2.typing import MatLike
+from telegram import Bot, ParseMode
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut
+from telegram.utils.request import Request
+
+from balrog.interface import MessagePriority
+from balrog.utils import logger
+
+# Only the worker of the outbox uses the bot, so a single (kept-alive) connection is enough
+_CONNECTION_POOL_SIZE = 1
+# Attempts to send a message when the connection fails or Telegram asks us to slow down
+_MAX_SEND_ATTEMPTS = 3
+_RETRY_WAIT_SECONDS = 1.0
+# Number of send latencies kept (per priority) for the statistics
+_LATENCY_HISTORY = 256
+
+
+def create_outbox_bot(token: str, base_url: Optional[str] = None) -> Bot:
+    """
+    Creates the bot used by the outbox, with its own connection pool.
+    :param token: the token of the bot
+    :param base_url: the URL of the Bot API (e.g., a local stand-in server); None for the Telegram servers
+    """
+    return Bot(token=token, base_url=base_url, request=Request(con_pool_size=_CONNECTION_POOL_SIZE))
+
+
+def encode_img(img: MatLike, max_width: int, jpeg_quality: int) -> bytes:
+    """
+    Encodes a picture as JPEG in memory.
+    :param img: the (BGR) picture
+    :param max_width: pictures wider than this are downscaled (keeping their aspect ratio); 0 for no limit
+    :param jpeg_quality: the JPEG quality, from 0 to 100
+    :return: the JPEG bytes
+    """
+    if 0 < max_width < img.shape[1]:
+        new_size = (max_width, max(1, int(img.shape[0] * max_width / img.shape[1])))
+        img = cv2.resize(img, new_size, interpolation=cv2.INTER_AREA)
+    encoded, jpeg = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])
+    if not encoded:
+        raise Exception("Could not encode the picture as JPEG")
+    return jpeg.tobytes()
+
+
+@dataclass(order=True)
+class _OutboxMessage:
+    priority: MessagePriority
+    sequence_number: int
+    text: str = field(compare=False)
+    img: Optional[MatLike] = field(default=None, compare=False)
+    enqueue_time: float = field(default_factory=time.perf_counter, compare=False)
+
+
+class Outbox:
+    """
+    Sends the messages of the bot from a single worker thread, so the threads that produce them (the aggregator, the
+    verdict senders and the command handlers) never wait for the network. The pending messages are sent in order of
+    priority (verdicts first), a new live picture replaces the one still waiting, and when the outbox is full the least
+    important (and newest) message is dropped. The pictures are encoded by the worker, so a live picture that gets
+    replaced is never encoded.
+    """
+    def __init__(self, bot: Bot, chat_id: str, capacity: int, image_max_width: int, jpeg_quality: int):
+        """
+        :param bot: the bot used to send the messages (see create_outbox_bot)
+        :param chat_id: the chat that receives the messages
+        :param capacity: the maximum number of pending messages
+        :param image_max_width: pictures wider than this are downscaled before sending them; 0 for no limit
+        :param jpeg_quality: the JPEG quality of the pictures
+        """
+        if capacity < 1:
+            raise Exception("The capacity of the outbox must be at least 1. Please check the configuration file")
+        self.bot = bot
+        self.chat_id = chat_id
+        self.capacity = capacity
+        self.image_max_width = image_max_width
+        self.jpeg_quality = jpeg_quality
+        self._pending: list[_OutboxMessage] = []
+        self._sequence_numbers = count()
+        self._condition = Condition()
+        self._sending = False
+        self._stopped = False
+        self._thread = Thread(target=self._run, name='telegram-outbox', daemon=True)
+        self._latencies: dict[MessagePriority, deque[float]] = {
+            priority: deque(maxlen=_LATENCY_HISTORY) for priority in MessagePriority
+        }
+        self.sent_messages = 0
+        self.coalesced_messages = 0
+        self.dropped_messages = 0
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self, timeout: float) -> None:
+        """
+        Stops the worker, once the pending messages are sent or the timeout expires.
+        :param timeout: maximum time (in seconds) to wait for the pending messages
+        """
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while (self._pending or self._sending) and self._thread.is_alive():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logger.warning(f"Outbox stopped with {len(self._pending)} pending messages")
+                    break
+                self._condition.wait(remaining)
+            self._stopped = True
+            self._condition.notify_all()
+        if self._thread.is_alive():
+            self._thread.join(max(0.0, deadline - time.monotonic()))
+
+    def put_text(self, text: str, priority: MessagePriority = MessagePriority.TEXT) -> None:
+        self._put(_OutboxMessage(priority, next(self._sequence_numbers), text))
+
+    def put_img(self, img: MatLike, caption: str, priority: MessagePriority = MessagePriority.VERDICT) -> None:
+        self._put(_OutboxMessage(priority, next(self._sequence_numbers), caption, img))
+
+    def latencies(self, priority: MessagePriority) -> list[float]:
+        """
+        :return: the last send latencies (from the moment a message is queued until it is sent) of the given priority
+        """
+        with self._condition:
+            return list(self._latencies[priority])
+
+    def _put(self, message: _OutboxMessage) -> None:
+        with self._condition:
+            if self._stopped:
+                logger.warning(f"Outbox is stopped; dropping message '{message.text}'")
+                return
+            if message.priority == MessagePriority.LIVE:
+                live_count = len(self._pending)
+                self._pending = [pending for pending in self._pending if pending.priority != MessagePriority.LIVE]
+                self.coalesced_messages += live_count - len(self._pending)
+                heapq.heapify(self._pending)
+            if len(self._pending) >= self.capacity:
+                least_important = max(self._pending)
+                if message > least_important:
+                    self.dropped_messages += 1
+                    logger.warning(f"Outbox is full; dropping message '{message.text}'")
+                    return
+                self._pending.remove(least_important)
+                heapq.heapify(self._pending)
+                self.dropped_messages += 1
+                logger.warning(f"Outbox is full; dropping message '{least_important.text}'")
+            heapq.heappush(self._pending, message)
+            self._condition.notify_all()
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while not self._pending and not self._stopped:
+                    self._condition.wait()
+                if self._stopped:
+                    return
+                message = heapq.heappop(self._pending)
+                self._sending = True
+            try:
+                self._send(message)
+            except Exception:
+                logger.exception(f"Exception while sending message '{message.text}'")
+            finally:
+                with self._condition:
+                    self._sending = False
+                    self._condition.notify_all()
+
+    def _send(self, message: _OutboxMessage) -> None:
+        photo = None
+        if message.img is not None:
+            photo = encode_img(message.img, self.image_max_width, self.jpeg_quality)
+            message.img = None
+        for attempt in range(1, _MAX_SEND_ATTEMPTS + 1):
+            try:
+                if photo is not None:
+                    self.bot.send_photo(chat_id=self.chat_id, photo=photo, caption=message.text)
+                else:
+                    self.bot.send_message(chat_id=self.chat_id, text=message.text, parse_mode=ParseMode.MARKDOWN)
+                break
+            except RetryAfter as e:
+                if attempt == _MAX_SEND_ATTEMPTS:
+                    raise
+                logger.warning(f"Telegram asked to wait {e.retry_after}s before sending more messages")
+                time.sleep(e.retry_after)
+            except BadRequest as e:
+                # Telegram rejected the message (e.g., its Markdown can't be parsed), so sending it again won't help
+                with self._condition:
+                    self.dropped_messages += 1
+                logger.error(f"Telegram rejected the message '{message.text}' ({e}); dropping it")
+                return
+            except TimedOut:
+                if photo is not None:
+                    # Telegram may have received the picture anyway; sending it again could post the verdict twice
+                    logger.warning(f"Timed out while sending the picture '{message.text}'; not sending it again")
+                    return
+                if attempt == _MAX_SEND_ATTEMPTS:
+                    raise
+                logger.warning(f"Timed out while sending a message (attempt {attempt}), retrying...")
+                time.sleep(_RETRY_WAIT_SECONDS * attempt)
+            except NetworkError:
+                if attempt == _MAX_SEND_ATTEMPTS:
+                    raise
+                logger.warning(f"Network error while sending a message (attempt {attempt}), retrying...")
+                time.sleep(_RETRY_WAIT_SECONDS * attempt)
+
+        with self._condition:
+            self.sent_messages += 1
+            self._latencies[message.priority].append(time.perf_counter() - message.enqueue_time)
@@ -1,23 +1,29 @@
-import asyncio
 import os
-from tempfile import TemporaryDirectory
+from datetime import datetime
 from threading import Event, Thread
-from typing import Callable
+from typing import Callable, Optional
 
-import cv2
 from cv2.typing import MatLike
-from telegram import Bot, Update, ParseMode
+from telegram import Update
 from telegram.ext import Updater, CommandHandler
 from telegram.ext.callbackcontext import CallbackContext
 
-from balrog.config import flap_config
-from balrog.interface import MessageSender
+from balrog.config import flap_config, telegram_config, reload_config
+from balrog.interface import MessageSender, MessagePriority
 from balrog.utils import Logging, logger
-from .flap_locker import FlapLocker
+from .flap_loop import FlapLockerLoop
+from .outbox import Outbox, create_outbox_bot
+
+# Maximum time to send the pending messages before exiting
+_OUTBOX_DRAIN_SECONDS = 5.0
+# Maximum time to restore the lock state of a pending timed unlock before exiting
+_FLAP_LOOP_CLOSE_SECONDS = 10.0
+# Maximum time to stop the polling of the bot before exiting; a wedged handler is left behind
+_UPDATER_STOP_SECONDS = 10.0
 
 
 class BalrogTelegramBot(MessageSender):
-    def __init__(self, clean_queue_event: Event, stop_event: Event):
+    def __init__(self, clean_queue_event: Event, stop_event: Event, process_restart_event: Optional[Event] = None):
         # Insert Chat ID and Bot Token according to Telegram API
         super().__init__()
         if os.getenv('TELEGRAM_CHAT_ID') == "":
@@ -26,16 +32,27 @@ class BalrogTelegramBot(MessageSender):
             raise Exception("Telegram Bot token not set!. Please set the 'TELEGRAM_BOT_TOKEN' environment variable")
         self.CHAT_ID = os.getenv('TELEGRAM_CHAT_ID')
         self.BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
-        self.telegram_bot = Bot(token=self.BOT_TOKEN)
+        self.telegram_bot = create_outbox_bot(self.BOT_TOKEN)
+        self.outbox = Outbox(
+            self.telegram_bot,
+            self.CHAT_ID,
+            capacity=telegram_config.outbox_capacity,
+            image_max_width=telegram_config.image_max_width,
+            jpeg_quality=telegram_config.jpeg_quality
+        )
+        self.outbox.start()
         self.bot_updater = Updater(token=self.BOT_TOKEN, use_context=True)
-        self.flap_handler = FlapLocker()
+        self.flap_loop = FlapLockerLoop()
+        self.flap_handler = self.flap_loop.flap_locker
         self.commands: dict[str,  Callable[[Update, CallbackContext], None]] = dict()
         pets_data = self._list_pets()
         devices_data = self._list_devices()
         self._populate_supported_commands(pets_data, devices_data)
         # Event to signal the main loop that the queue needs to be cleaned
         self.clean_queue_event = clean_queue_event
+        # Events to ask the supervisor for a soft restart (stop_event), or for a restart of the process (both)
         self.stop_event = stop_event
+        self.process_restart_event = process_restart_event
 
         # Init the listener
         self._init_bot_listener()
@@ -44,6 +61,8 @@ class BalrogTelegramBot(MessageSender):
         self.commands['help'] = self._help_cmd_callback
         self.commands['clean'] = self._clean_cmd_callback
         self.commands['restart'] = self._restart_cmd_callback
+        self.commands['hardrestart'] = self._hard_restart_cmd_callback
+        self.commands['reload'] = self._reload_cmd_callback
         self.commands['nodestatus'] = self._send_status_cmd_callback
         self.commands['sendlivepic'] = self._send_live_pic_cmd_callback
         self.commands['sendlastcascpic'] = self._send_last_casc_pic_cmd_callback
@@ -65,7 +84,7 @@ class BalrogTelegramBot(MessageSender):
     # Constructor supporter functions
 
     def _init_bot_listener(self) -> None:
-        self.telegram_bot.send_message(chat_id=self.CHAT_ID, text='Balrog is online!')
+        self.send_text('Balrog is online!')
         # Add all commands to handler
         for command in self.commands:
             logger.info(f"Registering command '{command}'")
@@ -80,13 +99,28 @@ class BalrogTelegramBot(MessageSender):
 
     # Raw send text and img functions
 
-    def send_text(self, message: str) -> None:
-        self.telegram_bot.send_message(chat_id=self.CHAT_ID, text=message, parse_mode=ParseMode.MARKDOWN)
+    def send_text(self, message: str, priority: MessagePriority = MessagePriority.TEXT) -> None:
+        self.outbox.put_text(message, priority)
+
+    def send_img(self, img: MatLike, caption: str, priority: MessagePriority = MessagePriority.VERDICT) -> None:
+        self.outbox.put_img(img, caption, priority)
 
-    def send_img(self, img: MatLike, caption: str) -> None:
-        with TemporaryDirectory() as tmp_dir:
-            cv2.imwrite(f'{tmp_dir}/balrog_send_img.jpg', img)
-            self.telegram_bot.send_photo(chat_id=self.CHAT_ID, photo=open(f'{tmp_dir}/balrog_send_img.jpg', 'rb'), caption=caption)
+    def auto_lock_on_prey(self, frame_timestamp: datetime) -> None:
+        # The session with the Surepet API is already open (and the flap known), so this is a single request
+        self.flap_loop.submit(
+            self.flap_handler.lock_out_on_prey(self, flap_config.auto_lock_hold_seconds, frame_timestamp)
+        )
+
+    def close(self) -> None:
+        # The polling must stop before a new bot starts (e.g., after a soft restart); this can't be done from a handler,
+        # since the dispatcher waits for its handlers
+        stop_thread = Thread(target=self._stop_telegram, daemon=True)
+        stop_thread.start()
+        stop_thread.join(_UPDATER_STOP_SECONDS)
+        if stop_thread.is_alive():
+            logger.warning(f"Telegram polling did not stop in {_UPDATER_STOP_SECONDS}s; leaving it behind")
+        self.flap_loop.close(_FLAP_LOOP_CLOSE_SECONDS)
+        self.outbox.stop(_OUTBOX_DRAIN_SECONDS)
 
     # Telegram Bot message handler callbacks
 
@@ -106,28 +140,48 @@ class BalrogTelegramBot(MessageSender):
         self.bot_updater.is_idle = False
 
     def _restart_cmd_callback(self, update: Update, context: CallbackContext) -> None:
-        self.send_text('Restarting script...')
-        stop_thread = Thread(target=self._stop_telegram)
-        stop_thread.start()
-        stop_thread.join()
+        # The supervisor creates the camera, buffers, processor and bot again, keeping the models loaded
+        self.send_text('Restarting (the models stay loaded)...')
+        self.stop_event.set()
+
+    def _hard_restart_cmd_callback(self, update: Update, context: CallbackContext) -> None:
+        if self.process_restart_event is None:
+            self.send_text('Restarting the process is not supported; use /restart')
+            return
+        self.send_text('Restarting the process (the models are loaded again)...')
+        self.process_restart_event.set()
         self.stop_event.set()
 
+    def _reload_cmd_callback(self, update: Update, context: CallbackContext) -> None:
+        try:
+            report = reload_config()
+        except Exception as e:
+            logger.exception("Exception while reloading the config file")
+            self.send_text(f'Could not reload the config file: `{e}`')
+            return
+        logger.info(str(report))
+        self.send_text(str(report))
+
     def _clean_cmd_callback(self, update: Update, context: CallbackContext) -> None:
         self.send_text('Cleaning old logs...')
         removed_paths = Logging.clean_logs()
         self.send_text(f'Removed: [{*removed_paths,}]')
 
     def _send_last_casc_pic_cmd_callback(self, update: Update, context: CallbackContext) -> None:
-        if self.node_last_casc_img is not None:
+        # The output image of the last cascade is only rendered when it is requested
+        last_casc_event = self.node_last_casc_event
+        last_casc_img = last_casc_event.render_output_img() if last_casc_event is not None else None
+        if last_casc_img is not None:
             caption = 'Last Cascade:'
-            self.send_img(self.node_last_casc_img, caption)
+            self.send_img(last_casc_img, caption, MessagePriority.TEXT)
         else:
             self.send_text('No casc img available yet...')
 
     def _send_live_pic_cmd_callback(self, update: Update, context: CallbackContext) -> None:
         if self.node_live_img is not None:
             caption = 'Here ya go...'
-            self.send_img(self.node_live_img, caption)
+            # The live image is a buffer that the aggregator keeps rewriting; we send a snapshot of it
+            self.send_img(self.node_live_img.copy(), caption, MessagePriority.LIVE)
         else:
             self.send_text('No img available yet...')
 
@@ -136,116 +190,68 @@ class BalrogTelegramBot(MessageSender):
             bot_message = f'Queue length: {self.node_queue_info}\nOverhead: {self.node_over_head_info}s'
         else:
             bot_message = 'No info yet...'
+        bot_message += f'\nSurepet cache: {self.flap_handler.cache_stats()}'
+        if self.flap_handler.auto_lock_latencies:
+            bot_message += f'\nLast auto-lock (frame-to-lock): {self.flap_handler.auto_lock_latencies[-1]:.2f}s'
         self.send_text(bot_message)
 
     # Internals to support the callbacks
 
     def _unlock_moria_for_seconds(self, seconds) -> None:
-        try:
-            loop = asyncio.get_running_loop()
-        except RuntimeError:
-            return asyncio.run(self.flap_handler.unlock_for_seconds(self, seconds))
-        else:
-            return loop.run_until_complete(self.flap_handler.unlock_for_seconds(self, seconds))
+        self.flap_loop.submit(self.flap_handler.unlock_for_seconds(self, seconds))
 
     def _lock_moria(self, update: Update, context: CallbackContext) -> None:
         self.send_text("Locking Moria!")
-        try:
-            loop = asyncio.get_running_loop()
-        except RuntimeError:
-            return asyncio.run(self.flap_handler.lock_moria(self))
-        else:
-            return loop.run_until_complete(self.flap_handler.lock_moria(self))
+        self.flap_loop.submit(self.flap_handler.lock_moria(self))
 
     def _unlock_moria(self, update: Update, context: CallbackContext) -> None:
         self.send_text("Unlocking Moria!")
-        try:
-            loop = asyncio.get_running_loop()
-        except RuntimeError:
-            return asyncio.run(self.flap_handler.unlock_moria(self))
-        else:
-            return loop.run_until_complete(self.flap_handler.unlock_moria(self))
+        self.flap_loop.submit(self.flap_handler.unlock_moria(self))
 
     def _lock_moria_in(self, update: Update, context: CallbackContext) -> None:
         self.send_text("Locking Moria for outgoing gatos!")
-        try:
-            loop = asyncio.get_running_loop()
-        except RuntimeError:
-            return asyncio.run(self.flap_handler.lock_moria_in(self))
-        else:
-            return loop.run_until_complete(self.flap_handler.lock_moria_in(self))
+        self.flap_loop.submit(self.flap_handler.lock_moria_in(self))
 
     def _lock_moria_out(self, update: Update, context: CallbackContext) -> None:
         self.send_text("Locking Moria for incoming gatos!")
-        try:
-            loop = asyncio.get_running_loop()
-        except RuntimeError:
-            return asyncio.run(self.flap_handler.lock_moria_out(self))
-        else:
-            return loop.run_until_complete(self.flap_handler.lock_moria_out(self))
+        self.flap_loop.submit(self.flap_handler.lock_moria_out(self))
 
     def _set_curfew(self, update: Update, context: CallbackContext) -> None:
         self.send_text("Activating curfew!")
-        try:
-            loop = asyncio.get_running_loop()
-        except RuntimeError:
-            return asyncio.run(self.flap_handler.activate_curfew(self))
-        else:
-            return loop.run_until_complete(self.flap_handler.activate_curfew(self))
+        self.flap_loop.submit(self.flap_handler.activate_curfew(self))
 
     def _create_pet_switch_function(self, pet_id: int) -> Callable[[Update, CallbackContext], None]:
         def _switch_pet_state(update: Update, context: CallbackContext) -> None:
-            try:
-                loop = asyncio.get_running_loop()
-            except RuntimeError:
-                return asyncio.run(self.flap_handler.switch_pet_location(self, pet_id))
-            else:
-                return loop.run_until_complete(self.flap_handler.switch_pet_location(self, pet_id))
+            self.flap_loop.submit(self.flap_handler.switch_pet_location(self, pet_id))
         return _switch_pet_state
 
     def _create_device_status_function(self, device_id: int) -> Callable[[Update, CallbackContext], None]:
         def _get_device_status(update: Update, context: CallbackContext) -> None:
-            try:
-                loop = asyncio.get_running_loop()
-            except RuntimeError:
-                return asyncio.run(self.flap_handler.send_device_data(self, device_id))
-            else:
-                return loop.run_until_complete(self.flap_handler.send_device_data(self, device_id))
+            self.flap_loop.submit(self.flap_handler.send_device_data(self, device_id))
         return _get_device_status
 
     def _list_pets_state(self, update: Update, context: CallbackContext) -> None:
-        try:
-            loop = asyncio.get_running_loop()
-        except RuntimeError:
-            return asyncio.run(self.flap_handler.send_pets_data(self))
-        else:
-            return loop.run_until_complete(self.flap_handler.send_pets_data(self))
+        self.flap_loop.submit(self.flap_handler.send_pets_data(self))
 
     def _list_pets(self) -> dict[str, int]:
-        try:
-            loop = asyncio.get_running_loop()
-        except RuntimeError:
-            return asyncio.run(self.flap_handler.get_pets_data())
-        else:
-            return loop.run_until_complete(self.flap_handler.get_pets_data())
+        return self.flap_loop.run(self.flap_handler.get_pets_data())
 
     def _list_devices(self) -> dict[str, int]:
-        try:
-            loop = asyncio.get_running_loop()
-        except RuntimeError:
-            return asyncio.run(self.flap_handler.get_devices_data())
-        else:
-            return loop.run_until_complete(self.flap_handler.get_devices_data())
+        return self.flap_loop.run(self.flap_handler.get_devices_data())
 
 
 class DebugBot(MessageSender):
     def __init__(self):
         super().__init__()
 
-    def send_img(self, img: MatLike, caption: str) -> None:
+    def send_img(self, img: MatLike, caption: str, priority: MessagePriority = MessagePriority.VERDICT) -> None:
         # Nothing to do here; we simply ignore the invocation
         logger.warning(f"DebugTelegramBot - Ignoring sending image!")
 
-    def send_text(self, message: str) -> None:
+    def send_text(self, message: str, priority: MessagePriority = MessagePriority.TEXT) -> None:
         # Nothing to do here; we simply ignore the invocation
         logger.warning(f"DebugTelegramBot - Ignoring sending text!")
+
+    def auto_lock_on_prey(self, frame_timestamp: datetime) -> None:
+        # Nothing to do here; we simply ignore the invocation
+        logger.warning(f"DebugTelegramBot - Ignoring auto-lock!")
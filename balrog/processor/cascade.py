@@ -1,24 +1,55 @@
 import time
-from dataclasses import dataclass
-from typing import Any
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Optional
 
 import cv2
 import numpy as np
 from cv2.typing import MatLike
 
-from balrog.config import logging_config
+from balrog.config import logging_config, tracking_config, inference_config
 from balrog.utils import logger
 from .model_stages import PCStage, FFStage, EyeStage, HaarStage, CCMobileNetStage
+from .tracking import CatTracker
 
 
-@dataclass
+@dataclass(frozen=True)
+class Annotation:
+    """
+    A label drawn on the output image of a frame: a box with its label above it, or (without box) a text at text_pos.
+    """
+    text: str
+    color: tuple[int, int, int]
+    box: Any = None
+    text_pos: tuple[int, int] = (15, 100)
+
+    def draw(self, img: MatLike) -> MatLike:
+        font = cv2.FONT_HERSHEY_SIMPLEX
+        font_scale = 2
+        line_type = 3
+        if self.box is None:
+            cv2.putText(img, self.text, self.text_pos, font, font_scale, self.color, line_type)
+            return img
+        text_pos = (self.box[0][0], int(self.box[0][1] - 16))
+        cv2.putText(img, self.text, text_pos, font, font_scale, self.color, line_type)
+        return cv2.rectangle(img, (self.box[0][0], self.box[0][1]), (self.box[1][0], self.box[1][1]), self.color, 5)
+
+
+@dataclass(slots=True)
 class EventElement:
+    """
+    Result of the cascade for a frame. The aggregator keeps one per frame with a cat during the whole event, so it only
+    holds the (small) results: the frame is dropped unless the output image of the frame may still be sent.
+    """
     img_name: str
-    cc_target_img: MatLike
+    cc_target_img: Optional[MatLike]
     cc_cat_bool: bool = None
-    cc_pred_bb = None
+    cc_pred_bb: Any = None
     cc_inference_time: float = None
-    bbs_target_img: Any = None
+    # Sequence number of the frame; the CC result of the frame may come from the tracker instead of the detector
+    sequence_number: int = -1
+    cc_tracked: bool = False
+    cc_time_saved: float = 0.0
     bbs_pred_bb: Any = None
     bbs_inference_time: float = None
     haar_pred_bb: Any = None
@@ -31,16 +62,23 @@ class EventElement:
     pc_prey_class: bool = None
     pc_prey_val: Any = None
     pc_inference_time: float = None
-    total_inference_time = None
-    output_img: MatLike = None
-    # Fields never assigned?
-    cr_inference_time = None
-    ff_haar_inference_time = None
-    # Fields never used?
-    cr_class = None
-    cr_val = None
-    ff_haar_bool = None
-    ff_haar_val = None
+    total_inference_time: float = None
+    # The output image is only rendered (from the frame and these annotations) when a message needs it
+    annotations: list[Annotation] = field(default_factory=list)
+
+    def render_output_img(self) -> Optional[MatLike]:
+        """
+        Draws the results of the cascade on a copy of the frame.
+        :return: the annotated frame, or None if the event element no longer has its frame
+        """
+        # The aggregator may drop the frame meanwhile (from another thread), so we read it only once
+        img = self.cc_target_img
+        if img is None:
+            return None
+        output_img = img.copy()
+        for annotation in self.annotations:
+            output_img = annotation.draw(output_img)
+        return output_img
 
     def __repr__(self):
         return f"[Evnt-elem: '{self.img_name}', data: '{'ABSENT' if self.cc_target_img is None else 'Present'}'"
@@ -48,12 +86,40 @@ class EventElement:
 
 class Cascade:
     def __init__(self):
-        # Models
-        self.cc_mobile_stage = CCMobileNetStage()
-        self.pc_stage = PCStage()
-        self.ff_stage = FFStage()
-        self.eyes_stage = EyeStage()
-        self.haar_stage = HaarStage()
+        # Models. They are independent, so they are loaded concurrently (most of the time goes to reading the files and
+        # building the graphs, which releases the GIL); the load time of each stage is kept for the startup reports
+        start_time = time.monotonic()
+        stage_classes = {
+            'cc': CCMobileNetStage, 'pc': PCStage, 'ff': FFStage, 'eye': EyeStage, 'haar': HaarStage
+        }
+        with ThreadPoolExecutor(max_workers=max(1, inference_config.model_loader_threads),
+                                thread_name_prefix='model-loader') as loader_pool:
+            futures = {name: loader_pool.submit(Cascade._load_stage, stage_class)
+                       for name, stage_class in stage_classes.items()}
+            loaded = {name: future.result() for name, future in futures.items()}
+        stages = {name: stage for name, (stage, _) in loaded.items()}
+        self.load_times: dict[str, float] = {name: seconds for name, (_, seconds) in loaded.items()}
+        self.cc_mobile_stage: CCMobileNetStage = stages['cc']
+        self.pc_stage: PCStage = stages['pc']
+        self.ff_stage: FFStage = stages['ff']
+        self.eyes_stage: EyeStage = stages['eye']
+        self.haar_stage: HaarStage = stages['haar']
+        load_times = ", ".join(f"{name}: {seconds:.2f}s" for name, seconds in self.load_times.items())
+        logger.info(f"Models of the cascade loaded in {time.monotonic() - start_time:.2f}s ({load_times})")
+        self.tracker: Optional[CatTracker] = None
+        if tracking_config.enable_tracking:
+            self.tracker = CatTracker(
+                tracker_type=tracking_config.tracker_type,
+                redetect_interval=tracking_config.redetect_interval,
+                max_frame_gap=tracking_config.max_frame_gap,
+                frame_width=tracking_config.tracking_frame_width
+            )
+
+    @staticmethod
+    def _load_stage(stage_class: type) -> tuple[Any, float]:
+        start_time = time.monotonic()
+        stage = stage_class()
+        return stage, time.monotonic() - start_time
 
     @staticmethod
     def _log(message: str, exception: Exception | None = None) -> None:
@@ -62,35 +128,92 @@ class Cascade:
         elif logging_config.enable_cascade_logging:
             logger.debug(message)
 
-    def do_single_cascade(self, event_img_object: EventElement, thread_id: int, frame_index: int) -> None:
+    def do_cascade_batch(
+            self,
+            event_img_objects: list[EventElement],
+            thread_id: int,
+            frame_indexes: list[int]
+    ) -> None:
+        """
+        Runs the cascade on several frames. The CC stage (the only one that runs on every frame) processes all the
+        frames in a single session call; the rest of the stages run frame by frame. With tracking enabled, the frames
+        (in sequence order) get the CC result from the tracker, until the tracker needs a new detection.
+        :param event_img_objects: the event elements of the frames to process
+        :param thread_id: the ID of the thread running the cascade
+        :param frame_indexes: the indexes of the buffers of the frames
+        """
+        cc_results: list[Optional[tuple]] = [None] * len(event_img_objects)
+        if self.tracker is not None:
+            for i, event_img_object in enumerate(event_img_objects):
+                tracked = None
+                if event_img_object.sequence_number >= 0:
+                    tracked = self.tracker.track(event_img_object.cc_target_img, event_img_object.sequence_number)
+                if tracked is None:
+                    break
+                tracked_box, tracking_time = tracked
+                cc_results[i] = (tracked_box, True, tracking_time)
+                event_img_object.cc_tracked = True
+                event_img_object.cc_time_saved = max(0.0, (self.tracker.detection_time or 0.0) - tracking_time)
+
+        detection_positions = [i for i, cc_result in enumerate(cc_results) if cc_result is None]
+        if len(detection_positions) > 0:
+            start_time = time.time()
+            detection_results = self.cc_mobile_stage.do_cc_batch(
+                [event_img_objects[i].cc_target_img for i in detection_positions]
+            )
+            Cascade._log(f'Thread {thread_id} - CASCADE - CC batch of {len(detection_positions)} frames compute Time: '
+                         f'{time.time() - start_time}')
+            for i, detection_result in zip(detection_positions, detection_results):
+                cc_results[i] = detection_result
+                event_img_object = event_img_objects[i]
+                if self.tracker is not None and event_img_object.sequence_number >= 0:
+                    pred_cc_bb, cat_bool, inference_time = detection_result
+                    self.tracker.seed(
+                        event_img_object.cc_target_img,
+                        event_img_object.sequence_number,
+                        cat_bool,
+                        pred_cc_bb,
+                        inference_time
+                    )
+
+        for event_img_object, frame_index, cc_result in zip(event_img_objects, frame_indexes, cc_results):
+            self.do_single_cascade(event_img_object, thread_id, frame_index, cc_result)
+
+    def do_single_cascade(
+            self,
+            event_img_object: EventElement,
+            thread_id: int,
+            frame_index: int,
+            cc_result: Optional[tuple] = None
+    ) -> None:
         cc_target_image = event_img_object.cc_target_img
         logger.info(f"Thread {thread_id} - Processing index: '{frame_index}', "
                     f"img_data: {'ABSENT' if event_img_object.cc_target_img is None else 'Present' }, "
                     f"name: '{event_img_object.img_name}'")
-        original_copy_img = cc_target_image.copy()
+        annotations = event_img_object.annotations
+        annotations.clear()
 
         # Do CC
         start_time = time.time()
         dk_bool, cat_bool, bbs_target_img, pred_cc_bb_full, cc_inference_time =(
             Cascade._do_cc_mobile_stage(
                 cc_mobile_stage=self.cc_mobile_stage,
-                cc_target_img=cc_target_image
+                cc_target_img=cc_target_image,
+                cc_result=cc_result
         ))
         current_time = time.time()
         Cascade._log(f'Thread {thread_id} - CASCADE - CC compute Time: {current_time - start_time}')
         event_img_object.cc_cat_bool = cat_bool
         event_img_object.cc_pred_bb = pred_cc_bb_full
-        event_img_object.bbs_target_img = bbs_target_img
         event_img_object.cc_inference_time = cc_inference_time
 
         if cat_bool and bbs_target_img.size != 0:
             Cascade._log(f'Thread {thread_id} - CASCADE - Cat Detected!')
-            rec_img = self.cc_mobile_stage.draw_rectangle(
-                img=original_copy_img,
-                box=pred_cc_bb_full,
+            annotations.append(Annotation(
+                text='CC_Track' if event_img_object.cc_tracked else 'CC_Pred',
                 color=(255, 0, 0),
-                text='CC_Pred'
-            )
+                box=pred_cc_bb_full
+            ))
 
             # Do HAAR
             haar_snout_crop, haar_bbs, haar_inference_time, haar_found_bool = (
@@ -101,12 +224,7 @@ class Cascade:
                     cc_target_img=cc_target_image
                 )
             )
-            rec_img = self.cc_mobile_stage.draw_rectangle(
-                img=rec_img,
-                box=haar_bbs,
-                color=(0, 255, 255),
-                text='HAAR_Pred'
-            )
+            annotations.append(Annotation(text='HAAR_Pred', color=(0, 255, 255), box=haar_bbs))
 
             event_img_object.haar_pred_bb = haar_bbs
             event_img_object.haar_inference_time = haar_inference_time
@@ -127,8 +245,7 @@ class Cascade:
                     cc_pred_bb=pred_cc_bb_full,
                     cc_target_img=cc_target_image
                 )
-                rec_img = self.cc_mobile_stage.draw_rectangle(img=rec_img, box=bbs, color=(255, 0, 255),
-                                                              text='BBS_Pred')
+                annotations.append(Annotation(text='BBS_Pred', color=(255, 0, 255), box=bbs))
                 event_img_object.bbs_pred_bb = bbs
                 event_img_object.bbs_inference_time = eye_inference_time
 
@@ -149,8 +266,7 @@ class Cascade:
             event_img_object.face_box = inf_bb
 
             if face_bool:
-                rec_img = self.cc_mobile_stage.draw_rectangle(img=rec_img, box=inf_bb, color=(255, 255, 255),
-                                                              text='INF_Pred')
+                annotations.append(Annotation(text='INF_Pred', color=(255, 255, 255), box=inf_bb))
                 Cascade._log(f'Thread {thread_id} - CASCADE - Face Detected!')
 
                 # Do PC
@@ -162,7 +278,7 @@ class Cascade:
                 Cascade._log(f'Thread {thread_id} - CASCADE - Pred_Val: {pred_val:.2f}')
                 pc_str = f' PC_Pred: {pred_class} @ {pred_val:.2f}'
                 color = (0, 0, 255) if pred_class else (0, 255, 0)
-                rec_img = Cascade._input_text(img=rec_img, text=pc_str, text_pos=(15, 100), color=color)
+                annotations.append(Annotation(text=pc_str, color=color))
 
                 event_img_object.pc_prey_class = pred_class
                 event_img_object.pc_prey_val = pred_val
@@ -171,19 +287,11 @@ class Cascade:
             else:
                 Cascade._log(f'Thread {thread_id} - CASCADE - No Face Found...')
                 ff_str = 'No_Face'
-                rec_img = Cascade._input_text(img=rec_img, text=ff_str, text_pos=(15, 100), color=(255, 255, 0))
+                annotations.append(Annotation(text=ff_str, color=(255, 255, 0)))
 
         else:
             Cascade._log(f'Thread {thread_id} - CASCADE - No Cat Found...')
-            rec_img = Cascade._input_text(
-                img=original_copy_img,
-                text='CC_Pred: NoCat',
-                text_pos=(15, 100),
-                color=(255, 255, 0)
-            )
-
-        # Always save rec_img in event_img object
-        event_img_object.output_img = rec_img
+            annotations.append(Annotation(text='CC_Pred: NoCat', color=(255, 255, 0)))
 
     @staticmethod
     def _cc_haar_overlap(cc_bbs: Any, haar_bbs: Any, thread_id: int) -> float:
@@ -274,9 +382,13 @@ class Cascade:
     @staticmethod
     def _do_cc_mobile_stage(
             cc_mobile_stage: CCMobileNetStage,
-            cc_target_img: MatLike
+            cc_target_img: MatLike,
+            cc_result: Optional[tuple] = None
     ) -> tuple[bool, bool, Any, Any, float]:
-        pred_cc_bb_full, cat_bool, inference_time = cc_mobile_stage.do_cc(target_img=cc_target_img)
+        # The result of the CC may have been already computed in a batch
+        if cc_result is None:
+            cc_result = cc_mobile_stage.do_cc(target_img=cc_target_img)
+        pred_cc_bb_full, cat_bool, inference_time = cc_result
         dk_bool = False if cat_bool is True else True
         if cat_bool:
             bbs_xmin = pred_cc_bb_full[0][0]
@@ -328,18 +440,3 @@ class Cascade:
     def _do_pc_stage(pc_stage: PCStage, pc_target_img: Any) -> tuple[bool, Any, float]:
         pred_class, pred_val, inference_time = pc_stage.pc_do(target_img=pc_target_img)
         return pred_class, pred_val, inference_time
-
-    @staticmethod
-    def _input_text(img: MatLike, text: str, text_pos: tuple[int, int], color: tuple[float, float, float]) -> MatLike:
-        font = cv2.FONT_HERSHEY_SIMPLEX
-        font_scale = 2
-        line_type = 3
-
-        cv2.putText(img,
-                    text,
-                    text_pos,
-                    font,
-                    font_scale,
-                    color,
-                    line_type)
-        return img
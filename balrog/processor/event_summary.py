@@ -0,0 +1,73 @@
+from dataclasses import dataclass
+from typing import Optional, Sequence
+
+from .cascade import EventElement
+
+
+@dataclass(frozen=True, slots=True)
+class FaceFrameSummary:
+    img_name: str
+    pc_prey_val: float
+
+
+@dataclass(frozen=True, slots=True)
+class EventSummary:
+    """
+    Summary of an event (a visit of the cat), handed to the verdict callbacks.
+    """
+    # The event element with the lowest prey value (the one that keeps its frame, to send it with the verdict)
+    min_prey_event: Optional[EventElement]
+    # The frames where a face was found, in order of arrival
+    face_frames: Sequence[FaceFrameSummary]
+    cumuli: float
+
+
+class EventAccumulator:
+    """
+    Running aggregates of an event, updated with each frame with a cat, so a verdict does not need to scan the results
+    of all the frames. When the event ends, the aggregator hands the accumulator over (as an EventSummary) and starts
+    a new one; the accumulator is never updated after that, so the summary does not need to copy anything.
+    """
+    def __init__(self):
+        self.cat_frames = 0
+        self.tracked_frames = 0
+        self.cc_time_saved = 0.0
+        self.face_counter = 0
+        self.cumulus_points = 0
+        self.face_frames: list[FaceFrameSummary] = []
+        self.min_prey_event: Optional[EventElement] = None
+        self.last_cat_event: Optional[EventElement] = None
+
+    def add(self, cascade_obj: EventElement) -> None:
+        """
+        Adds the results of a frame with a cat. Only the event element with the lowest prey value and the last one keep
+        their frame; the frames of the rest are dropped.
+        :param cascade_obj: the event element of the frame
+        """
+        self.cat_frames += 1
+        if cascade_obj.cc_tracked:
+            self.tracked_frames += 1
+            self.cc_time_saved += cascade_obj.cc_time_saved
+        if cascade_obj.face_bool:
+            self.face_counter += 1
+            self.cumulus_points += (50 - int(round(100 * cascade_obj.pc_prey_val)))
+            self.face_frames.append(FaceFrameSummary(cascade_obj.img_name, cascade_obj.pc_prey_val))
+
+        dropped_events = []
+        if cascade_obj.pc_prey_val is not None and (
+                self.min_prey_event is None or cascade_obj.pc_prey_val < self.min_prey_event.pc_prey_val):
+            dropped_events.append(self.min_prey_event)
+            self.min_prey_event = cascade_obj
+        dropped_events.append(self.last_cat_event)
+        self.last_cat_event = cascade_obj
+        for dropped_event in dropped_events:
+            if dropped_event is not None and dropped_event is not self.min_prey_event and \
+                    dropped_event is not self.last_cat_event:
+                dropped_event.cc_target_img = None
+
+    def summary(self, cumuli: float) -> EventSummary:
+        """
+        :param cumuli: the cumuli of the verdict
+        :return: the summary of the event. The accumulator must not be updated anymore
+        """
+        return EventSummary(self.min_prey_event, self.face_frames, cumuli)
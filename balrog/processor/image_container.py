@@ -1,21 +1,39 @@
-import copy
+import time
 from collections import deque
 from dataclasses import dataclass
 from datetime import datetime
 from enum import Enum
-from threading import RLock
-from typing import Self, Optional
+from multiprocessing import Event
+from multiprocessing.shared_memory import SharedMemory
+from threading import RLock, Condition
+from typing import Optional, Callable
 
+import numpy as np
 from cv2.typing import MatLike
 
 from balrog.processor import EventElement
 from balrog.utils import logger
 
+# Maximum time that a blocking wait sleeps before re-checking the stop event
+_WAIT_SLICE_SECONDS = 0.5
+
+
+@dataclass(frozen=True)
+class SharedFrameRef:
+    """
+    Reference to a frame stored in the shared memory slabs, so other processes can access it without copying it.
+    """
+    frames_slab_name: str
+    slab_shape: tuple[int, ...]
+    dtype: str
+    index: int
+
 
 @dataclass
 class _CaptureImageData:
     img_data: Optional[MatLike]= None
     timestamp: Optional[datetime] = None
+    shared_ref: Optional[SharedFrameRef] = None
 
     def __repr__(self) -> str:
         return f"<img_data: {'present' if self.img_data is not None else 'empty'}, tstamp: {self.timestamp}>"
@@ -50,21 +68,15 @@ class ImageContainer:
         self._capture_data: _CaptureImageData = _CaptureImageData() if capture_data is None else capture_data
         self._casc_result_data: _CascadeResultData = _CascadeResultData() if casc_result_data is None else casc_result_data
         self._buffer_state = _BufferState.WAITING_FRAME if buffer_state is None else buffer_state
+        # Monotonic number of the frame (in capture order), and the time when its cascade started
+        self._sequence_number = -1
+        self._cascade_start_time: Optional[float] = None
 
     def __repr__(self) -> str:
         return (f"<Buff State: {self._buffer_state}>, "
+                f"Seq: {self._sequence_number}, "
                 f"Capture data: {repr(self._capture_data)},>")
 
-    def clone(self) -> Self:
-        if self._capture_data.img_data is None:
-            logger.debug(f"IMG DATA IS NONE")
-        return ImageContainer(
-            self.enable_logging,
-            _CaptureImageData(self._capture_data.img_data.copy(), self._capture_data.timestamp),
-            copy.deepcopy(self._casc_result_data),
-            self.buffer_state
-        )
-
     def clean(self) -> None:
         """
         Cleans the data in this image container.
@@ -72,6 +84,8 @@ class ImageContainer:
         self._capture_data: _CaptureImageData = _CaptureImageData()
         self._casc_result_data: _CascadeResultData = _CascadeResultData()
         self._buffer_state = _BufferState.WAITING_FRAME
+        self._sequence_number = -1
+        self._cascade_start_time = None
 
     @property
     def enable_logging(self) -> bool:
@@ -85,6 +99,22 @@ class ImageContainer:
     def buffer_state(self, new_state: _BufferState) -> None:
         self._buffer_state = new_state
 
+    @property
+    def sequence_number(self) -> int:
+        return self._sequence_number
+
+    @sequence_number.setter
+    def sequence_number(self, sequence_number: int) -> None:
+        self._sequence_number = sequence_number
+
+    @property
+    def cascade_start_time(self) -> Optional[float]:
+        return self._cascade_start_time
+
+    @cascade_start_time.setter
+    def cascade_start_time(self, start_time: Optional[float]) -> None:
+        self._cascade_start_time = start_time
+
     @property
     def capture_data(self) -> _CaptureImageData:
         return self._capture_data
@@ -119,8 +149,14 @@ class ImageContainer:
         return self.buffer_state == _BufferState.USED
 
     # Methods used to store the data in this buffer
-    def write_capture_data(self, img_data: MatLike, timestamp: datetime) -> None:
-        self._capture_data = _CaptureImageData(img_data.copy(), timestamp)
+    def write_capture_data(
+            self,
+            img_data: MatLike,
+            timestamp: datetime,
+            shared_ref: Optional[SharedFrameRef] = None
+    ) -> None:
+        # The image data is a (read-only) view of the frame slot in the buffers; we don't copy it
+        self._capture_data = _CaptureImageData(img_data, timestamp, shared_ref)
 
     # Accessors for the data stored in this buffer
     @property
@@ -131,6 +167,10 @@ class ImageContainer:
     def timestamp(self) -> datetime:
         return self.capture_data.timestamp
 
+    @property
+    def shared_ref(self) -> Optional[SharedFrameRef]:
+        return self.capture_data.shared_ref
+
     @property
     def event_element(self) -> EventElement:
         return self.casc_result_data.event_element
@@ -145,15 +185,46 @@ class ImageContainer:
 
 
 class ImageBuffers:
-    def __init__(self, max_capacity: int, enable_logging: bool):
+    def __init__(
+            self,
+            max_capacity: int,
+            enable_logging: bool,
+            reorder_window: int = 0,
+            skip_stragglers: bool = False,
+            straggler_deadline: float = 0,
+            shared_memory: bool = False,
+            first_sequence_number: int = 0
+    ):
         """
         Creates a pre-allocated circular buffer with the given maximum capacity.
         All the indexes returned by methods of this class will return an integer in
         the range [0, max_capacity)
+        The frames are stored in a single contiguous slab of shape (max_capacity, H, W, 3), which is allocated when
+        the first frame arrives (since we don't know the resolution of the camera before that).
+        Each frame gets a sequence number when it is ready for cascade. The cascade of the frames can finish in any
+        order, but they are handed to the aggregation in sequence order. A frame that takes too long in the cascade
+        (a straggler) can be skipped, so it does not block the aggregation of the frames that already finished.
         :param max_capacity: the maximum capacity of the circular buffer
+        :param reorder_window: maximum number of finished frames that can wait behind a straggler before it is
+        skipped; 0 for no limit
+        :param skip_stragglers: if False, the aggregation always waits for the stragglers
+        :param straggler_deadline: maximum time (in seconds) that a frame can spend in the cascade before it is
+        skipped; 0 for no limit
+        :param shared_memory: if True, the slab is allocated in shared memory, so the frames can be processed by
+        other processes
+        :param first_sequence_number: the sequence number of the first frame (e.g., to continue the numbering of the
+        buffers used before a soft restart)
         """
         self._enable_logging = enable_logging
+        self._reorder_window = reorder_window
+        self._skip_stragglers = skip_stragglers
+        self._straggler_deadline = straggler_deadline
         self._circular_buffer: deque[ImageContainer] = deque(maxlen=max_capacity)
+        self._frames_slab: Optional[np.ndarray] = None
+        self._shared_memory = shared_memory
+        self._frames_slab_shm: Optional[SharedMemory] = None
+        # Shared memory of previous slabs; they can't be closed while there are views of them
+        self._retired_shm: list[SharedMemory] = []
         # To emulate the circular behavior, we will keep a reference _of the first and last_
         # index of the window that is in use. When computing any "next available index" we will iterate over the range:
         # [self.base_index, self.base_index + max_capacity). Of course, this range extends to
@@ -162,8 +233,14 @@ class ImageBuffers:
         # max_capacity.
         self._first_empty_frame = -1
         self._first_unprocessed_cascade = -1
-        self._last_non_aggregated_frame = -1
         self._indexes_lock = RLock()
+        # Sequence numbers of the frames; the aggregation is done in order of these numbers
+        self._next_sequence_number = first_sequence_number
+        self._next_sequence_for_aggregation = first_sequence_number
+        self._sequence_indexes: dict[int, int] = dict()
+        self._skipped_sequence_numbers: set[int] = set()
+        # Condition used to wake up the threads waiting for a buffer to change its state
+        self._buffers_changed = Condition(self._indexes_lock)
 
         for i in range(0, max_capacity):
             self._circular_buffer.append(ImageContainer(enable_logging))
@@ -175,8 +252,13 @@ class ImageBuffers:
     def __len__(self):
         return len(self._circular_buffer)
 
+    @property
+    def next_sequence_number(self) -> int:
+        return self._next_sequence_number
+
     def __del__(self):
         self.clear()
+        self._release_shared_memory()
 
     def __getitem__(self, item: int) -> ImageContainer:
         """
@@ -194,6 +276,24 @@ class ImageBuffers:
         elif self._enable_logging:
             logger.debug(message)
 
+    def _allocate_slab(self, shape: tuple[int, ...], dtype: np.dtype) -> tuple[np.ndarray, Optional[SharedMemory]]:
+        if not self._shared_memory:
+            return np.empty(shape, dtype=dtype), None
+        shm = SharedMemory(create=True, size=max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize))
+        return np.ndarray(shape, dtype=dtype, buffer=shm.buf), shm
+
+    def _release_shared_memory(self) -> None:
+        for shm in [self._frames_slab_shm, *self._retired_shm]:
+            if shm is None:
+                continue
+            try:
+                shm.unlink()
+            except FileNotFoundError:
+                # Already unlinked when it was retired
+                pass
+        self._frames_slab_shm = None
+        self._retired_shm.clear()
+
     def clear(self) -> None:
         """
         Cleans the data in _all_ the buffers of this structure
@@ -206,11 +306,37 @@ class ImageBuffers:
 
             self._first_empty_frame = -1
             self._first_unprocessed_cascade = -1
-            self._last_non_aggregated_frame = -1
+            # The frames still in cascade will be discarded, so nothing is pending to be aggregated
+            self._next_sequence_for_aggregation = self._next_sequence_number
+            self._sequence_indexes.clear()
+            self._skipped_sequence_numbers.clear()
 
             self._frames_available_for_frame = len(self._circular_buffer)
             self._frames_available_for_cascade = 0
             self._frames_available_for_aggregation = 0
+            self._buffers_changed.notify_all()
+
+    def _wait_for(self, claim: Callable[[], int], timeout: Optional[float], stop_event: Optional[Event]) -> int:
+        """
+        Blocks until the given claim function returns a non-negative value, the timeout expires, or the stop event
+        is set. The claim function is always invoked while holding the indexes lock.
+        :param claim: function that returns a non-negative value on success, or a negative value otherwise
+        :param timeout: maximum time to wait in seconds; None to wait until the stop event is set
+        :param stop_event: optional event that interrupts the wait
+        :return: the last value returned by the claim function
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._buffers_changed:
+            while True:
+                result = claim()
+                if result >= 0 or (stop_event is not None and stop_event.is_set()):
+                    return result
+                wait_time = _WAIT_SLICE_SECONDS
+                if deadline is not None:
+                    wait_time = min(wait_time, deadline - time.monotonic())
+                    if wait_time <= 0:
+                        return result
+                self._buffers_changed.wait(wait_time)
 
     def frames_ready_for_cascade(self) -> int:
         with self._indexes_lock:
@@ -220,6 +346,23 @@ class ImageBuffers:
         with self._indexes_lock:
             return self._frames_available_for_aggregation
 
+    def wait_for_frames_ready_for_aggregation(
+            self,
+            min_frames: int,
+            timeout: Optional[float] = None,
+            stop_event: Optional[Event] = None
+    ) -> int:
+        """
+        Blocks until there are at least min_frames frames ready for aggregation, and the next frame to aggregate is
+        one of them (frames are aggregated in sequence order).
+        :return: the number of frames ready for aggregation, or -1 if the wait timed out or was stopped
+        """
+        def claim() -> int:
+            if self._frames_available_for_aggregation >= min_frames and self._next_index_for_aggregation() >= 0:
+                return self._frames_available_for_aggregation
+            return -1
+        return self._wait_for(claim, timeout, stop_event)
+
     def get_next_index_for_frame(self) -> int:
         with self._indexes_lock:
             # Border case: at the start, all indexes are -1
@@ -242,10 +385,79 @@ class ImageBuffers:
                 self._frames_available_for_frame -= 1
                 return empty_frame_index
 
+    def frame_slot(self, index: int) -> Optional[np.ndarray]:
+        """
+        Gets the (writable) slot of the frames slab for the given buffer, so the camera can decode the frame directly
+        into it. The caller must have acquired the buffer with get_next_index_for_frame.
+        :param index: the position of the buffer
+        :return: the slot where the frame can be written, or None if the slab was not allocated yet
+        """
+        with self._indexes_lock:
+            return None if self._frames_slab is None else self._frames_slab[index]
+
+    def write_capture_data(self, index: int, img_data: MatLike, timestamp: datetime) -> None:
+        """
+        Stores the given frame in the slot of the given buffer. If the frame was decoded directly into the slot
+        (see frame_slot), no copy is performed. The caller must have acquired the buffer with get_next_index_for_frame.
+        :param index: the position of the buffer
+        :param img_data: the captured frame
+        :param timestamp: the time when the frame was captured
+        """
+        with self._indexes_lock:
+            if (self._frames_slab is None or
+                    self._frames_slab.shape[1:] != img_data.shape or
+                    self._frames_slab.dtype != img_data.dtype):
+                # The buffers still referencing the old slab keep it alive until they are released
+                self._log(f"Allocating frames slab for frames of shape {img_data.shape}")
+                if self._frames_slab_shm is not None:
+                    self._frames_slab_shm.unlink()
+                    self._retired_shm.append(self._frames_slab_shm)
+                slab_shape = (len(self._circular_buffer), *img_data.shape)
+                self._frames_slab, self._frames_slab_shm = self._allocate_slab(slab_shape, img_data.dtype)
+            frame_slot = self._frames_slab[index]
+            shared_ref = None
+            if self._shared_memory:
+                shared_ref = SharedFrameRef(
+                    self._frames_slab_shm.name,
+                    self._frames_slab.shape,
+                    self._frames_slab.dtype.str,
+                    index
+                )
+
+        if img_data.ctypes.data != frame_slot.ctypes.data:
+            np.copyto(frame_slot, img_data)
+        frame_view = frame_slot.view()
+        frame_view.flags.writeable = False
+        self._circular_buffer[index].write_capture_data(frame_view, timestamp, shared_ref)
+
+    def cancel_frame(self, index: int) -> None:
+        """
+        Gives back a buffer acquired with get_next_index_for_frame, when the frame could not be captured.
+        :param index: the position of the buffer
+        """
+        with self._indexes_lock:
+            self._circular_buffer[index].clean()
+            self._frames_available_for_frame += 1
+            # The camera is the only writer, so we rewind the index to keep the buffers in capture order
+            if (index + 1) % len(self._circular_buffer) == self._first_empty_frame:
+                self._first_empty_frame = index
+            self._buffers_changed.notify_all()
+
+    def wait_for_next_index_for_frame(self, timeout: Optional[float] = None, stop_event: Optional[Event] = None) -> int:
+        """
+        Same as get_next_index_for_frame, but blocks until a buffer is released if all of them are in use.
+        :return: the index of the buffer to write the frame, or -1 if the wait timed out or was stopped
+        """
+        return self._wait_for(self.get_next_index_for_frame, timeout, stop_event)
+
     def mark_position_ready_for_cascade(self, index: int) -> None:
         with self._indexes_lock:
             self._circular_buffer[index].buffer_state = _BufferState.WAITING_CASCADE
+            self._circular_buffer[index].sequence_number = self._next_sequence_number
+            self._sequence_indexes[self._next_sequence_number] = index
+            self._next_sequence_number += 1
             self._frames_available_for_cascade += 1
+            self._buffers_changed.notify_all()
 
     def get_next_index_for_cascade(self) -> int:
         with self._indexes_lock:
@@ -263,38 +475,151 @@ class ImageBuffers:
             else:
                 cascade_index = self._first_unprocessed_cascade
                 self._circular_buffer[cascade_index].buffer_state = _BufferState.IN_CASCADE
+                self._circular_buffer[cascade_index].cascade_start_time = time.monotonic()
                 self._first_unprocessed_cascade = ((self._first_unprocessed_cascade + 1) % len(self._circular_buffer))
                 self._frames_available_for_cascade -= 1
                 return cascade_index
 
+    def wait_for_next_index_for_cascade(
+            self,
+            timeout: Optional[float] = None,
+            stop_event: Optional[Event] = None
+    ) -> int:
+        """
+        Same as get_next_index_for_cascade, but blocks until a frame is ready for cascade.
+        :return: the index of the buffer to process, or -1 if the wait timed out or was stopped
+        """
+        return self._wait_for(self.get_next_index_for_cascade, timeout, stop_event)
+
+    def wait_for_next_indexes_for_cascade(
+            self,
+            max_frames: int,
+            max_batch_wait: float,
+            timeout: Optional[float] = None,
+            stop_event: Optional[Event] = None
+    ) -> list[int]:
+        """
+        Claims a batch of frames for cascade. Blocks until a first frame is ready for cascade, and then keeps claiming
+        the frames that become ready, until the batch is full or the maximum batch wait expires.
+        :param max_frames: maximum number of frames in the batch
+        :param max_batch_wait: maximum time (in seconds) to wait for more frames after the first one was claimed
+        :param timeout: maximum time to wait for the first frame; None to wait until the stop event is set
+        :param stop_event: optional event that interrupts the wait
+        :return: the indexes of the buffers to process (in sequence order); empty if the wait timed out or was stopped
+        """
+        first_index = self.wait_for_next_index_for_cascade(timeout, stop_event)
+        if first_index < 0:
+            return []
+
+        indexes = [first_index]
+        batch_deadline = time.monotonic() + max_batch_wait
+        while len(indexes) < max_frames:
+            next_index = self._wait_for(
+                self.get_next_index_for_cascade,
+                max(0.0, batch_deadline - time.monotonic()),
+                stop_event
+            )
+            if next_index < 0:
+                break
+            indexes.append(next_index)
+        return indexes
+
     def write_cascade_data(self, index: int, event_elem: EventElement, total_time: float, overhead: float) -> None:
         with self._indexes_lock:
-            if self._circular_buffer[index].buffer_state == _BufferState.IN_CASCADE:
-                self._circular_buffer[index].casc_result_data = _CascadeResultData(event_elem, total_time, overhead)
-                self._circular_buffer[index].buffer_state = _BufferState.WAITING_AGGREGATION
-                self._frames_available_for_aggregation += 1
+            buffer = self._circular_buffer[index]
+            if buffer.buffer_state != _BufferState.IN_CASCADE:
+                return
+
+            if buffer.sequence_number in self._skipped_sequence_numbers:
+                # The aggregation already moved past this frame; we simply release the buffer
+                self._log(f"Discarding cascade result of skipped frame # {buffer.sequence_number}")
+                self._skipped_sequence_numbers.discard(buffer.sequence_number)
+                self.reset_buffer(index)
+                return
+
+            buffer.casc_result_data = _CascadeResultData(event_elem, total_time, overhead)
+            buffer.buffer_state = _BufferState.WAITING_AGGREGATION
+            self._frames_available_for_aggregation += 1
+            self._buffers_changed.notify_all()
+
+    def abandon_cascade(self, index: int) -> None:
+        """
+        Gives back a buffer acquired with get_next_index_for_cascade, when its cascade failed. The frame is skipped by
+        the aggregation, and only this buffer is released: the rest of the buffers (and their read-only views, which
+        other threads may be using) are left untouched.
+        :param index: the position of the buffer
+        """
+        with self._indexes_lock:
+            buffer = self._circular_buffer[index]
+            if buffer.buffer_state != _BufferState.IN_CASCADE:
+                # The result was already written (or the buffers were cleared); the buffer is not ours anymore
+                return
+            self._log(f"Abandoning cascade of frame # {buffer.sequence_number} (buffer # {index})")
+            if buffer.sequence_number in self._skipped_sequence_numbers:
+                self._skipped_sequence_numbers.discard(buffer.sequence_number)
+            else:
+                # The aggregation moves past the sequence numbers without a buffer
+                self._sequence_indexes.pop(buffer.sequence_number, None)
+            self.reset_buffer(index)
+
+    def _is_straggler(self, buffer: ImageContainer) -> bool:
+        """
+        Checks if the given buffer (the next one in sequence for aggregation, which is not ready yet) needs to be
+        skipped according to the configured policy. Must be invoked while holding the indexes lock.
+        """
+        if not self._skip_stragglers or buffer.buffer_state != _BufferState.IN_CASCADE:
+            return False
+        if 0 < self._reorder_window < self._frames_available_for_aggregation:
+            return True
+        return (self._straggler_deadline > 0 and
+                buffer.cascade_start_time is not None and
+                time.monotonic() - buffer.cascade_start_time > self._straggler_deadline)
+
+    def _next_index_for_aggregation(self) -> int:
+        """
+        Finds the buffer of the next frame (in sequence order) to aggregate, skipping the stragglers.
+        Must be invoked while holding the indexes lock.
+        :return: the index of the buffer, or -1 if the next frame is not ready for aggregation
+        """
+        while self._next_sequence_for_aggregation < self._next_sequence_number:
+            index = self._sequence_indexes.get(self._next_sequence_for_aggregation)
+            if index is None:
+                # Should not happen; we simply move to the next frame
+                self._next_sequence_for_aggregation += 1
+                continue
+
+            buffer = self._circular_buffer[index]
+            if buffer.is_ready_for_aggregation:
+                return index
+            if not self._is_straggler(buffer):
+                return -1
+
+            logger.warning(f"Skipping aggregation of frame # {buffer.sequence_number} (buffer # {index}); "
+                           f"its cascade is taking too long")
+            self._skipped_sequence_numbers.add(buffer.sequence_number)
+            del self._sequence_indexes[self._next_sequence_for_aggregation]
+            self._next_sequence_for_aggregation += 1
+        return -1
 
     def get_next_index_for_aggregation(self) -> int:
         with self._indexes_lock:
-            # Border case: at the start, all indexes are -1
-            if self._last_non_aggregated_frame < 0:
-                if not self._circular_buffer[0].is_ready_for_aggregation:
-                    return -1
-                else:
-                    self._last_non_aggregated_frame += 1
+            if self._frames_available_for_aggregation <= 0:
+                return -1
 
-            buffer_state = self._circular_buffer[self._last_non_aggregated_frame].buffer_state
-            if self._frames_available_for_aggregation <= 0 or buffer_state != _BufferState.WAITING_AGGREGATION:
-                # No frames are available for aggregation; the last non aggregated frame has not gone through cascade
+            aggregate_index = self._next_index_for_aggregation()
+            if aggregate_index < 0:
+                # The next frame in sequence has not gone through cascade yet
                 return -1
-            else:
-                aggregate_index = self._last_non_aggregated_frame
-                self._last_non_aggregated_frame = ((self._last_non_aggregated_frame + 1) % len(self._circular_buffer))
-                self._frames_available_for_aggregation -= 1
-                return aggregate_index
+
+            self._circular_buffer[aggregate_index].buffer_state = _BufferState.IN_AGGREGATION
+            del self._sequence_indexes[self._next_sequence_for_aggregation]
+            self._next_sequence_for_aggregation += 1
+            self._frames_available_for_aggregation -= 1
+            return aggregate_index
 
     def reset_buffer(self, index: int) -> None:
         with self._indexes_lock:
             self._log(f"Releasing buffer # {index}")
             self._circular_buffer[index].clean()
             self._frames_available_for_frame += 1
+            self._buffers_changed.notify_all()
@@ -0,0 +1,225 @@
+import abc
+from enum import Enum
+from pathlib import Path
+from threading import Lock
+from typing import Self, Optional
+
+import numpy as np
+
+from balrog.utils import logger
+
+
+class InferenceEngine(Enum):
+    """
+    Engines that can run the models of the cascade stages.
+    """
+    TENSORFLOW = "tensorflow"
+    TFLITE = "tflite"
+    ONNX = "onnx"
+
+    @classmethod
+    def from_config(cls, value: str) -> Self:
+        try:
+            return cls(value)
+        except ValueError:
+            raise Exception(f"Unknown inference engine '{value}'. Please check the configuration file")
+
+
+class InferenceBackend(abc.ABC):
+    """
+    Runs the model of a cascade stage. The stages only prepare the input batch and interpret the outputs, so the
+    model can be executed by any engine: full tensorflow (with the original models), or the lightweight TFLite and
+    ONNX runtimes (with the models exported by the balrog.tools.convert_models tool).
+    """
+    @abc.abstractmethod
+    def run(self, batch: np.ndarray) -> list[np.ndarray]:
+        """
+        Runs the model on a batch of inputs.
+        :param batch: the batch of (preprocessed) inputs of the model
+        :return: the outputs of the model, in the order of the outputs of the original tensorflow model
+        """
+        pass
+
+    @classmethod
+    def get_instance(
+            cls,
+            engine: InferenceEngine,
+            stage_name: str,
+            tf_model_file: Path,
+            models_folder: str,
+            tf_input_name: Optional[str] = None,
+            tf_output_names: Optional[list[str]] = None,
+            custom_objects: Optional[dict] = None,
+            jit_compile: bool = False,
+            variant: str = ""
+    ) -> Self:
+        """
+        Creates the backend of a cascade stage.
+        :param engine: the engine that runs the model
+        :param stage_name: the name of the stage; the converted models are stored as '<stage_name>.<engine>'
+        :param tf_model_file: the original tensorflow model (a frozen graph, or a keras model)
+        :param models_folder: the folder with the converted models
+        :param tf_input_name: the name of the input tensor (only for frozen graphs)
+        :param tf_output_names: the names of the output tensors (only for frozen graphs)
+        :param custom_objects: custom objects needed to load the model (only for keras models)
+        :param jit_compile: if True, the model is compiled with XLA (only for keras models)
+        :param variant: the quantized variant of the model (only for the tflite engine); empty for the float model
+        """
+        if variant and engine != InferenceEngine.TFLITE:
+            raise Exception(f"The quantized variant '{variant}' of the '{stage_name}' model is only supported by the "
+                            f"tflite engine. Please check the configuration file")
+        if engine == InferenceEngine.TENSORFLOW:
+            if tf_model_file.suffix == ".pb":
+                return FrozenGraphBackend(tf_model_file, tf_input_name, tf_output_names)
+            return KerasBackend(tf_model_file, custom_objects, jit_compile)
+        elif engine == InferenceEngine.TFLITE:
+            return TFLiteBackend(converted_model_file(models_folder, stage_name, engine, variant))
+        elif engine == InferenceEngine.ONNX:
+            return OnnxBackend(converted_model_file(models_folder, stage_name, engine))
+        else:
+            raise Exception(f"Unsupported inference engine '{engine}'")
+
+
+def converted_model_file(models_folder: str, stage_name: str, engine: InferenceEngine, variant: str = "") -> Path:
+    """
+    :return: the path of the model of a stage, converted for the given engine (and quantized with the given variant)
+    """
+    extension = {InferenceEngine.TFLITE: "tflite", InferenceEngine.ONNX: "onnx"}[engine]
+    if variant:
+        return Path(models_folder) / f"{stage_name}.{variant}.{extension}"
+    return Path(models_folder) / f"{stage_name}.{extension}"
+
+
+def _check_model_file(model_file: Path) -> None:
+    if not model_file.is_file():
+        raise Exception(f"Model file '{model_file}' does not exist. "
+                        f"Please run the balrog.tools.convert_models tool, or check the configuration file")
+
+
+class KerasBackend(InferenceBackend):
+    """
+    Runs a keras (.h5) model with tensorflow. The model is called through a tf.function traced once with a fixed input
+    signature (and optionally compiled with XLA); unlike model.predict, it does not build a data adapter and the
+    callbacks on every call, so a single crop only costs the execution of the graph.
+    """
+    def __init__(self, model_file: Path, custom_objects: Optional[dict] = None, jit_compile: bool = False):
+        import tensorflow as tf
+
+        _check_model_file(model_file)
+        self.model = tf.keras.models.load_model(
+            str(model_file).strip(),
+            custom_objects=custom_objects,
+            compile=False
+        )
+        input_signature = [tf.TensorSpec(shape=(None, *self.model.input_shape[1:]), dtype=tf.float32)]
+        self._predict = tf.function(
+            lambda batch: self.model(batch, training=False),
+            input_signature=input_signature,
+            jit_compile=jit_compile
+        )
+        # We trace the function now, so the first frame does not pay for it
+        self._predict.get_concrete_function()
+        logger.debug(f"Keras model '{model_file.name}' loaded (XLA: {jit_compile})")
+
+    def run(self, batch: np.ndarray) -> list[np.ndarray]:
+        return [self._predict(batch.astype(np.float32, copy=False)).numpy()]
+
+
+class FrozenGraphBackend(InferenceBackend):
+    """
+    Runs a TF1 frozen graph (.pb) with a tensorflow session.
+    """
+    def __init__(self, model_file: Path, input_name: str, output_names: list[str]):
+        import tensorflow as tf
+
+        _check_model_file(model_file)
+        graph = tf.Graph()
+        with graph.as_default():
+            graph_def = tf.compat.v1.GraphDef()
+            with tf.compat.v2.io.gfile.GFile(str(model_file).strip(), 'rb') as graph_file:
+                graph_def.ParseFromString(graph_file.read())
+                tf.import_graph_def(graph_def, name='')
+            self.sess = tf.compat.v1.Session(graph=graph)
+        self.input_tensor = graph.get_tensor_by_name(input_name)
+        self.output_tensors = [graph.get_tensor_by_name(output_name) for output_name in output_names]
+        logger.debug(f"Frozen graph '{model_file.name}' loaded")
+
+    def run(self, batch: np.ndarray) -> list[np.ndarray]:
+        return self.sess.run(self.output_tensors, feed_dict={self.input_tensor: batch})
+
+
+class TFLiteBackend(InferenceBackend):
+    """
+    Runs a TFLite model. It uses the tflite_runtime package if it is installed, and tensorflow otherwise. Float inputs
+    of fully quantized (INT8) models are quantized, and their outputs are dequantized, so the stages always work with
+    the same values as with the float model.
+    """
+    def __init__(self, model_file: Path):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            import tensorflow as tf
+            Interpreter = tf.lite.Interpreter
+
+        _check_model_file(model_file)
+        self.interpreter = Interpreter(model_path=str(model_file))
+        self.interpreter.allocate_tensors()
+        self.input_detail = self.interpreter.get_input_details()[0]
+        self.output_details = self.interpreter.get_output_details()
+        # The interpreter is not thread-safe, and its tensors are reused between calls
+        self.lock = Lock()
+        logger.debug(f"TFLite model '{model_file.name}' loaded")
+
+    @staticmethod
+    def _quantize(batch: np.ndarray, detail: dict) -> np.ndarray:
+        dtype = detail['dtype']
+        scale, zero_point = detail['quantization']
+        if scale == 0 or not np.issubdtype(dtype, np.integer) or np.issubdtype(batch.dtype, np.integer):
+            return batch.astype(dtype, copy=False)
+        dtype_info = np.iinfo(dtype)
+        return np.clip(np.round(batch / scale + zero_point), dtype_info.min, dtype_info.max).astype(dtype)
+
+    @staticmethod
+    def _dequantize(output: np.ndarray, detail: dict) -> np.ndarray:
+        scale, zero_point = detail['quantization']
+        if scale == 0 or not np.issubdtype(output.dtype, np.integer):
+            return output
+        return (output.astype(np.float32) - zero_point) * scale
+
+    def run(self, batch: np.ndarray) -> list[np.ndarray]:
+        batch = TFLiteBackend._quantize(batch, self.input_detail)
+        with self.lock:
+            if tuple(self.input_detail['shape']) != batch.shape:
+                self.interpreter.resize_tensor_input(self.input_detail['index'], batch.shape)
+                self.interpreter.allocate_tensors()
+                self.input_detail = self.interpreter.get_input_details()[0]
+                self.output_details = self.interpreter.get_output_details()
+            self.interpreter.set_tensor(self.input_detail['index'], batch)
+            self.interpreter.invoke()
+            return [
+                TFLiteBackend._dequantize(self.interpreter.get_tensor(output['index']), output)
+                for output in self.output_details
+            ]
+
+
+class OnnxBackend(InferenceBackend):
+    """
+    Runs an ONNX model with the ONNX runtime (on CPU).
+    """
+    _ONNX_TYPES = {
+        'tensor(float)': np.float32,
+        'tensor(uint8)': np.uint8,
+    }
+
+    def __init__(self, model_file: Path):
+        import onnxruntime
+
+        _check_model_file(model_file)
+        self.session = onnxruntime.InferenceSession(str(model_file), providers=['CPUExecutionProvider'])
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        self.input_dtype = OnnxBackend._ONNX_TYPES.get(model_input.type, np.float32)
+        logger.debug(f"ONNX model '{model_file.name}' loaded")
+
+    def run(self, batch: np.ndarray) -> list[np.ndarray]:
+        return self.session.run(None, {self.input_name: batch.astype(self.input_dtype, copy=False)})
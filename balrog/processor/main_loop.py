@@ -1,22 +1,26 @@
-import copy
 import os
-import sys
 import time
 import traceback
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait
+from dataclasses import dataclass
 from datetime import datetime
-from multiprocessing import Event
-from typing import Optional
+from multiprocessing import Event, get_context
+from typing import Callable, Optional, Self
 
 import cv2
+import numpy as np
 import pytz
 from cv2.typing import MatLike
 
-from balrog.config import general_config, model_config, logging_config
+from balrog.config import general_config, model_config, logging_config, motion_config, flap_config
 from balrog.interface import MessageSender
 from balrog.processor import Cascade, EventElement
 from balrog.processor.image_container import ImageBuffers, ImageContainer
-from balrog.utils import logger, get_resource_path
+from balrog.utils import logger, ConfigWatcher
+from .event_summary import EventAccumulator
+from .motion_gate import MotionGate
+from .process_pool import init_cascade_worker, cascade_worker_ready, run_shared_cascade
+from .warmup import warm_up_cascade, log_warmup
 from .detection_callbacks import (
     send_cat_detected_message,
     send_dont_know_message,
@@ -24,6 +28,58 @@ from .detection_callbacks import (
     send_no_prey_message
 )
 
+# Maximum time the loops wait for new work, before checking their events again
+_IDLE_WAIT_SECONDS = 1.0
+
+
+@dataclass
+class CascadeModels:
+    """
+    The loaded models of the cascade: a Cascade (with the "thread" executor), or the pool of worker processes that hold
+    their own Cascade (with the "process" executor). They can outlive the FrameProcessor, so a soft restart does not
+    load them again.
+    """
+    base_cascade: Optional[Cascade] = None
+    cascade_pool: Optional[ProcessPoolExecutor] = None
+    warmed_up: bool = False
+
+    @classmethod
+    def load(cls) -> Self:
+        if general_config.frame_processor_executor == "process":
+            # We use "spawn" so the workers don't inherit the threads (and the tensorflow state) of this process
+            mp_context = get_context("spawn")
+            return cls(cascade_pool=ProcessPoolExecutor(
+                max_workers=general_config.max_frame_processor_threads,
+                mp_context=mp_context,
+                initializer=init_cascade_worker,
+                initargs=(mp_context.Barrier(general_config.max_frame_processor_threads),)
+            ))
+        return cls(base_cascade=Cascade())
+
+    def warm_up(self) -> None:
+        """
+        Warms up every stage of the models (see warm_up_cascade), and waits until it is done, so nothing that depends
+        on the models is ready before.
+        """
+        start_time = time.monotonic()
+        if self.cascade_pool is not None:
+            # Submitting one task per worker starts all the worker processes; each one warms up its own models in its
+            # initializer, before running any task. The tasks wait for each other, so each worker runs one of them
+            workers = wait([
+                self.cascade_pool.submit(cascade_worker_ready)
+                for _ in range(general_config.max_frame_processor_threads)
+            ]).done
+            for worker_pid, warmup in sorted(future.result() for future in workers):
+                log_warmup(warmup, f"Cascade of worker process {worker_pid}")
+        else:
+            log_warmup(warm_up_cascade(self.base_cascade), "Cascade")
+        logger.info(f"Models warmed up in {time.monotonic() - start_time:.2f}s")
+        self.warmed_up = True
+
+    def close(self) -> None:
+        if self.cascade_pool is not None:
+            self.cascade_pool.shutdown(wait=False, cancel_futures=True)
+
 
 class FrameResultAggregator:
     """
@@ -35,13 +91,26 @@ class FrameResultAggregator:
       * Aggregates the results, computing cumulative with previous frames' results
       * Invokes the telegram callbacks with the verdicts.
     """
-    def __init__(self, frame_buffers: ImageBuffers, stop_event: Event):
+    def __init__(
+            self,
+            frame_buffers: ImageBuffers,
+            stop_event: Event,
+            process_restart_event: Optional[Event] = None,
+            on_first_frame: Optional[Callable[[], None]] = None
+    ):
+        """
+        :param frame_buffers: the buffers with the processed frames
+        :param stop_event: event that stops the aggregation (e.g., for a soft restart)
+        :param process_restart_event: event that the bot sets (with stop_event) to ask for a restart of the process
+        :param on_first_frame: function called when the first processed frame is aggregated (to measure the startup)
+        """
         self.clean_queue_event: Event = Event()
         self.stop_event = stop_event
         self.bot = MessageSender.get_message_sender_instance(
             is_debug=os.getenv("BALROG_USE_NULL_TELEGRAM") is not None,
             clean_queue_event=self.clean_queue_event,
-            stop_event=stop_event
+            stop_event=stop_event,
+            process_restart_event=process_restart_event
         )
         self.verdict_sender_pool = ThreadPoolExecutor(max_workers=general_config.max_message_sender_threads)
         # Aggregation fields
@@ -53,18 +122,24 @@ class FrameResultAggregator:
         self.NO_PREY_FLAG = None
         self.patience_counter = 0
         self.event_reset_counter = 0
-        self.cumulus_points = 0
         self.cat_counter = 0
-        self.face_counter = 0
-        self.event_objects: list[EventElement] = []
+        # Running aggregates of the current event (cumulus, face frames, frame with the lowest prey value)
+        self.event = EventAccumulator()
         self.frame_buffers = frame_buffers
+        self._on_first_frame = on_first_frame
+        # Double buffer for the live image, so we don't allocate a new image for every frame
+        self._live_imgs: list[Optional[np.ndarray]] = [None, None]
+        self._live_img_index = 0
+        # Reloads the config file when it changes, and reports it in the chat
+        self.config_watcher = ConfigWatcher(general_config.config_watch_interval_seconds, self.bot.send_text)
 
     def __enter__(self):
-        # We don't do anything here
-        pass
+        self.config_watcher.start()
 
     def __exit__(self, exception_type, exception_value, tb):
+        self.config_watcher.stop()
         self.verdict_sender_pool.shutdown(wait=False, cancel_futures=True)
+        self.bot.close()
         if exception_type is not None:
             logger.error(f"Something wrong happened in the frame result aggregator thread")
             logger.error(f"Exception type: {repr(exception_type)}")
@@ -72,13 +147,17 @@ class FrameResultAggregator:
             logger.error(f"Exception value: {exception_value}")
         if tb is not None:
             logger.error(f"Traceback: {''.join(traceback.format_tb(tb))}")
-            sys.exit(1)
-        # We use a "successful" exit code to restart the script
-        # This is interpreted as a call to restart the script
-        sys.exit(0)
+        # The supervisor decides if we restart (in the same process or not)
+
+    def _log_tracking_stats(self) -> None:
+        if self.event.tracked_frames == 0:
+            return
+        logger.info(f"CC of the event: {self.event.cat_frames - self.event.tracked_frames} cat frames detected, "
+                    f"{self.event.tracked_frames} cat frames tracked, {self.event.cc_time_saved:.3f}s of CC time saved")
 
     def reset_aggregation_fields(self):
         # TODO - Do not rely on this "static" state that needs to be reset every time we reach a verdict
+        self._log_tracking_stats()
         self.EVENT_FLAG = False
         self.PATIENCE_FLAG = False
         self.CAT_DETECTED_FLAG = False
@@ -87,36 +166,46 @@ class FrameResultAggregator:
         self.NO_PREY_FLAG = None
         self.patience_counter = 0
         self.event_reset_counter = 0
-        self.cumulus_points = 0
         self.cat_counter = 0
-        self.face_counter = 0
-        self.event_objects.clear()
+        # A verdict may still be sending the summary of the previous event, so we start a new accumulator
+        self.event = EventAccumulator()
         self.clean_queue_event.clear()
         # The next operation is expensive, maybe we don't need to perform it every single time
         #self.frame_buffers.clear()
 
+    def _update_live_img(self, img_data: MatLike) -> None:
+        # We write the new live image in the buffer that is not being shown to the bot
+        back_index = 1 - self._live_img_index
+        back_img = self._live_imgs[back_index]
+        if back_img is None or back_img.shape != img_data.shape or back_img.dtype != img_data.dtype:
+            back_img = self._live_imgs[back_index] = np.empty_like(img_data)
+        np.copyto(back_img, img_data)
+        self._live_img_index = back_index
+        self.bot.node_live_img = back_img
+
     def aggregator_thread(self):
         while not self.stop_event.is_set():
             try:
-                # We check if there are enough frames to work with (according to the config)
-                frames_rdy_for_aggregation = self.frame_buffers.frames_ready_for_aggregation()
+                # We wait until there are enough frames to work with (according to the config)
+                frames_rdy_for_aggregation = self.frame_buffers.wait_for_frames_ready_for_aggregation(
+                    general_config.min_aggregation_frames_threshold,
+                    timeout=_IDLE_WAIT_SECONDS,
+                    stop_event=self.stop_event
+                )
                 logger.debug(f"Frames ready for aggregation: {frames_rdy_for_aggregation}")
 
                 if frames_rdy_for_aggregation >= general_config.min_aggregation_frames_threshold:
                     # Here we go :)
                     self.aggregate_available_frames(frames_rdy_for_aggregation)
-                else:
-                    # We simply wait for new frames to be ready (The camera thread should propulate the deque)
-                    time.sleep(0.25)
 
                 # Check if user force opens the door
                 if self.clean_queue_event.is_set():
                     # We do super simple stuff here. The actual unlock of the door is handled in NodeBot class
                     self.reset_aggregation_fields()
-            except Exception as e:
-                logger.exception("Exception in aggregation thread: ", e)
-                logger.info("Cleaning queue since exception")
-                self.frame_buffers.clear()
+            except Exception:
+                # The buffer of the frame is always released (see aggregate_available_frames); the rest of the buffers
+                # may still be in use by the frame processor, so we don't clear them
+                logger.exception("Exception in aggregation thread")
 
     def aggregate_available_frames(self, frames_rdy_for_aggregation: int):
         # We get the last buffer, and extract its data
@@ -124,65 +213,71 @@ class FrameResultAggregator:
         if next_frame_index < 0:
             return
 
-        next_frame = self.frame_buffers[next_frame_index].clone()
-        # We release the lock asap
-        self.frame_buffers.reset_buffer(next_frame_index)
-
-        cascade_obj: EventElement = next_frame.event_element
-        overhead: float = next_frame.overhead
-        image_data: MatLike = next_frame.img_data
-
+        # The buffer can't be written by the camera until we release it, so we don't need to copy it
+        try:
+            next_frame = self.frame_buffers[next_frame_index]
+            cascade_obj: EventElement = next_frame.event_element
+            overhead: float = next_frame.overhead
+            self._update_live_img(next_frame.img_data)
+            # The images of the event element are views of the buffer; we drop them before releasing the buffer. Only
+            # the frames with a cat keep a copy, to render their output image if a message needs it
+            cascade_obj.cc_target_img = next_frame.img_data.copy() if cascade_obj.cc_cat_bool else None
+            frame_timestamp = next_frame.timestamp
+        finally:
+            # We release the lock asap (even if the frame could not be read)
+            self.frame_buffers.reset_buffer(next_frame_index)
+
+        if self._on_first_frame is not None:
+            self._on_first_frame()
+            self._on_first_frame = None
 
         # Add this such that the bot has some info
         self.bot.node_queue_info = frames_rdy_for_aggregation
-        self.bot.node_live_img = image_data
         self.bot.node_over_head_info = overhead
 
         if cascade_obj.cc_cat_bool:
             # We are inside an event => add event_obj to list
             logger.info('**** CAT FOUND! ****')
             self.EVENT_FLAG = True
-            self.event_objects.append(cascade_obj)
+            self.event.add(cascade_obj)
             # Send a message on Telegram to ask what to do
             self.cat_counter += 1
             if self.cat_counter >= model_config.cat_counter_threshold and not self.CAT_DETECTED_FLAG:
                 self.CAT_DETECTED_FLAG = True
-                node_live_img_cpy = self.bot.node_live_img
+                node_live_img_cpy = self.bot.node_live_img.copy()
                 self.verdict_sender_pool.submit(send_cat_detected_message, self.bot, node_live_img_cpy, 0)
 
             # Last cat pic for bot
-            self.bot.node_last_casc_img = cascade_obj.output_img
+            self.bot.node_last_casc_event = cascade_obj
 
             # self.fps_offset = 0
             # If face found add the cumulus points
             if cascade_obj.face_bool:
                 logger.info('**** FACE FOUND! ****')
-                self.face_counter += 1
-                self.cumulus_points += (50 - int(round(100 * cascade_obj.pc_prey_val)))
                 self.FACE_FOUND_FLAG = True
 
-            logger.debug(f'CUMULUS: {self.cumulus_points}')
+            logger.debug(f'CUMULUS: {self.event.cumulus_points}')
 
             # Check the cumuli points and set flags if necessary
-            if self.face_counter > 0 and self.PATIENCE_FLAG:
-                if self.cumulus_points / self.face_counter > model_config.cumulus_no_prey_threshold:
+            if self.event.face_counter > 0 and self.PATIENCE_FLAG:
+                cumuli = self.event.cumulus_points / self.event.face_counter
+                if cumuli > model_config.cumulus_no_prey_threshold:
                     self.NO_PREY_FLAG = True
                     logger.info('**** NO PREY DETECTED... YOU CLEAN... ****')
-                    #events_cpy = copy.deepcopy(self.event_objects)
-                    cumuli_cpy = self.cumulus_points / self.face_counter
                     self.verdict_sender_pool.submit(
                         send_no_prey_message,
-                        self.bot, copy.deepcopy(self.event_objects), cumuli_cpy
+                        self.bot, self.event.summary(cumuli)
                     )
                     self.reset_aggregation_fields()
-                elif self.cumulus_points / self.face_counter < model_config.cumulus_prey_threshold:
+                elif cumuli < model_config.cumulus_prey_threshold:
                     self.PREY_FLAG = True
                     logger.info('**** IT IS A PREY!!!!! ****')
-                    events_cpy = copy.deepcopy(self.event_objects)
-                    cumuli_cpy = self.cumulus_points / self.face_counter
+                    if flap_config.auto_lock_on_prey:
+                        # The lock goes first: it does not wait for the message with the pictures
+                        self.bot.auto_lock_on_prey(frame_timestamp)
                     self.verdict_sender_pool.submit(
                         send_prey_message,
-                        self.bot, events_cpy, cumuli_cpy
+                        self.bot, self.event.summary(cumuli)
                     )
                     self.reset_aggregation_fields()
                 else:
@@ -201,13 +296,11 @@ class FrameResultAggregator:
                 # If was True => event now over => clear queue
                 if self.EVENT_FLAG:
                     # TODO QUICK FIX
-                    if self.face_counter == 0:
-                        self.face_counter = 1
-                    #events_cpy = copy.deepcopy(self.event_objects)
-                    cumuli_cpy = self.cumulus_points / self.face_counter
+                    face_counter = max(self.event.face_counter, 1)
+                    cumuli = self.event.cumulus_points / face_counter
                     self.verdict_sender_pool.submit(
                         send_dont_know_message,
-                        self.bot, copy.deepcopy(self.event_objects), cumuli_cpy
+                        self.bot, self.event.summary(cumuli)
                     )
                 logger.debug(f'---- CLEARED QUEUE BECAUSE EVENT ENDED: {self.event_reset_counter} > {model_config.event_reset_threshold} ----')
                 self.reset_aggregation_fields()
@@ -216,7 +309,7 @@ class FrameResultAggregator:
             self.patience_counter += 1
         if self.patience_counter > 2:
             self.PATIENCE_FLAG = True
-        if self.face_counter > 1:
+        if self.event.face_counter > 1:
             self.PATIENCE_FLAG = True
 
 
@@ -230,22 +323,45 @@ class FrameProcessor:
       * Invokes the cascade on the frame to compute the results
       * Writes the results to the circular buffer
       * Marks the buffer as ready to be aggregated
+    With the "process" executor, the cascade runs in worker processes (each one with its own models), which read the
+    frames from the shared memory slab of the buffers. The threads of this class then only dispatch the frames.
     """
-    def __init__(self, frame_buffers: ImageBuffers, stop_event: Event):
+    def __init__(self, frame_buffers: ImageBuffers, stop_event: Event, models: Optional[CascadeModels] = None):
+        """
+        :param frame_buffers: the buffers with the captured frames
+        :param stop_event: event that stops the processing threads
+        :param models: the already loaded models (e.g., kept by the supervisor across soft restarts); if None, the
+        models are loaded here, and released when the processor exits
+        """
         self.stop_event = stop_event
-        self.base_cascade = Cascade()
         self.frame_buffers = frame_buffers
-        self.frame_processor_pool = ThreadPoolExecutor(max_workers=general_config.max_message_sender_threads)
+        self.use_process_pool = general_config.frame_processor_executor == "process"
+        self._owns_models = models is None
+        self.models = CascadeModels.load() if models is None else models
+        self.base_cascade: Optional[Cascade] = self.models.base_cascade
+        self.cascade_pool: Optional[ProcessPoolExecutor] = self.models.cascade_pool
+        self.motion_gate: Optional[MotionGate] = None
+        if motion_config.enable_motion_gate:
+            self.motion_gate = MotionGate(
+                sensitivity=motion_config.motion_sensitivity,
+                pixel_threshold=motion_config.motion_pixel_threshold,
+                hold_frames=motion_config.motion_hold_frames,
+                mask_file=motion_config.motion_mask_file
+            )
+        self.frame_processor_pool = ThreadPoolExecutor(max_workers=general_config.max_frame_processor_threads)
 
     def __enter__(self):
-        # Do this to force run all networks s.t. the network inference time stabilizes
-        self.single_debug()
+        if not self.models.warmed_up:
+            # Do this to force run all networks s.t. the network inference time stabilizes
+            self.models.warm_up()
         # We need to submit the process tasks here
         for i in range(0, general_config.max_frame_processor_threads):
             self.frame_processor_pool.submit(self.process_frame, i)
 
     def __exit__(self, exception_type, exception_value, tb):
         self.frame_processor_pool.shutdown(wait=False, cancel_futures=True)
+        if self._owns_models:
+            self.models.close()
         if exception_type is not None:
             logger.error(f"Something wrong happened in the frame processor thread")
             logger.error(f"Exception type: {exception_type}")
@@ -253,77 +369,181 @@ class FrameProcessor:
             logger.error(f"Exception value: {exception_value}")
         if tb is not None:
             logger.error(f"Traceback: {''.join(traceback.format_tb(tb))}")
-        return True
+        # The exception propagates, so the supervisor decides if we restart
 
-    def feed_to_cascade(self, target_img: MatLike, img_name: str, thread_id: int = -1, frame_index: int = -1) -> tuple[float, EventElement]:
-        target_event_obj = EventElement(img_name=img_name, cc_target_img=target_img)
-
-        start_time = time.time()
-        self.base_cascade.do_single_cascade(
-            event_img_object=target_event_obj,
-            thread_id=thread_id,
-            frame_index=frame_index
-        )
+    @staticmethod
+    def _set_total_inference_time(target_event_obj: EventElement) -> None:
         target_event_obj.total_inference_time = sum(filter(None, [
             target_event_obj.cc_inference_time,
-            target_event_obj.cr_inference_time,
             target_event_obj.bbs_inference_time,
             target_event_obj.haar_inference_time,
             target_event_obj.ff_bbs_inference_time,
-            target_event_obj.ff_haar_inference_time,
             target_event_obj.pc_inference_time]))
+
+    def feed_to_cascade(
+            self,
+            target_imgs: list[MatLike],
+            img_names: list[str],
+            thread_id: int = -1,
+            frame_indexes: Optional[list[int]] = None,
+            sequence_numbers: Optional[list[int]] = None
+    ) -> tuple[float, list[EventElement]]:
+        if sequence_numbers is None:
+            sequence_numbers = [-1] * len(target_imgs)
+        target_event_objs = [
+            EventElement(img_name=img_name, cc_target_img=target_img, sequence_number=sequence_number)
+            for target_img, img_name, sequence_number in zip(target_imgs, img_names, sequence_numbers)
+        ]
+
+        start_time = time.time()
+        self.base_cascade.do_cascade_batch(
+            event_img_objects=target_event_objs,
+            thread_id=thread_id,
+            frame_indexes=frame_indexes if frame_indexes is not None else [-1] * len(target_event_objs)
+        )
+        for target_event_obj in target_event_objs:
+            FrameProcessor._set_total_inference_time(target_event_obj)
         total_runtime = time.time() - start_time
-        logger.debug(f'Thread {thread_id} - Total Runtime: {total_runtime}')
+        logger.debug(f'Thread {thread_id} - Total Runtime ({len(target_event_objs)} frames): {total_runtime}')
+
+        return total_runtime, target_event_objs
+
+    def feed_to_cascade_worker(
+            self,
+            frames: list[ImageContainer],
+            img_names: list[str],
+            thread_id: int = -1
+    ) -> tuple[float, list[EventElement]]:
+        """
+        Runs the cascade on a worker process, which reads the frames from the shared memory slab.
+        :param frames: the buffers with the frames to process
+        :param img_names: the names of the images (i.e., their timestamps)
+        :param thread_id: the ID of the thread dispatching the frames
+        :return: the total runtime, and the event elements with the results of the cascade
+        """
+        shared_refs = [frame.shared_ref for frame in frames]
+        if None in shared_refs:
+            raise Exception("The frame buffers are not allocated in shared memory; they can't be processed by workers")
 
-        return total_runtime, target_event_obj
+        start_time = time.time()
+        sequence_numbers = [frame.sequence_number for frame in frames]
+        target_event_objs: list[EventElement] = self.cascade_pool.submit(
+            run_shared_cascade, shared_refs, img_names, sequence_numbers, thread_id
+        ).result()
+        for frame, target_event_obj in zip(frames, target_event_objs):
+            # The worker only returns the compact results, we restore the views of the (read-only) frame
+            target_event_obj.cc_target_img = frame.img_data
+            FrameProcessor._set_total_inference_time(target_event_obj)
+        total_runtime = time.time() - start_time
+        logger.debug(f'Thread {thread_id} - Total Runtime ({len(target_event_objs)} frames): {total_runtime}')
+
+        return total_runtime, target_event_objs
+
+    def gate_frame(self, target_img: MatLike, img_name: str, thread_id: int = -1) -> Optional[EventElement]:
+        """
+        Checks the given frame against the motion gate (if enabled).
+        :return: a synthetic "no cat" event element if the frame is static (so it does not need to go through the
+        cascade), or None if the frame has to be processed by the cascade
+        """
+        if self.motion_gate is None or self.motion_gate.has_motion(target_img):
+            return None
+
+        logger.debug(f'Thread {thread_id} - No motion detected, skipping cascade. '
+                     f'Gated frames: {self.motion_gate.gated_frames}, passed frames: {self.motion_gate.passed_frames}')
+        gated_event_obj = EventElement(
+            img_name=img_name,
+            cc_target_img=target_img,
+            cc_cat_bool=False,
+            cc_inference_time=0.0
+        )
+        gated_event_obj.total_inference_time = 0.0
+        return gated_event_obj
+
+    def write_cascade_result(
+            self,
+            thread_id: int,
+            frame_index: int,
+            frame: ImageContainer,
+            cascade_obj: EventElement,
+            total_runtime: float
+    ) -> None:
+        overhead = datetime.now(pytz.timezone(general_config.local_timezone)) - frame.timestamp
+        logger.debug(f'Thread {thread_id} - Overhead: {overhead.total_seconds()}')
+
+        logger.debug(f"Thread {thread_id} - Writing cascade result of buffer # = {frame_index}")
+        self.frame_buffers.write_cascade_data(frame_index, cascade_obj, total_runtime, overhead.total_seconds())
 
     def process_frame(self, thread_id: int) -> None:
-        next_frame_copy: Optional[ImageContainer] = None
+        next_frame_indexes: list[int] = []
+        next_frames: list[ImageContainer] = []
         while not self.stop_event.is_set():
             try:
-                # Feed the latest image in the Queue through the cascade
-                next_frame_index = self.frame_buffers.get_next_index_for_cascade()
+                # Feed the latest images in the Queue through the cascade; during a burst, we take several of them
+                next_frame_indexes = self.frame_buffers.wait_for_next_indexes_for_cascade(
+                    max_frames=general_config.cascade_batch_size,
+                    max_batch_wait=general_config.cascade_batch_max_wait_seconds,
+                    timeout=_IDLE_WAIT_SECONDS,
+                    stop_event=self.stop_event
+                )
 
-                if next_frame_index < 0:
-                    # We couldn't acquire the lock of a frame to compute the cascade; pass
-                    time.sleep(0.25)
+                if len(next_frame_indexes) == 0:
+                    # No frame was ready for cascade (or we are stopping); we check the stop event and wait again
                     continue
 
-                logger.debug(f'Thread {thread_id} - Index for cascade: {next_frame_index}')
-                next_frame_copy = self.frame_buffers[next_frame_index].clone()
-
-                total_runtime, cascade_obj = self.feed_to_cascade(
-                    target_img=next_frame_copy.img_data,
-                    img_name=next_frame_copy.timestamp.strftime(general_config.timestamp_format),
-                    thread_id=thread_id,
-                    frame_index=next_frame_index
-                )
-                overhead = datetime.now(pytz.timezone(general_config.local_timezone)) - next_frame_copy.timestamp
-                logger.debug(f'Thread {thread_id} - Overhead: {overhead.total_seconds()}')
-
-                logger.debug(f"Thread {thread_id} - Writing cascade result of buffer # = {next_frame_index}")
-                self.frame_buffers.write_cascade_data(next_frame_index, cascade_obj, total_runtime, overhead.total_seconds())
+                logger.debug(f'Thread {thread_id} - Indexes for cascade: {next_frame_indexes}')
+                # The buffers are locked for us until we write the cascade results, so we can use their (read-only) data
+                next_frames = [self.frame_buffers[index] for index in next_frame_indexes]
+
+                cascade_indexes: list[int] = []
+                cascade_frames: list[ImageContainer] = []
+                cascade_img_names: list[str] = []
+                for next_frame_index, next_frame in zip(next_frame_indexes, next_frames):
+                    img_name = next_frame.timestamp.strftime(general_config.timestamp_format)
+                    cascade_obj = self.gate_frame(next_frame.img_data, img_name, thread_id)
+                    if cascade_obj is not None:
+                        self.write_cascade_result(thread_id, next_frame_index, next_frame, cascade_obj, 0.0)
+                    else:
+                        cascade_indexes.append(next_frame_index)
+                        cascade_frames.append(next_frame)
+                        cascade_img_names.append(img_name)
+
+                if len(cascade_frames) > 0:
+                    if self.use_process_pool:
+                        total_runtime, cascade_objs = self.feed_to_cascade_worker(
+                            frames=cascade_frames,
+                            img_names=cascade_img_names,
+                            thread_id=thread_id
+                        )
+                    else:
+                        total_runtime, cascade_objs = self.feed_to_cascade(
+                            target_imgs=[frame.img_data for frame in cascade_frames],
+                            img_names=cascade_img_names,
+                            thread_id=thread_id,
+                            frame_indexes=cascade_indexes,
+                            sequence_numbers=[frame.sequence_number for frame in cascade_frames]
+                        )
+                    for next_frame_index, next_frame, cascade_obj in zip(cascade_indexes, cascade_frames, cascade_objs):
+                        if cascade_obj.cc_cat_bool and self.motion_gate is not None:
+                            # A cat that stays still should not end the event
+                            self.motion_gate.keep_open()
+                        self.write_cascade_result(thread_id, next_frame_index, next_frame, cascade_obj, total_runtime)
+                next_frame_indexes = []
+                next_frames = []
             except Exception:
-                if next_frame_copy is not None:
-                    img_name = next_frame_copy.timestamp.strftime(general_config.timestamp_format)
+                for next_frame in next_frames:
+                    if next_frame.img_data is None:
+                        continue
+                    img_name = next_frame.timestamp.strftime(general_config.timestamp_format)
                     filename = f'{logging_config.log_dbg_img_folder}/{img_name.replace(" ", "_")}.jpg'
                     cv2.imwrite(
                         filename,
-                        next_frame_copy.img_data
+                        next_frame.img_data
                     )
                 logger.exception(f"Thread {thread_id} - Exception in processing thread:")
-                logger.info(f"Thread {thread_id} - Cleaning queue since exception")
-                self.frame_buffers.clear()
-
-
-    def single_debug(self):
-        start_time = time.time()
-        target_img_name = 'dummy_img.jpg'
-        with get_resource_path("dbg_casc.jpg") as resource:
-            target_img = cv2.imread(
-                str(resource.resolve())
-            )
-        cascade_obj = self.feed_to_cascade(target_img=target_img, img_name=target_img_name)[1]
-        current_time = time.time()
-        logger.debug(f'Debug cascade runtime: {current_time - start_time}')
-        return cascade_obj
+                # Only the buffers of this thread are released: the other threads (and the worker processes) may still
+                # be reading theirs
+                logger.info(f"Thread {thread_id} - Releasing the buffers {next_frame_indexes} since exception")
+                for next_frame_index in next_frame_indexes:
+                    self.frame_buffers.abandon_cascade(next_frame_index)
+                next_frame_indexes = []
+                next_frames = []
@@ -1,161 +1,117 @@
-import os
-import pathlib
-import sys
 import time
 from pathlib import Path
 
 import cv2
 import numpy as np
-import tensorflow as tf
 
+from balrog.config import inference_config
 from balrog.utils import logger, get_resource_path
-
-_tensorflow_models_path = os.getenv('BALROG_TENSORFLOW_PATH')
-if (_tensorflow_models_path is None or
-        len(_tensorflow_models_path) <= 0 or
-        not pathlib.Path(_tensorflow_models_path).is_dir()):
-    raise Exception("The BALROG_TENSOFLOW_PATH was not set, or points to an invalid location. Please check the asigned value")
-
-sys.path.append(_tensorflow_models_path)
-
-from object_detection.utils import label_map_util
-
+from .inference import InferenceBackend, InferenceEngine
+from .preprocessing import detector_batch, classifier_batch, letterbox_batch, normalized_batch
 
 _PC_model_file = 'models/Prey_Classifier/0.86_512_05_VGG16_ownData_FTfrom15_350_Epochs_2020_05_15_11_40_56.h5'
 _FF_model_file = 'models/Face_Fur_Classifier/256_05_mobileNet_50_Epochs_2020_05_07_14_56_25.h5'
 _EYE_model_file = 'models/Eye_Detector/trainwhole100_Epochs_2020_04_30_18_05_25.h5'
 _HAAR_model_file = 'models/Haar_Classifier/haarcascade_frontalcatface_extended.xml'
 
-_TF_OD_model_name = 'ssdlite_mobilenet_v2_coco_2018_05_09'
-_TF_OD_frozen_model_filename = 'frozen_inference_graph.pb'
-_TF_OD_labels_filename = 'data/mscoco_label_map.pbtxt'
+# Frozen graph of the ssdlite_mobilenet_v2_coco_2018_05_09 model, from the TensorFlow detection model zoo
+_CC_model_file = 'models/SSDLite_MobileNetV2_COCO/frozen_inference_graph.pb'
 
 _CR_model_file = 'models/Cat_Recognizer'
 
+# The classes of the COCO label map that the CC stage looks for, in the format of the category index of the
+# object_detection package (we don't need the rest of the classes of the detector)
+CC_CATEGORY_INDEX = {
+    17: {'id': 17, 'name': 'cat'},
+    18: {'id': 18, 'name': 'dog'},
+}
 
-class CCMobileNetStage:
-    def __init__(self):
-        self.img_org = None
+# Original tensorflow models of the stages (package resources), and the inputs/outputs of the CC model
+CC_MODEL_RESOURCE = _CC_model_file
+CC_INPUT_NAME = 'image_tensor:0'
+CC_OUTPUT_NAMES = ['detection_boxes:0', 'detection_scores:0', 'detection_classes:0', 'num_detections:0']
+KERAS_MODEL_RESOURCES = {
+    'pc': _PC_model_file,
+    'ff': _FF_model_file,
+    'eye': _EYE_model_file,
+}
 
-        # Number of classes the object detector can identify
-        self.num_classes = 90
 
+class CCMobileNetStage:
+    def __init__(self):
         # Path to frozen detection graph .pb file, which contains the model that is used
         # for object detection.
-        self.frozen_model_file = Path(f'{_tensorflow_models_path}/object_detection/{_TF_OD_model_name}/{_TF_OD_frozen_model_filename}')
-
-        # Path to label map file
-        self.labels_file = Path(f'{_tensorflow_models_path}/object_detection/{_TF_OD_labels_filename}')
+        self.model_file_ctx = get_resource_path(_CC_model_file)
+        self.frozen_model_file = Path(self.model_file_ctx.__enter__())
 
         # Start the CNN
-        self.sess, self.detection_boxes, self.detection_scores, self.detection_classes, self.num_detections, self.image_tensor, self.category_index = self.init_cnn_model()
+        self.backend, self.category_index = self.init_cnn_model()
+
+    def __del__(self):
+        self.model_file_ctx.__exit__(None, None, None)
 
     def init_cnn_model(self):
         #### Initialize TensorFlow model ####
-
-        ## Load the label map.
-        # Label maps map indices to category names, so that when the convolution
-        # network predicts `5`, we know that this corresponds to `airplane`.
-        # Here we use internal utility functions, but anything that returns a
-        # dictionary mapping integers to appropriate string labels would be fine
-        label_map = label_map_util.load_labelmap(str(self.labels_file).strip())
-        categories = label_map_util.convert_label_map_to_categories(label_map,
-                                                                    max_num_classes=self.num_classes,
-                                                                    use_display_name=True
-                                                                    )
-        category_index = label_map_util.create_category_index(categories)
-
-        # Load the Tensorflow model into memory.
-        detection_graph = tf.Graph()
-        with detection_graph.as_default():
-            od_graph_def = tf.compat.v1.GraphDef()
-            with tf.compat.v2.io.gfile.GFile(str(self.frozen_model_file).strip(), 'rb') as fid:
-                serialized_graph = fid.read()
-                od_graph_def.ParseFromString(serialized_graph)
-                tf.import_graph_def(od_graph_def, name='')
-
-            sess = tf.compat.v1.Session(graph=detection_graph)
-
-        # Define input and output tensors (i.e. data) for the object detection classifier
-
-        # Input tensor is the image
-        image_tensor = detection_graph.get_tensor_by_name('image_tensor:0')
-
-        # Output tensors are the detection boxes, scores, and classes
-        # Each box represents a part of the image where a particular object was detected
-        detection_boxes = detection_graph.get_tensor_by_name('detection_boxes:0')
-
-        # Each score represents level of confidence for each of the objects.
-        # The score is shown on the result image, together with the class label.
-        detection_scores = detection_graph.get_tensor_by_name('detection_scores:0')
-        detection_classes = detection_graph.get_tensor_by_name('detection_classes:0')
-
-        # Number of objects detected
-        num_detections = detection_graph.get_tensor_by_name('num_detections:0')
+        if not self.frozen_model_file.is_file():
+            raise Exception(f"The model of the cat detector was not found at '{self.frozen_model_file}'. Please check "
+                            f"the installation steps in the readme")
+
+        # Label maps map indices to category names, so that when the convolution network predicts `17`, we know that
+        # this corresponds to `cat`. We only keep the classes we look for
+        category_index = CC_CATEGORY_INDEX
+
+        # Load the model with the configured engine
+        backend = InferenceBackend.get_instance(
+            engine=InferenceEngine.from_config(inference_config.cc_engine),
+            stage_name='cc',
+            tf_model_file=self.frozen_model_file,
+            models_folder=inference_config.models_folder,
+            tf_input_name=CC_INPUT_NAME,
+            tf_output_names=CC_OUTPUT_NAMES
+        )
 
         logger.debug('CNN is ready to go!')
 
-        return sess, detection_boxes, detection_scores, detection_classes, num_detections, image_tensor, category_index
-
-    def resize_img(self, input_img):
-        # prepare input image to shape (300, 300, 3) as the MobileNetV2 model specifies
-        self.img_org = input_img
-        img = cv2.cvtColor(input_img, cv2.COLOR_BGR2RGB)
-        img = cv2.resize(img, (300, 300))
-        return img
+        return backend, category_index
 
     def do_cc(self, target_img):
-        preprocessed_img = self.resize_img(input_img=target_img)
-        pred_class, pred_cc_bb, inference_time = self.pet_detector(preprocessed_img, self.sess, self.detection_boxes,
-                                                                   self.detection_scores, self.detection_classes,
-                                                                   self.num_detections, self.image_tensor,
-                                                                   self.category_index)
-        logger.debug(f'CC_time: {inference_time}')
+        pred_cc_bb, pred_class, inference_time = self.do_cc_batch([target_img])[0]
         return pred_cc_bb, pred_class, inference_time
 
-    def draw_rectangle(self, img, box, color, text):
-        font = cv2.FONT_HERSHEY_SIMPLEX
-        font_scale = 2
-        line_type = 3
-        text_pos = (box[0][0], int(box[0][1] - 16))
-
-        cv2.putText(img, text,
-                    text_pos,
-                    font,
-                    font_scale,
-                    color,
-                    line_type)
-        return cv2.rectangle(img, (box[0][0], box[0][1]), (box[1][0], box[1][1]), color, 5)
-
-    # This function contains the code to detect a pet, determine if it's
-    # inside or outside, and send a text to the user's phone.
-    def pet_detector(self, frame, sess, detection_boxes, detection_scores, detection_classes, num_detections,
-                     image_tensor, category_index):
-        frame_expanded = np.expand_dims(frame, axis=0)
+    def do_cc_batch(self, target_imgs: list) -> list[tuple]:
+        """
+        Runs the detector on several frames with a single call to the inference backend.
+        :param target_imgs: the (BGR) frames to process
+        :return: a list with the results of each frame, as returned by do_cc. The inference time of each frame is its
+        share of the time of the batch
+        """
+        # Input images of shape (300, 300, 3), as the MobileNetV2 model specifies
+        preprocessed_imgs = detector_batch(target_imgs)
 
-        # Perform the actual detection by running the model with the image as input
         start_time = time.time()
-        (boxes, scores, classes, num) = sess.run(
-            [detection_boxes, detection_scores, detection_classes, num_detections],
-            feed_dict={image_tensor: frame_expanded})
-        end_time = time.time()
-        inference_time = end_time - start_time
-
-        # Check the class of the top detected object by looking at classes[0][0].
-        # If the top detected object is a cat (17) or a dog (18) (or a teddy bear (88) for test purposes),
-        # find its center coordinates by looking at the boxes[0][0] variable.
-        # boxes[0][0] variable holds coordinates of detected objects as (ymin, xmin, ymax, xmax)
-        xmin = int(boxes[0][0][1] * self.img_org.shape[1])
-        ymin = int(boxes[0][0][0] * self.img_org.shape[0])
-        xmax = int(boxes[0][0][3] * self.img_org.shape[1])
-        ymax = int(boxes[0][0][2] * self.img_org.shape[0])
+        (boxes, scores, classes, num) = self.backend.run(preprocessed_imgs)
+        inference_time = (time.time() - start_time) / len(target_imgs)
+        logger.debug(f'CC_time (batch of {len(target_imgs)}): {inference_time} per frame')
+
+        results = []
+        for i, target_img in enumerate(target_imgs):
+            pred_class, pred_cc_bb = CCMobileNetStage._top_detection(boxes[i], classes[i], target_img.shape)
+            results.append((pred_cc_bb, pred_class, inference_time))
+        return results
+
+    @staticmethod
+    def _top_detection(boxes, classes, img_shape) -> tuple[bool, np.ndarray]:
+        # Check the class of the top detected object by looking at classes[0].
+        # If the top detected object is a cat (17) or a dog (18) (see CC_CATEGORY_INDEX),
+        # find its center coordinates by looking at the boxes[0] variable.
+        # boxes[0] variable holds coordinates of detected objects as (ymin, xmin, ymax, xmax)
+        xmin = int(boxes[0][1] * img_shape[1])
+        ymin = int(boxes[0][0] * img_shape[0])
+        xmax = int(boxes[0][3] * img_shape[1])
+        ymax = int(boxes[0][2] * img_shape[0])
         target_box = np.array([(xmin, ymin), (xmax, ymax)]).reshape((-1, 2))
 
-        if int(classes[0][0]) == 17 or int(classes[0][0]) == 18:
-            return True, target_box, inference_time
-
-        else:
-            return False, target_box, inference_time
+        return int(classes[0]) in CC_CATEGORY_INDEX, target_box
 
 
 class HaarStage:
@@ -210,20 +166,6 @@ class HaarStage:
 
         return pred_bb, inference_time, haar_found_bool
 
-    def draw_rectangle(self, img, box, color, text):
-        font = cv2.FONT_HERSHEY_SIMPLEX
-        fontScale = 2
-        lineType = 3
-        text_pos = (box[0][0], int(box[0][1] - 16))
-
-        cv2.putText(img, text,
-                    text_pos,
-                    font,
-                    fontScale,
-                    color,
-                    lineType)
-        return cv2.rectangle(img, (box[0][0], box[0][1]), (box[1][0], box[1][1]), color, 5)
-
     def calc_iou(self, gt_bbox, pred_bbox):
         (x_topleft_gt, y_topleft_gt), (x_bottomright_gt, y_bottomright_gt) = gt_bbox.tolist()
         (x_topleft_p, y_topleft_p), (x_bottomright_p, y_bottomright_p) = pred_bbox.tolist()
@@ -279,16 +221,22 @@ class PCStage:
         dependencies = {
             'get_f1': self.get_f1
         }
-        if 'F1' in _PC_model_file:
-            self.pc_model = tf.keras.models.load_model(str(self.model_file).strip(),
-                                                       custom_objects=dependencies)
-        else:
-            self.pc_model = tf.keras.models.load_model(str(self.model_file).strip())
+        self.pc_backend = InferenceBackend.get_instance(
+            engine=InferenceEngine.from_config(inference_config.pc_engine),
+            stage_name='pc',
+            tf_model_file=Path(self.model_file),
+            models_folder=inference_config.models_folder,
+            custom_objects=dependencies if 'F1' in _PC_model_file else None,
+            jit_compile=inference_config.keras_jit_compile,
+            variant=inference_config.pc_variant
+        )
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.model_file_ctx.__exit__(None, None, None)
 
     def get_f1(self, y_true, y_pred):  # taken from old keras source code
+        import tensorflow as tf
+
         K = tf.keras.backend
         true_positives = K.sum(K.round(K.clip(y_true * y_pred, 0, 1)))
         possible_positives = K.sum(K.round(K.clip(y_true, 0, 1)))
@@ -298,19 +246,16 @@ class PCStage:
         f1_val = 2 * (precision * recall) / (precision + recall + K.epsilon())
         return f1_val
 
-    def resize_img(self, img_org):
-        return cv2.resize(img_org, (self.TARGET_SIZE, self.TARGET_SIZE)) * (1. / 255)
-
-    def pc_prediction(self, img, pc_model):
-        preprocessed_img = self.resize_img(img_org=img).reshape((1, self.TARGET_SIZE, self.TARGET_SIZE, 3))
+    def pc_prediction(self, img, pc_backend):
+        preprocessed_img = classifier_batch(img, 'pc')
         start_time = time.time()
-        class_pred = pc_model.predict(preprocessed_img)
+        class_pred = pc_backend.run(preprocessed_img)[0]
         inference_time = time.time() - start_time
 
         return class_pred[0][0], inference_time
 
     def pc_do(self, target_img):
-        pred_val, inference_time = self.pc_prediction(img=target_img, pc_model=self.pc_model)
+        pred_val, inference_time = self.pc_prediction(img=target_img, pc_backend=self.pc_backend)
 
         if pred_val <= 0.5:
             return False, pred_val, inference_time
@@ -343,25 +288,29 @@ class FFStage:
         # Handle args
         self.model_file_ctx = get_resource_path(_FF_model_file)
         self.model_file = self.model_file_ctx.__enter__()
-        self.ff_model = tf.keras.models.load_model(str(self.model_file).strip())
+        self.ff_backend = InferenceBackend.get_instance(
+            engine=InferenceEngine.from_config(inference_config.ff_engine),
+            stage_name='ff',
+            tf_model_file=Path(self.model_file),
+            models_folder=inference_config.models_folder,
+            jit_compile=inference_config.keras_jit_compile,
+            variant=inference_config.ff_variant
+        )
 
     def __del__(self):
         self.model_file_ctx.__exit__(None, None, None)
 
-    def resize_img(self, img_org):
-        return cv2.resize(img_org, (self.TARGET_SIZE, self.TARGET_SIZE)) * (1. / 255)
-
-    def ff_prediction(self, img, ff_model):
-        preprocessed_img = self.resize_img(img_org=img).reshape((1, self.TARGET_SIZE, self.TARGET_SIZE, 3))
+    def ff_prediction(self, img, ff_backend):
+        preprocessed_img = classifier_batch(img, 'ff')
 
         start_time = time.time()
-        class_pred = ff_model.predict(preprocessed_img)
+        class_pred = ff_backend.run(preprocessed_img)[0]
         inference_time = time.time() - start_time
 
         return class_pred[0][0], inference_time
 
     def ff_do(self, target_img):
-        pred, inference_time = self.ff_prediction(img=target_img, ff_model=self.ff_model)
+        pred, inference_time = self.ff_prediction(img=target_img, ff_backend=self.ff_backend)
 
         if pred <= 0.5:
             return True, pred, inference_time
@@ -374,34 +323,27 @@ class EyeStage:
         self.TARGET_SIZE = 224
         self.model_file_ctx = get_resource_path(_EYE_model_file)
         self.model_file = self.model_file_ctx.__enter__()
-        self.eye_model = tf.keras.models.load_model(str(self.model_file).strip())
+        self.eye_backend = InferenceBackend.get_instance(
+            engine=InferenceEngine.from_config(inference_config.eye_engine),
+            stage_name='eye',
+            tf_model_file=Path(self.model_file),
+            models_folder=inference_config.models_folder,
+            jit_compile=inference_config.keras_jit_compile,
+            variant=inference_config.eye_variant
+        )
 
     def __del__(self):
         self.model_file_ctx.__exit__(None, None, None)
 
-    def resize_img(self, img_resize):
-        old_size = img_resize.shape[:2]  # old_size is in (height, width) format
-        ratio = float(self.TARGET_SIZE) / max(old_size)
-        new_size = tuple([int(x * ratio) for x in old_size])
-        # new_size should be in (width, height) format
-        img_resize = cv2.resize(img_resize, (new_size[1], new_size[0]))
-        delta_w = self.TARGET_SIZE - new_size[1]
-        delta_h = self.TARGET_SIZE - new_size[0]
-        top, bottom = delta_h // 2, delta_h - (delta_h // 2)
-        left, right = delta_w // 2, delta_w - (delta_w // 2)
-        img_resize = cv2.copyMakeBorder(img_resize, top, bottom, left, right, cv2.BORDER_CONSTANT, value=[0, 0, 0])
-        return img_resize, top, left
-
     def eye_prediction(self, input):
-        inputs = (input.astype('float32') / 255).reshape((1, self.TARGET_SIZE, self.TARGET_SIZE, 3))
-        pred_eyes = self.eye_model.predict(inputs)[0].reshape((-1, 2))
+        inputs = normalized_batch(input, 'eye')
+        pred_eyes = self.eye_backend.run(inputs)[0][0].reshape((-1, 2))
         return pred_eyes
 
     def eye_full_prediction(self, target_img, cc_bbs):
-        preprocessed_img, top, left = self.resize_img(target_img)
-        inputs = (preprocessed_img.astype('float32') / 255).reshape((1, self.TARGET_SIZE, self.TARGET_SIZE, 3))
+        inputs, top, left = letterbox_batch(target_img, 'eye')
         start_time = time.time()
-        pred_eyes = self.eye_model.predict(inputs)[0].reshape((-1, 2))
+        pred_eyes = self.eye_backend.run(inputs)[0][0].reshape((-1, 2))
         inference_time = time.time() - start_time
 
         ratio_h = self.TARGET_SIZE / target_img.shape[0]
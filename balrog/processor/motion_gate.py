@@ -0,0 +1,110 @@
+from threading import Lock
+from typing import Optional
+
+import cv2
+import numpy as np
+from cv2.typing import MatLike
+
+from balrog.utils import logger
+
+# Width (in pixels) of the downscaled frames used to detect motion
+_MOTION_FRAME_WIDTH = 160
+# How fast the background model adapts to the scene (e.g., to light changes)
+_BACKGROUND_LEARNING_RATE = 0.05
+
+
+class MotionGate:
+    """
+    Cheap change detector that runs before the cascade. Each frame is downscaled, converted to grayscale and compared
+    against a running-average background model. Frames where the fraction of changed pixels is below the configured
+    sensitivity are considered static, and they do not need to go through the (expensive) cascade.
+    """
+    def __init__(self, sensitivity: float, pixel_threshold: int, hold_frames: int, mask_file: str):
+        """
+        :param sensitivity: minimum fraction (in the range [0, 1]) of changed pixels to consider that a frame has motion
+        :param pixel_threshold: minimum gray level difference (in the range [0, 255]) to consider a pixel as changed
+        :param hold_frames: number of frames that are still passed to the cascade after the last detected motion
+        :param mask_file: optional path to an image where non-black pixels mark the region to watch; empty to watch
+        the whole frame
+        """
+        self.sensitivity = sensitivity
+        self.pixel_threshold = pixel_threshold
+        self.hold_frames = hold_frames
+        self.mask_file = mask_file
+        self._lock = Lock()
+        self._background: Optional[np.ndarray] = None
+        self._mask: Optional[np.ndarray] = None
+        self._watched_pixels = 0
+        self._hold_counter = 0
+        self._gated_frames = 0
+        self._passed_frames = 0
+
+    @property
+    def gated_frames(self) -> int:
+        return self._gated_frames
+
+    @property
+    def passed_frames(self) -> int:
+        return self._passed_frames
+
+    @staticmethod
+    def _prepare_frame(img: MatLike) -> np.ndarray:
+        height, width = img.shape[:2]
+        small_height = max(1, int(height * _MOTION_FRAME_WIDTH / width))
+        small_img = cv2.resize(img, (_MOTION_FRAME_WIDTH, small_height), interpolation=cv2.INTER_AREA)
+        gray_img = cv2.cvtColor(small_img, cv2.COLOR_BGR2GRAY)
+        return cv2.GaussianBlur(gray_img, (5, 5), 0)
+
+    def _reset_model(self, gray_img: np.ndarray) -> None:
+        self._background = gray_img.astype(np.float32)
+        self._mask = None
+        self._watched_pixels = gray_img.size
+        if self.mask_file:
+            mask_img = cv2.imread(self.mask_file, cv2.IMREAD_GRAYSCALE)
+            if mask_img is None:
+                raise Exception(f"Motion mask file '{self.mask_file}' could not be read")
+            mask_img = cv2.resize(mask_img, (gray_img.shape[1], gray_img.shape[0]), interpolation=cv2.INTER_NEAREST)
+            self._mask = np.where(mask_img > 0, 255, 0).astype(np.uint8)
+            self._watched_pixels = max(1, cv2.countNonZero(self._mask))
+
+    def has_motion(self, img: MatLike) -> bool:
+        """
+        Checks if the given frame changed with respect to the background model, and updates the model with it.
+        :param img: the full (BGR) frame to check
+        :return: True if the frame needs to go through the cascade, False if it can be skipped
+        """
+        gray_img = MotionGate._prepare_frame(img)
+        with self._lock:
+            if self._background is None or self._background.shape != gray_img.shape:
+                # First frame (or the camera resolution changed); we can't tell, so we let it pass
+                self._reset_model(gray_img)
+                changed = True
+            else:
+                diff_img = cv2.absdiff(gray_img, cv2.convertScaleAbs(self._background))
+                _, changed_img = cv2.threshold(diff_img, self.pixel_threshold, 255, cv2.THRESH_BINARY)
+                if self._mask is not None:
+                    changed_img = cv2.bitwise_and(changed_img, self._mask)
+                changed_fraction = cv2.countNonZero(changed_img) / self._watched_pixels
+                cv2.accumulateWeighted(gray_img, self._background, _BACKGROUND_LEARNING_RATE)
+                changed = changed_fraction >= self.sensitivity
+                logger.debug(f"Motion gate - changed fraction: {changed_fraction:.4f}")
+
+            if changed:
+                self._hold_counter = self.hold_frames
+            elif self._hold_counter > 0:
+                self._hold_counter -= 1
+                changed = True
+
+            if changed:
+                self._passed_frames += 1
+            else:
+                self._gated_frames += 1
+            return changed
+
+    def keep_open(self) -> None:
+        """
+        Keeps passing frames to the cascade for (at least) the configured hold frames. This is used when the cascade
+        finds a cat, so a cat that sits still in front of the flap does not end the event.
+        """
+        with self._lock:
+            self._hold_counter = self.hold_frames
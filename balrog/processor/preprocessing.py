@@ -0,0 +1,95 @@
+"""
+Preprocessing of the inputs of the cascade stages. Each function fuses the resize, colour conversion and normalization
+of a stage, and writes the result into an input batch that is preallocated per thread (and per stage), so the hot path
+does not allocate new arrays nor converts between dtypes. The returned batches are only valid until the next call for
+the same stage from the same thread; the inference backends consume them before that.
+"""
+import threading
+
+import cv2
+import numpy as np
+from cv2.typing import MatLike
+
+# Input size of the SSD MobileNet detector (CC stage)
+DETECTOR_INPUT_SIZE = 300
+# Input size of the keras models (PC, FF and eye stages)
+CLASSIFIER_INPUT_SIZE = 224
+
+_NORMALIZATION_SCALE = np.float32(1. / 255)
+_thread_buffers = threading.local()
+
+
+def _buffer(key: str, shape: tuple[int, ...], dtype: type) -> np.ndarray:
+    buffers: dict[str, np.ndarray] = getattr(_thread_buffers, 'buffers', None)
+    if buffers is None:
+        buffers = _thread_buffers.buffers = {}
+    buffer = buffers.get(key)
+    if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+        buffer = buffers[key] = np.empty(shape, dtype=dtype)
+    return buffer
+
+
+def detector_batch(imgs: list[MatLike]) -> np.ndarray:
+    """
+    Prepares the input of the detector: the frames resized to 300x300 and converted to RGB. The frozen graph takes
+    uint8 images, so they are not normalized.
+    :param imgs: the (BGR) frames
+    :return: the uint8 batch of shape (len(imgs), 300, 300, 3)
+    """
+    batch = _buffer('cc', (len(imgs), DETECTOR_INPUT_SIZE, DETECTOR_INPUT_SIZE, 3), np.uint8)
+    for img, batch_img in zip(imgs, batch):
+        # Resizing first converts the colour of the smaller image; both operations work per pixel/channel
+        cv2.resize(img, (DETECTOR_INPUT_SIZE, DETECTOR_INPUT_SIZE), dst=batch_img)
+        cv2.cvtColor(batch_img, cv2.COLOR_BGR2RGB, dst=batch_img)
+    return batch
+
+
+def _normalize_into(img: np.ndarray, batch_img: np.ndarray) -> None:
+    np.multiply(img, _NORMALIZATION_SCALE, out=batch_img)
+
+
+def classifier_batch(img: MatLike, key: str) -> np.ndarray:
+    """
+    Prepares the input of a classifier (PC and FF stages): the (BGR) crop resized to 224x224 and scaled to [0, 1].
+    :param img: the crop to classify
+    :param key: the name of the stage, so each stage has its own buffers
+    :return: the float32 batch of shape (1, 224, 224, 3)
+    """
+    resized = _buffer(f'{key}-resized', (CLASSIFIER_INPUT_SIZE, CLASSIFIER_INPUT_SIZE, 3), img.dtype)
+    cv2.resize(img, (CLASSIFIER_INPUT_SIZE, CLASSIFIER_INPUT_SIZE), dst=resized)
+    batch = _buffer(key, (1, CLASSIFIER_INPUT_SIZE, CLASSIFIER_INPUT_SIZE, 3), np.float32)
+    _normalize_into(resized, batch[0])
+    return batch
+
+
+def letterbox_batch(img: MatLike, key: str) -> tuple[np.ndarray, int, int]:
+    """
+    Prepares the input of the eye detector: the (BGR) crop resized to fit in 224x224 (keeping its aspect ratio),
+    centered on a black canvas, and scaled to [0, 1].
+    :param img: the crop to process
+    :param key: the name of the stage, so each stage has its own buffers
+    :return: the float32 batch of shape (1, 224, 224, 3), and the top and left borders added to the crop
+    """
+    ratio = float(CLASSIFIER_INPUT_SIZE) / max(img.shape[:2])
+    new_height, new_width = [int(x * ratio) for x in img.shape[:2]]
+    top = (CLASSIFIER_INPUT_SIZE - new_height) // 2
+    left = (CLASSIFIER_INPUT_SIZE - new_width) // 2
+
+    canvas = _buffer(f'{key}-canvas', (CLASSIFIER_INPUT_SIZE, CLASSIFIER_INPUT_SIZE, 3), img.dtype)
+    canvas.fill(0)
+    canvas[top:top + new_height, left:left + new_width] = cv2.resize(img, (new_width, new_height))
+    batch = _buffer(key, (1, CLASSIFIER_INPUT_SIZE, CLASSIFIER_INPUT_SIZE, 3), np.float32)
+    _normalize_into(canvas, batch[0])
+    return batch, top, left
+
+
+def normalized_batch(img: MatLike, key: str) -> np.ndarray:
+    """
+    Prepares an input that already has the size of the model: the image scaled to [0, 1].
+    :param img: the image to process
+    :param key: the name of the stage, so each stage has its own buffers
+    :return: the float32 batch of shape (1, *img.shape)
+    """
+    batch = _buffer(key, (1, *img.shape), np.float32)
+    _normalize_into(img, batch[0])
+    return batch
@@ -0,0 +1,94 @@
+import os
+from multiprocessing.shared_memory import SharedMemory
+from multiprocessing.synchronize import Barrier
+from typing import Optional
+
+import numpy as np
+
+from balrog.utils import logger
+from .cascade import Cascade, EventElement
+from .image_container import SharedFrameRef
+from .warmup import warm_up_cascade, StageWarmup
+
+# State of each worker process: its own cascade, and the shared memory slabs it attached to
+_worker_cascade: Optional[Cascade] = None
+_worker_slabs: dict[str, tuple[SharedMemory, np.ndarray]] = {}
+# Shared by all the workers of the pool (see cascade_worker_ready)
+_ready_barrier: Optional[Barrier] = None
+_worker_warmup: list[StageWarmup] = []
+
+
+def init_cascade_worker(ready_barrier: Barrier) -> None:
+    """
+    Initializer of the cascade worker processes: loads and warms up the models of the cascade owned by this process.
+    The worker does not run any task until this is done.
+    :param ready_barrier: barrier with a party per worker of the pool
+    """
+    global _worker_cascade, _ready_barrier, _worker_warmup
+    _ready_barrier = ready_barrier
+    _worker_cascade = Cascade()
+    _worker_warmup = warm_up_cascade(_worker_cascade)
+    logger.info("Cascade worker process initialized")
+
+
+def cascade_worker_ready() -> tuple[int, list[StageWarmup]]:
+    """
+    Task that returns when every worker of the pool is initialized (i.e., its cascade is warmed up). It waits for the
+    same task in the rest of the workers, so submitting one per worker reaches all of them.
+    :return: the PID of the worker, and the warmup of its stages (the workers don't log)
+    """
+    _ready_barrier.wait()
+    return os.getpid(), _worker_warmup
+
+
+def _attach_slab(slab_name: str, slab_shape: tuple[int, ...], dtype: str) -> np.ndarray:
+    if slab_name not in _worker_slabs:
+        # The workers share the resource tracker of the main process, which owns (and unlinks) the shared memory
+        shm = SharedMemory(name=slab_name)
+        _worker_slabs[slab_name] = (shm, np.ndarray(slab_shape, dtype=np.dtype(dtype), buffer=shm.buf))
+    return _worker_slabs[slab_name][1]
+
+
+def _detach_old_slabs(frame_refs: list[SharedFrameRef]) -> None:
+    # The slabs are only replaced when the resolution of the camera changes
+    used_slab_names = {ref.frames_slab_name for ref in frame_refs}
+    for slab_name in list(_worker_slabs):
+        if slab_name not in used_slab_names:
+            shm = _worker_slabs.pop(slab_name)[0]
+            shm.close()
+
+
+def run_shared_cascade(
+        frame_refs: list[SharedFrameRef],
+        img_names: list[str],
+        sequence_numbers: list[int],
+        thread_id: int
+) -> list[EventElement]:
+    """
+    Runs the cascade of this worker on a batch of frames stored in the shared memory slab.
+    :param frame_refs: the references to the frames in the shared memory
+    :param img_names: the names of the images (i.e., their timestamps)
+    :param sequence_numbers: the sequence numbers of the frames
+    :param thread_id: the ID of the thread in the main process that requested the cascade
+    :return: the event elements with the results of the cascade, without images (the main process restores the views
+    of its frames)
+    """
+    _detach_old_slabs(frame_refs)
+    event_objs = []
+    for frame_ref, img_name, sequence_number in zip(frame_refs, img_names, sequence_numbers):
+        frames_slab = _attach_slab(frame_ref.frames_slab_name, frame_ref.slab_shape, frame_ref.dtype)
+        event_objs.append(EventElement(
+            img_name=img_name,
+            cc_target_img=frames_slab[frame_ref.index],
+            sequence_number=sequence_number
+        ))
+    _worker_cascade.do_cascade_batch(
+        event_img_objects=event_objs,
+        thread_id=thread_id,
+        frame_indexes=[frame_ref.index for frame_ref in frame_refs]
+    )
+
+    for event_obj in event_objs:
+        # Only the compact results go back to the main process
+        event_obj.cc_target_img = None
+    return event_objs
@@ -0,0 +1,147 @@
+import time
+from threading import Lock
+from typing import Optional, Callable
+
+import cv2
+import numpy as np
+from cv2.typing import MatLike
+
+from balrog.utils import logger
+
+_TRACKER_FACTORIES: dict[str, Callable[[], cv2.Tracker]] = {
+    "CSRT": lambda: cv2.TrackerCSRT.create(),
+    "KCF": lambda: cv2.TrackerKCF.create(),
+    "MOSSE": lambda: cv2.legacy.TrackerMOSSE.create(),
+}
+# Range of the area of the tracked box (relative to the detected box) that we still trust
+_MIN_AREA_RATIO = 0.5
+_MAX_AREA_RATIO = 2.0
+# Weight of the last detection in the running estimate of the detection time
+_DETECTION_TIME_WEIGHT = 0.2
+
+
+class CatTracker:
+    """
+    Propagates the bounding box of the cat between consecutive frames, so the (expensive) detector does not need to
+    run on every frame. A detection of the cat seeds an OpenCV tracker, which runs on downscaled frames. The detector
+    runs again every redetect_interval frames, when frames were skipped (the tracker only moves forward in sequence
+    order), or when the tracker loses the cat.
+    """
+    def __init__(self, tracker_type: str, redetect_interval: int, max_frame_gap: int, frame_width: int):
+        """
+        :param tracker_type: the OpenCV tracker: "CSRT", "KCF" or "MOSSE"
+        :param redetect_interval: maximum number of consecutive tracked frames before running the detector again
+        :param max_frame_gap: maximum difference of sequence numbers between two tracked frames
+        :param frame_width: width (in pixels) of the downscaled frames used for tracking
+        """
+        if tracker_type not in _TRACKER_FACTORIES:
+            raise Exception(f"Unknown tracker type '{tracker_type}'. Please check the configuration file")
+        self.tracker_type = tracker_type
+        self.redetect_interval = redetect_interval
+        self.max_frame_gap = max_frame_gap
+        self.frame_width = frame_width
+        self._lock = Lock()
+        self._tracker: Optional[cv2.Tracker] = None
+        self._last_sequence_number = -1
+        self._tracked_since_detection = 0
+        self._seed_area = 0.0
+        self._detection_time: Optional[float] = None
+        self._detected_frames = 0
+        self._tracked_frames = 0
+
+    @property
+    def detected_frames(self) -> int:
+        return self._detected_frames
+
+    @property
+    def tracked_frames(self) -> int:
+        return self._tracked_frames
+
+    @property
+    def detection_time(self) -> Optional[float]:
+        """
+        :return: the running estimate of the time of a detection, or None if there was no detection yet
+        """
+        return self._detection_time
+
+    def _downscale(self, img: MatLike) -> tuple[MatLike, float]:
+        scale = min(1.0, self.frame_width / img.shape[1])
+        if scale >= 1.0:
+            return img, 1.0
+        small_size = (self.frame_width, max(1, int(img.shape[0] * scale)))
+        return cv2.resize(img, small_size, interpolation=cv2.INTER_AREA), scale
+
+    def track(self, img: MatLike, sequence_number: int) -> Optional[tuple[np.ndarray, float]]:
+        """
+        Tries to find the cat in the given frame with the tracker.
+        :param img: the full frame
+        :param sequence_number: the sequence number of the frame
+        :return: the bounding box of the cat (in the same format as the detector) and the tracking time, or None if
+        the frame needs a detection
+        """
+        with self._lock:
+            if (self._tracker is None or
+                    sequence_number <= self._last_sequence_number or
+                    sequence_number - self._last_sequence_number > self.max_frame_gap or
+                    self._tracked_since_detection >= self.redetect_interval):
+                return None
+
+            start_time = time.time()
+            small_img, scale = self._downscale(img)
+            found, (x, y, width, height) = self._tracker.update(small_img)
+            tracking_time = time.time() - start_time
+            area_ratio = (width * height) / self._seed_area if self._seed_area > 0 else 0
+            if not found or not _MIN_AREA_RATIO <= area_ratio <= _MAX_AREA_RATIO:
+                logger.debug(f"Tracker lost the cat in frame {sequence_number} (area ratio: {area_ratio:.2f})")
+                self._tracker = None
+                return None
+
+            self._last_sequence_number = sequence_number
+            self._tracked_since_detection += 1
+            self._tracked_frames += 1
+            xmin = max(int(x / scale), 0)
+            ymin = max(int(y / scale), 0)
+            xmax = min(int((x + width) / scale), img.shape[1])
+            ymax = min(int((y + height) / scale), img.shape[0])
+            return np.array([(xmin, ymin), (xmax, ymax)]).reshape((-1, 2)), tracking_time
+
+    def seed(
+            self,
+            img: MatLike,
+            sequence_number: int,
+            cat_bool: bool,
+            box: Optional[np.ndarray],
+            detection_time: float
+    ) -> None:
+        """
+        Updates the tracker with the result of a detection.
+        :param img: the full frame
+        :param sequence_number: the sequence number of the frame
+        :param cat_bool: True if the detector found a cat in the frame
+        :param box: the bounding box of the cat, as returned by the detector
+        :param detection_time: the time that the detection took
+        """
+        with self._lock:
+            self._detected_frames += 1
+            if self._detection_time is None:
+                self._detection_time = detection_time
+            else:
+                self._detection_time += _DETECTION_TIME_WEIGHT * (detection_time - self._detection_time)
+            if sequence_number < self._last_sequence_number:
+                # A newer frame already updated the tracker
+                return
+
+            self._last_sequence_number = sequence_number
+            self._tracked_since_detection = 0
+            if not cat_bool or box is None:
+                self._tracker = None
+                return
+
+            small_img, scale = self._downscale(img)
+            x = int(box[0][0] * scale)
+            y = int(box[0][1] * scale)
+            width = max(1, int((box[1][0] - box[0][0]) * scale))
+            height = max(1, int((box[1][1] - box[0][1]) * scale))
+            self._tracker = _TRACKER_FACTORIES[self.tracker_type]()
+            self._tracker.init(small_img, (x, y, width, height))
+            self._seed_area = float(width * height)
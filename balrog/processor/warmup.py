@@ -0,0 +1,99 @@
+import time
+from dataclasses import dataclass, field
+from typing import Callable
+
+import cv2
+import numpy as np
+
+from balrog.config import general_config, inference_config
+from balrog.utils import logger, get_resource_path
+from .cascade import Cascade
+
+# Size (in pixels) of the synthetic crops of the cat (the input of the Haar and eye stages) and of its snout (the input
+# of the FF and PC stages). The stages resize their inputs to the size of their models, so any size works
+_CAT_CROP_SIZE = 480
+_SNOUT_CROP_SIZE = 160
+
+
+@dataclass
+class StageWarmup:
+    """
+    Latencies (in seconds) of the warmup runs of a stage, in order.
+    """
+    name: str
+    latencies: list[float] = field(default_factory=list)
+    stable: bool = False
+
+    @property
+    def stable_latency(self) -> float:
+        return float(np.median(self.latencies[-inference_config.warmup_stable_iterations:]))
+
+
+def _is_stable(latencies: list[float]) -> bool:
+    # The last runs are stable when all of them are within the tolerance of their median
+    window = latencies[-inference_config.warmup_stable_iterations:]
+    if len(window) < inference_config.warmup_stable_iterations:
+        return False
+    median = float(np.median(window))
+    return max(abs(latency - median) for latency in window) <= inference_config.warmup_tolerance * median
+
+
+def _stage_runs(cascade: Cascade) -> dict[str, Callable[[], object]]:
+    # Synthetic inputs with the shapes of the real ones: noise frames with the resolution of the debug image (as the
+    # null camera produces), and crops of the cat and its snout. Unlike running the cascade on a frame, this reaches
+    # every stage, whatever the stages find in the image
+    with get_resource_path("dbg_casc.jpg") as resource:
+        frame_shape = cv2.imread(str(resource)).shape
+    rng = np.random.default_rng(0)
+    frame = rng.integers(0, 256, frame_shape, dtype=np.uint8)
+    cat_crop = rng.integers(0, 256, (_CAT_CROP_SIZE, _CAT_CROP_SIZE, 3), dtype=np.uint8)
+    snout_crop = rng.integers(0, 256, (_SNOUT_CROP_SIZE, _SNOUT_CROP_SIZE, 3), dtype=np.uint8)
+    cat_box = np.array([(0, 0), (_CAT_CROP_SIZE, _CAT_CROP_SIZE)])
+
+    stage_runs = {'cc': lambda: cascade.cc_mobile_stage.do_cc_batch([frame])}
+    if general_config.cascade_batch_size > 1:
+        # The batches of the detector have their own input shape
+        batch = [frame] * general_config.cascade_batch_size
+        stage_runs[f'cc x{len(batch)}'] = lambda: cascade.cc_mobile_stage.do_cc_batch(batch)
+    stage_runs['haar'] = lambda: cascade.haar_stage.haar_predict(cat_crop)
+    stage_runs['eye'] = lambda: cascade.eyes_stage.eye_full_prediction(cat_crop, cat_box)
+    stage_runs['ff'] = lambda: cascade.ff_stage.ff_do(snout_crop)
+    stage_runs['pc'] = lambda: cascade.pc_stage.pc_do(snout_crop)
+    return stage_runs
+
+
+def warm_up_cascade(cascade: Cascade) -> list[StageWarmup]:
+    """
+    Runs every stage of the cascade with synthetic inputs until its latency is stable (see the warmup options of the
+    inference section), so the first frames with a cat don't pay for the initialization of the models.
+    :param cascade: the cascade to warm up
+    :return: the warmup of each stage
+    """
+    results = []
+    for name, stage_run in _stage_runs(cascade).items():
+        result = StageWarmup(name)
+        while not result.stable and len(result.latencies) < max(1, inference_config.warmup_max_iterations):
+            run_start_time = time.perf_counter()
+            stage_run()
+            result.latencies.append(time.perf_counter() - run_start_time)
+            result.stable = _is_stable(result.latencies)
+        results.append(result)
+    return results
+
+
+def log_warmup(results: list[StageWarmup], cascade_name: str) -> None:
+    """
+    Logs the warmup of each stage as a table.
+    :param results: the warmup of each stage, as returned by warm_up_cascade
+    :param cascade_name: the name of the cascade in the log (e.g., its worker process)
+    """
+    warmup_time = sum(sum(result.latencies) for result in results)
+    table = [f"{'stage':>6} | {'runs':>4} | {'first ms':>9} | {'stable ms':>9} | stable"]
+    for result in results:
+        table.append(f"{result.name:>6} | {len(result.latencies):>4} | {result.latencies[0] * 1000:>9.2f} | "
+                     f"{result.stable_latency * 1000:>9.2f} | {'yes' if result.stable else 'NO'}")
+    logger.info(f"{cascade_name} warmed up in {warmup_time:.2f}s:\n" + "\n".join(table))
+    unstable = [result.name for result in results if not result.stable]
+    if len(unstable) > 0:
+        logger.warning(f"{cascade_name}: the latency of the stages {unstable} was not stable after "
+                       f"{inference_config.warmup_max_iterations} warmup runs")
@@ -0,0 +1,154 @@
+import time
+from os import getenv
+from threading import Event, Thread
+from typing import Optional
+
+from balrog.camera import ICamera
+from balrog.config import (general_config, camera_config, logging_config, tracking_config, add_reload_listener,
+                           remove_reload_listener, reload_config)
+from balrog.processor.image_container import ImageBuffers
+from balrog.processor.main_loop import FrameResultAggregator, FrameProcessor, CascadeModels
+from balrog.utils import logger
+
+# Exit codes of the process, as interpreted by balrog.sh
+RESTART_EXIT_CODE = 0
+FAILURE_EXIT_CODE = 1
+# Soft restarts that can fail in a row (e.g., no network for the bot) before we give up and exit the process
+_MAX_CONSECUTIVE_FAILURES = 5
+_FAILURE_BACKOFF_SECONDS = 5.0
+# Period of the check of the camera stall
+_STALL_CHECK_SECONDS = 1.0
+
+
+def _validate_general_config() -> None:
+    if general_config.straggler_policy not in ("skip", "wait"):
+        raise Exception(f"Unknown straggler policy '{general_config.straggler_policy}'. "
+                        f"Please check the configuration file")
+    if general_config.cascade_batch_size < 1:
+        raise Exception("The cascade batch size must be at least 1. Please check the configuration file")
+    if general_config.frame_processor_executor not in ("thread", "process"):
+        raise Exception(f"Unknown frame processor executor '{general_config.frame_processor_executor}'. "
+                        f"Please check the configuration file")
+
+
+class Supervisor:
+    """
+    Runs the module, and restarts it in the same process when asked (/restart), when the camera stalls, or when the
+    pipeline fails: the camera, buffers, frame processor, aggregator and bot are torn down and created again, but the
+    models of the cascade (the slowest part of the startup) are loaded only once and kept across these soft restarts.
+    The process only exits to be restarted by balrog.sh (/hardrestart), or when the soft restarts keep failing.
+    """
+    def __init__(self):
+        # Startup time: from the creation of the supervisor until the first processed frame is aggregated
+        self.start_time = time.monotonic()
+        self.time_to_first_frame: Optional[float] = None
+        self.first_frame_event = Event()
+        _validate_general_config()
+        self.models = CascadeModels.load()
+        # Nothing is started (not even the bot, which tells that the module is online) until every model is warm
+        self.models.warm_up()
+        self.replay_source = getenv("BALROG_REPLAY_SOURCE")
+        # The sequence numbers of the frames continue across soft restarts (see _run_pipeline)
+        self._next_sequence_number = 0
+
+    def run(self) -> int:
+        """
+        Runs the module until the process needs to exit.
+        :return: the exit code of the process
+        """
+        consecutive_failures = 0
+        try:
+            while True:
+                process_restart_event = Event()
+                start_time = time.monotonic()
+                try:
+                    self._run_pipeline(process_restart_event)
+                    consecutive_failures = 0
+                except Exception:
+                    consecutive_failures += 1
+                    logger.exception(f"Exception in the pipeline (failure {consecutive_failures} in a row)")
+                    if consecutive_failures >= _MAX_CONSECUTIVE_FAILURES:
+                        logger.error("The pipeline keeps failing; exiting the process")
+                        return FAILURE_EXIT_CODE
+                    time.sleep(_FAILURE_BACKOFF_SECONDS)
+
+                if process_restart_event.is_set():
+                    logger.warning("Restarting the process")
+                    return RESTART_EXIT_CODE
+                logger.warning(f"Soft restart, the pipeline ran for {time.monotonic() - start_time:.1f}s")
+                self._reload_config()
+        finally:
+            self.models.close()
+
+    @staticmethod
+    def _reload_config() -> None:
+        # The settings that are not used by the models are applied by the new pipeline
+        try:
+            report = reload_config(soft_restart=True)
+            logger.info(str(report))
+        except Exception:
+            logger.exception("Could not reload the config file; keeping the current config")
+
+    def _run_pipeline(self, process_restart_event: Event) -> None:
+        setup_start_time = time.monotonic()
+        _validate_general_config()
+        stop_event = Event()
+        frame_buffers = ImageBuffers(
+            2 * general_config.max_frame_buffers,
+            logging_config.enable_circular_buffer_logging,
+            reorder_window=general_config.aggregation_reorder_window,
+            skip_stragglers=general_config.straggler_policy == "skip",
+            straggler_deadline=general_config.straggler_deadline_seconds,
+            shared_memory=general_config.frame_processor_executor == "process",
+            first_sequence_number=self._next_sequence_number
+        )
+        camera = ICamera.get_instance(
+            fps=camera_config.camera_fps,
+            frame_buffers=frame_buffers,
+            stop_event=stop_event,
+            cleanup_threshold=camera_config.camera_cleanup_frames_threshold,
+            capture_mode=camera_config.capture_mode,
+            replay_source=self.replay_source,
+            replay_realtime=camera_config.replay_realtime,
+            is_debug=getenv("BALROG_USE_NULL_CAMERA") is not None
+        )
+
+        def apply_camera_config() -> None:
+            camera.apply_settings(camera_config.camera_fps, camera_config.camera_cleanup_frames_threshold)
+
+        add_reload_listener(apply_camera_config)
+        try:
+            frame_processor = FrameProcessor(frame_buffers, stop_event, self.models)
+            frame_aggregator = FrameResultAggregator(
+                frame_buffers, stop_event, process_restart_event,
+                on_first_frame=None if self.first_frame_event.is_set() else self._on_first_frame
+            )
+            with frame_aggregator, frame_processor, camera:
+                logger.info(f"Pipeline ready in {time.monotonic() - setup_start_time:.2f}s")
+                if self.replay_source is None:
+                    Thread(
+                        target=self._watch_camera, args=(camera, frame_aggregator, stop_event),
+                        name='camera-watchdog', daemon=True
+                    ).start()
+                frame_aggregator.aggregator_thread()
+        finally:
+            stop_event.set()
+            remove_reload_listener(apply_camera_config)
+            # The trackers of the cascades (which we keep) only follow consecutive sequence numbers, so we leave a gap
+            # after the frames of this pipeline: they see the new frames as a new scene
+            self._next_sequence_number = frame_buffers.next_sequence_number + tracking_config.max_frame_gap + 1
+
+    def _on_first_frame(self) -> None:
+        self.time_to_first_frame = time.monotonic() - self.start_time
+        logger.info(f"First frame processed {self.time_to_first_frame:.2f}s after the start")
+        self.first_frame_event.set()
+
+    @staticmethod
+    def _watch_camera(camera: ICamera, frame_aggregator: FrameResultAggregator, stop_event: Event) -> None:
+        while not stop_event.wait(_STALL_CHECK_SECONDS):
+            stall_seconds = time.monotonic() - camera.last_capture_time
+            if 0 < camera_config.camera_stall_restart_seconds < stall_seconds:
+                logger.error(f"No frame was captured in {stall_seconds:.0f}s; restarting the pipeline")
+                frame_aggregator.bot.send_text(f'No frame was captured in {stall_seconds:.0f}s, restarting...')
+                stop_event.set()
+                return
@@ -0,0 +1,168 @@
+"""
+Measures the frame-to-lock latency of the automatic lock on a prey verdict, against a local stand-in of the Surepet API
+(so no real flap nor account is needed). Each verdict runs the same fast path as the bot: the flap is locked for
+incoming cats with the already open session, and its previous state is restored after a (short) hold time. The
+stand-in server answers every request after a configurable delay, emulating the round trip to the Surepet servers.
+
+Usage (from the folder with the config.toml file):
+    python -m balrog.tools.auto_lock_latency [--verdicts 10] [--verdict-interval 0.5] [--hold-seconds 0.2]
+                                             [--server-delay 0.1]
+
+The report shows the frame-to-lock latency (from the capture time of the frame of the verdict until the flap
+confirmed the lock) and the number of requests that reached the stand-in server.
+"""
+import argparse
+import asyncio
+import os
+import time
+from datetime import datetime
+from threading import Thread
+from typing import Callable
+
+import aiohttp
+import numpy as np
+import pytz
+from aiohttp import web
+from cv2.typing import MatLike
+from surepy.const import BASE_RESOURCE
+from yarl import URL
+
+from balrog.config import general_config
+from balrog.interface import MessageSender, MessagePriority
+from balrog.interface.flap_loop import FlapLockerLoop
+
+_STAND_IN_FLAP_ID = 1
+_STAND_IN_HOUSEHOLD_ID = 1
+# Product ID of the cat flap in the Surepet API
+_CAT_FLAP_PRODUCT_ID = 6
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Measure the frame-to-lock latency of the automatic lock")
+    parser.add_argument("--verdicts", type=int, default=10, help="number of prey verdicts")
+    parser.add_argument("--verdict-interval", type=float, default=0.5, help="time (in seconds) between verdicts")
+    parser.add_argument("--hold-seconds", type=float, default=0.2,
+                        help="time (in seconds) that the flap stays locked after each verdict")
+    parser.add_argument("--server-delay", type=float, default=0.1,
+                        help="time (in seconds) that the stand-in server takes to answer each request")
+    return parser.parse_args()
+
+
+class _StandInSurepetApi:
+    """
+    The few endpoints of the Surepet API used by the flap locker, for a household with a single cat flap.
+    """
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.lock_mode = 0
+        self.requests = 0
+        self.app = web.Application(middlewares=[self._count_and_delay])
+        self.app.router.add_route("OPTIONS", "/{tail:.*}", self._options)
+        self.app.router.add_post("/api/auth/login", self._login)
+        self.app.router.add_get("/api/me/start", self._me_start)
+        self.app.router.add_get("/api/report/household/{household_id}", self._report)
+        self.app.router.add_put("/api/device/{device_id}/control", self._control)
+
+    @web.middleware
+    async def _count_and_delay(self, request: web.Request, handler) -> web.StreamResponse:
+        self.requests += 1
+        await asyncio.sleep(self.delay)
+        return await handler(request)
+
+    async def _options(self, request: web.Request) -> web.Response:
+        return web.Response()
+
+    async def _login(self, request: web.Request) -> web.Response:
+        return web.json_response({"data": {"token": "stand-in"}})
+
+    async def _me_start(self, request: web.Request) -> web.Response:
+        return web.json_response({"data": {
+            "devices": [{
+                "id": _STAND_IN_FLAP_ID,
+                "household_id": _STAND_IN_HOUSEHOLD_ID,
+                "product_id": _CAT_FLAP_PRODUCT_ID,
+                "name": "Moria",
+                "status": {"locking": {"mode": self.lock_mode}, "battery": 6.0, "online": True},
+            }],
+            "pets": [],
+        }})
+
+    async def _report(self, request: web.Request) -> web.Response:
+        return web.json_response({"data": []})
+
+    async def _control(self, request: web.Request) -> web.Response:
+        self.lock_mode = (await request.json())["locking"]
+        return web.json_response({"data": {"locking": self.lock_mode}})
+
+    def serve_in_thread(self) -> int:
+        """
+        Starts the server in its own thread and event loop.
+        :return: the port of the server
+        """
+        loop = asyncio.new_event_loop()
+        runner = web.AppRunner(self.app)
+        loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        loop.run_until_complete(site.start())
+        Thread(target=loop.run_forever, name="surepet-stand-in", daemon=True).start()
+        return runner.addresses[0][1]
+
+
+def _stand_in_session_factory(base_url: str) -> Callable[[], aiohttp.ClientSession]:
+    """
+    :param base_url: the base URL of the stand-in server
+    :return: a factory of HTTP sessions that send the requests to the Surepet API to the stand-in server instead
+    """
+    class _RedirectedRequest(aiohttp.ClientRequest):
+        def __init__(self, method: str, url: URL, **kwargs):
+            if str(url).startswith(BASE_RESOURCE):
+                url = URL(base_url + str(url)[len(BASE_RESOURCE):])
+            super().__init__(method, url, **kwargs)
+
+    return lambda: aiohttp.ClientSession(request_class=_RedirectedRequest)
+
+
+class _LoggingSender(MessageSender):
+    def send_text(self, message: str, priority: MessagePriority = MessagePriority.TEXT) -> None:
+        print(f"  [{priority.name}] {message}")
+
+    def send_img(self, img: MatLike, caption: str, priority: MessagePriority = MessagePriority.VERDICT) -> None:
+        print(f"  [{priority.name}] <picture> {caption}")
+
+
+def main() -> None:
+    args = _parse_args()
+    stand_in = _StandInSurepetApi(args.server_delay)
+    port = stand_in.serve_in_thread()
+    # Only the requests of this tool go to the stand-in server, with stand-in credentials
+    os.environ["SUREPET_USER"] = "stand-in"
+    os.environ["SUREPET_PASSWORD"] = "stand-in"
+
+    flap_loop = FlapLockerLoop(_stand_in_session_factory(f"http://127.0.0.1:{port}/api"))
+    flap_locker = flap_loop.flap_locker
+    sender = _LoggingSender()
+    # Like the bot at startup: login and first fetch of the devices, so the verdicts find the session ready
+    flap_loop.run(flap_locker.get_devices_data())
+    warmup_requests = stand_in.requests
+
+    timezone = pytz.timezone(general_config.local_timezone)
+    for verdict in range(args.verdicts):
+        frame_timestamp = datetime.now(timezone)
+        flap_loop.run(flap_locker.lock_out_on_prey(sender, args.hold_seconds, frame_timestamp))
+        # Waits for the restore, so every verdict finds the flap open
+        time.sleep(max(args.verdict_interval, args.hold_seconds + 2 * args.server_delay + 0.1))
+    flap_loop.close(timeout=10.0)
+
+    latencies = list(flap_locker.auto_lock_latencies)
+    if len(latencies) == 0:
+        print("The flap was never locked")
+        return
+    p50, p95 = np.percentile(latencies, [50, 95])
+    print(f"Frame-to-lock latency over {len(latencies)} verdicts: p50 {p50 * 1000:.1f} ms, "
+          f"p95 {p95 * 1000:.1f} ms, max {max(latencies) * 1000:.1f} ms")
+    print(f"Requests: {warmup_requests} at startup, {stand_in.requests - warmup_requests} for the verdicts "
+          f"(server delay: {args.server_delay * 1000:.0f} ms)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""
+Benchmark of the per-frame cost of the cat detector (CC stage) for different batch sizes, on CPU.
+
+Usage (from the folder with the config.toml file):
+    python -m balrog.tools.cc_batch_benchmark [--image path/to/frame.jpg] [--max-batch-size 8] [--iterations 20]
+"""
+import argparse
+import os
+import time
+
+# The benchmark targets the CPU of the boards; we hide any GPU before tensorflow is loaded
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", "-1")
+
+import cv2
+
+from balrog.processor.model_stages import CCMobileNetStage
+from balrog.utils import get_resource_path
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the cat detector with different batch sizes")
+    parser.add_argument("--image", default=None, help="frame to feed to the detector (default: the debug image)")
+    parser.add_argument("--max-batch-size", type=int, default=8, help="largest batch size to benchmark")
+    parser.add_argument("--iterations", type=int, default=20, help="number of timed batches per batch size")
+    parser.add_argument("--warmup", type=int, default=3, help="number of untimed batches per batch size")
+    return parser.parse_args()
+
+
+def _benchmark_batch_size(cc_stage: CCMobileNetStage, frame, batch_size: int, iterations: int, warmup: int) -> float:
+    frames = [frame] * batch_size
+    for _ in range(warmup):
+        cc_stage.do_cc_batch(frames)
+    start_time = time.perf_counter()
+    for _ in range(iterations):
+        cc_stage.do_cc_batch(frames)
+    return (time.perf_counter() - start_time) / (iterations * batch_size)
+
+
+def main() -> None:
+    args = _parse_args()
+    if args.image is None:
+        with get_resource_path("dbg_casc.jpg") as resource:
+            frame = cv2.imread(str(resource))
+    else:
+        frame = cv2.imread(args.image)
+    if frame is None:
+        raise Exception(f"Could not read the benchmark image '{args.image}'")
+
+    cc_stage = CCMobileNetStage()
+    print(f"Frame shape: {frame.shape}, iterations per batch size: {args.iterations}")
+    print(f"{'batch':>5} | {'ms/frame':>9} | {'frames/s':>9} | {'speedup':>7}")
+    baseline = None
+    for batch_size in range(1, args.max_batch_size + 1):
+        frame_time = _benchmark_batch_size(cc_stage, frame, batch_size, args.iterations, args.warmup)
+        baseline = frame_time if baseline is None else baseline
+        print(f"{batch_size:>5} | {frame_time * 1000:>9.2f} | {1 / frame_time:>9.2f} | {baseline / frame_time:>6.2f}x")
+
+
+if __name__ == "__main__":
+    main()
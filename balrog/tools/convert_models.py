@@ -0,0 +1,151 @@
+"""
+Exports the models of the cascade stages to TFLite and/or ONNX, so they can be executed by the lightweight runtimes
+(see the inference section of the configuration file), and checks that the converted models produce the same outputs
+as the original tensorflow models on the bundled debug image.
+
+Usage (from the folder with the config.toml file):
+    python -m balrog.tools.convert_models [--formats tflite onnx] [--stages cc pc ff eye] [--output-folder folder]
+                                          [--check-only] [--tolerance 0.01]
+
+The ONNX export requires the tf2onnx package. The TFLite version of the cat detector (cc) uses some tensorflow
+operations that are not TFLite builtins, so it can only be executed with the TFLite interpreter of tensorflow.
+"""
+import argparse
+import sys
+from contextlib import ExitStack
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from balrog.config import inference_config
+from balrog.processor.inference import InferenceBackend, InferenceEngine, converted_model_file
+from balrog.processor.model_stages import CC_MODEL_RESOURCE, CC_INPUT_NAME, CC_OUTPUT_NAMES, KERAS_MODEL_RESOURCES
+from balrog.processor.preprocessing import (
+    detector_batch,
+    classifier_batch,
+    DETECTOR_INPUT_SIZE,
+    CLASSIFIER_INPUT_SIZE
+)
+from balrog.utils import get_resource_path
+
+_STAGES = ['cc', *KERAS_MODEL_RESOURCES]
+_ONNX_OPSET = 13
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Convert the models of the cascade stages to TFLite and ONNX")
+    parser.add_argument("--formats", nargs="+", default=["tflite", "onnx"], choices=["tflite", "onnx"])
+    parser.add_argument("--stages", nargs="+", default=_STAGES, choices=_STAGES)
+    parser.add_argument("--output-folder", default=inference_config.models_folder,
+                        help="folder for the converted models (default: the models folder of the configuration)")
+    parser.add_argument("--check-only", action="store_true", help="only check the parity of the converted models")
+    parser.add_argument("--tolerance", type=float, default=0.01,
+                        help="maximum absolute difference between the outputs of the original and converted models")
+    return parser.parse_args()
+
+
+def _tensor_names(names: list[str]) -> list[str]:
+    # TFLite expects the names of the operations, without the index of the output
+    return [name.split(':')[0] for name in names]
+
+
+def _export_tflite(stage: str, tf_model_file: Path, output_file: Path) -> None:
+    import tensorflow as tf
+
+    if stage == 'cc':
+        converter = tf.compat.v1.lite.TFLiteConverter.from_frozen_graph(
+            str(tf_model_file),
+            input_arrays=_tensor_names([CC_INPUT_NAME]),
+            output_arrays=_tensor_names(CC_OUTPUT_NAMES),
+            input_shapes={_tensor_names([CC_INPUT_NAME])[0]: [1, DETECTOR_INPUT_SIZE, DETECTOR_INPUT_SIZE, 3]}
+        )
+        # The post-processing of the detector (non-max suppression) needs some tensorflow operations
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS, tf.lite.OpsSet.SELECT_TF_OPS]
+    else:
+        converter = tf.lite.TFLiteConverter.from_keras_model(tf.keras.models.load_model(str(tf_model_file)))
+    output_file.write_bytes(converter.convert())
+
+
+def _export_onnx(stage: str, tf_model_file: Path, output_file: Path) -> None:
+    import tensorflow as tf
+    import tf2onnx
+
+    if stage == 'cc':
+        graph_def = tf.compat.v1.GraphDef()
+        graph_def.ParseFromString(tf_model_file.read_bytes())
+        tf2onnx.convert.from_graph_def(
+            graph_def,
+            input_names=[CC_INPUT_NAME],
+            output_names=CC_OUTPUT_NAMES,
+            opset=_ONNX_OPSET,
+            output_path=str(output_file)
+        )
+    else:
+        input_shape = (None, CLASSIFIER_INPUT_SIZE, CLASSIFIER_INPUT_SIZE, 3)
+        input_signature = (tf.TensorSpec(input_shape, tf.float32, name='input'),)
+        tf2onnx.convert.from_keras(
+            tf.keras.models.load_model(str(tf_model_file)),
+            input_signature=input_signature,
+            opset=_ONNX_OPSET,
+            output_path=str(output_file)
+        )
+
+
+def _stage_input(stage: str, img: np.ndarray) -> np.ndarray:
+    # Same preprocessing as the stages; we copy the input, since the preprocessing buffers are reused
+    if stage == 'cc':
+        return detector_batch([img]).copy()
+    return classifier_batch(img, stage).copy()
+
+
+def _max_difference(stage: str, reference: list[np.ndarray], converted: list[np.ndarray]) -> float:
+    if stage == 'cc':
+        # The cascade only uses the top detection (boxes, scores and classes)
+        return max(
+            float(np.max(np.abs(np.asarray(ref)[:, 0] - np.asarray(conv)[:, 0])))
+            for ref, conv in zip(reference[:3], converted[:3])
+        )
+    return max(
+        float(np.max(np.abs(np.asarray(ref) - np.asarray(conv))))
+        for ref, conv in zip(reference, converted)
+    )
+
+
+def main() -> None:
+    args = _parse_args()
+    output_folder = Path(args.output_folder)
+    output_folder.mkdir(parents=True, exist_ok=True)
+    engines = [InferenceEngine(engine_format) for engine_format in args.formats]
+    exporters = {InferenceEngine.TFLITE: _export_tflite, InferenceEngine.ONNX: _export_onnx}
+
+    with get_resource_path("dbg_casc.jpg") as resource:
+        dbg_img = cv2.imread(str(resource))
+
+    all_passed = True
+    print(f"{'stage':>5} | {'engine':>6} | {'max diff':>10} | result")
+    with ExitStack() as stack:
+        for stage in args.stages:
+            model_resource = CC_MODEL_RESOURCE if stage == 'cc' else KERAS_MODEL_RESOURCES[stage]
+            tf_model_file = Path(stack.enter_context(get_resource_path(model_resource)))
+            stage_input = _stage_input(stage, dbg_img)
+            reference = InferenceBackend.get_instance(
+                InferenceEngine.TENSORFLOW, stage, tf_model_file, str(output_folder), CC_INPUT_NAME, CC_OUTPUT_NAMES
+            ).run(stage_input)
+
+            for engine in engines:
+                if not args.check_only:
+                    exporters[engine](stage, tf_model_file, converted_model_file(str(output_folder), stage, engine))
+                converted = InferenceBackend.get_instance(
+                    engine, stage, tf_model_file, str(output_folder)
+                ).run(stage_input)
+                difference = _max_difference(stage, reference, converted)
+                passed = difference <= args.tolerance
+                all_passed &= passed
+                print(f"{stage:>5} | {engine.value:>6} | {difference:>10.6f} | {'OK' if passed else 'MISMATCH'}")
+
+    sys.exit(0 if all_passed else 1)
+
+
+if __name__ == "__main__":
+    main()
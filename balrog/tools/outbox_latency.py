@@ -0,0 +1,127 @@
+"""
+Measures the send latency of the telegram outbox under bursts of messages, against a local stand-in of the Bot API (so
+no real bot nor network is needed). Each burst queues, at once, a verdict picture, some text replies and some live
+pictures; the stand-in server answers every request after a configurable delay, emulating the upload time.
+
+Usage (from the folder with the config.toml file):
+    python -m balrog.tools.outbox_latency [--bursts 10] [--burst-interval 1.0] [--texts 2] [--live-pictures 5]
+                                          [--server-delay 0.2] [--image path/to/frame.jpg]
+
+The report shows, per priority, the number of messages sent and their latency (from the moment a message is queued
+until the server answered it), and how many live pictures were coalesced and how many messages were dropped.
+"""
+import argparse
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+import cv2
+import numpy as np
+
+from balrog.config import telegram_config
+from balrog.interface import MessagePriority
+from balrog.interface.outbox import Outbox, create_outbox_bot
+from balrog.utils import get_resource_path
+
+# Any token with the format of the Bot API is accepted by the stand-in server
+_STAND_IN_TOKEN = "123456:STAND-IN"
+_STAND_IN_CHAT_ID = "1"
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Measure the send latency of the telegram outbox")
+    parser.add_argument("--bursts", type=int, default=10, help="number of bursts of messages")
+    parser.add_argument("--burst-interval", type=float, default=1.0, help="time (in seconds) between bursts")
+    parser.add_argument("--texts", type=int, default=2, help="text replies per burst")
+    parser.add_argument("--live-pictures", type=int, default=5, help="live pictures per burst")
+    parser.add_argument("--server-delay", type=float, default=0.2,
+                        help="time (in seconds) that the stand-in server takes to answer each request")
+    parser.add_argument("--image", default=None, help="picture to send (default: the debug image)")
+    return parser.parse_args()
+
+
+class _StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, delay: float):
+        super().__init__(("127.0.0.1", 0), _StandInHandler)
+        self.delay = delay
+        self.requests_lock = Lock()
+        self.requests = 0
+        self.received_bytes = 0
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self) -> None:
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(self.server.delay)
+        with self.server.requests_lock:
+            self.server.requests += 1
+            self.server.received_bytes += len(body)
+        # The bot only needs a valid message in the result
+        response = json.dumps({
+            "ok": True,
+            "result": {"message_id": self.server.requests, "date": int(time.time()), "chat": {"id": 1, "type": "private"}}
+        }).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+def _print_latencies(priority: MessagePriority, latencies: list[float]) -> None:
+    if len(latencies) == 0:
+        print(f"{priority.name:>8} | {0:>5} | {'-':>8} | {'-':>8} | {'-':>8}")
+        return
+    p50, p95 = np.percentile(latencies, [50, 95])
+    print(f"{priority.name:>8} | {len(latencies):>5} | {p50 * 1000:>8.1f} | {p95 * 1000:>8.1f} | "
+          f"{max(latencies) * 1000:>8.1f}")
+
+
+def main() -> None:
+    args = _parse_args()
+    if args.image is not None:
+        img = cv2.imread(args.image)
+    else:
+        with get_resource_path("dbg_casc.jpg") as resource:
+            img = cv2.imread(str(resource))
+
+    server = _StandInServer(args.server_delay)
+    Thread(target=server.serve_forever, daemon=True).start()
+    outbox = Outbox(
+        create_outbox_bot(_STAND_IN_TOKEN, base_url=f"http://127.0.0.1:{server.server_address[1]}/bot"),
+        _STAND_IN_CHAT_ID,
+        capacity=telegram_config.outbox_capacity,
+        image_max_width=telegram_config.image_max_width,
+        jpeg_quality=telegram_config.jpeg_quality
+    )
+    outbox.start()
+
+    start_time = time.perf_counter()
+    for burst in range(args.bursts):
+        outbox.put_img(img, f"Verdict {burst}", MessagePriority.VERDICT)
+        for text in range(args.texts):
+            outbox.put_text(f"Reply {burst}.{text}", MessagePriority.TEXT)
+        for live_picture in range(args.live_pictures):
+            outbox.put_img(img, f"Live {burst}.{live_picture}", MessagePriority.LIVE)
+        time.sleep(args.burst_interval)
+    outbox.stop(timeout=60.0)
+    elapsed_time = time.perf_counter() - start_time
+    server.shutdown()
+
+    print(f"{'priority':>8} | {'sent':>5} | {'p50 ms':>8} | {'p95 ms':>8} | {'max ms':>8}")
+    for priority in MessagePriority:
+        _print_latencies(priority, outbox.latencies(priority))
+    print(f"Requests: {server.requests} ({server.received_bytes / 2 ** 20:.2f} MB) in {elapsed_time:.2f}s, "
+          f"coalesced live pictures: {outbox.coalesced_messages}, dropped messages: {outbox.dropped_messages}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+"""
+Produces quantized TFLite variants (dynamic-range, float16 and full INT8) of the keras models of the cascade (prey
+classifier, face/fur classifier and eye detector), and reports their size, latency and accuracy against the original
+models. The variants are stored in the models folder of the configuration, where the tflite engine loads the variant
+chosen with the pc_variant, ff_variant and eye_variant options.
+
+Usage (from the folder with the config.toml file):
+    python -m balrog.tools.quantize_models --calibration-folder crops/ [--evaluation-folder labelled-crops/]
+                                           [--stages pc ff eye] [--variants dynamic float16 int8] [--runs 20]
+
+The calibration folder contains recorded snout crops (any image format readable by OpenCV), used to calibrate the
+INT8 quantization. The evaluation folder contains the labelled crops, in a sub-folder per stage, with the crops where
+the stage should return True (prey for pc, face for ff) under 'positive', and the rest under 'negative':
+    labelled-crops/pc/positive/*.jpg, labelled-crops/pc/negative/*.jpg, labelled-crops/ff/positive/*.jpg, ...
+The eye detector is a regression model, so its variants are only compared against the original model.
+The report shows the accuracy of the original model, and the accuracy delta of each variant; the max diff column is the
+largest difference between the outputs of the variant and the original model.
+"""
+import argparse
+import time
+from contextlib import ExitStack
+from pathlib import Path
+from typing import Optional
+
+import cv2
+import numpy as np
+
+from balrog.config import inference_config
+from balrog.processor.inference import InferenceBackend, InferenceEngine, converted_model_file
+from balrog.processor.model_stages import KERAS_MODEL_RESOURCES
+from balrog.processor.preprocessing import classifier_batch, letterbox_batch
+from balrog.utils import get_resource_path
+
+# The stages return True when the prediction is above (pc) or below (ff) this threshold
+_CLASSIFIER_THRESHOLD = 0.5
+_IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp'}
+_VARIANTS = ["dynamic", "float16", "int8"]
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Quantize the keras models of the cascade stages")
+    parser.add_argument("--calibration-folder", default=None, help="folder with recorded snout crops (for INT8)")
+    parser.add_argument("--evaluation-folder", default=None, help="folder with the labelled crops of each stage")
+    parser.add_argument("--stages", nargs="+", default=list(KERAS_MODEL_RESOURCES), choices=list(KERAS_MODEL_RESOURCES))
+    parser.add_argument("--variants", nargs="+", default=_VARIANTS, choices=_VARIANTS)
+    parser.add_argument("--output-folder", default=inference_config.models_folder,
+                        help="folder for the quantized models (default: the models folder of the configuration)")
+    parser.add_argument("--runs", type=int, default=20, help="number of timed runs to measure the latency")
+    return parser.parse_args()
+
+
+def _preprocess(stage: str, img: np.ndarray) -> np.ndarray:
+    # Same preprocessing as the stages; we copy the input, since the preprocessing buffers are reused
+    if stage == 'eye':
+        return letterbox_batch(img, stage)[0][0].copy()
+    return classifier_batch(img, stage)[0].copy()
+
+
+def _load_crops(stage: str, folder: Path) -> list[np.ndarray]:
+    crops = []
+    for image_file in sorted(folder.iterdir()) if folder.is_dir() else []:
+        if image_file.suffix.lower() not in _IMAGE_EXTENSIONS:
+            continue
+        img = cv2.imread(str(image_file))
+        if img is not None:
+            crops.append(_preprocess(stage, img))
+    return crops
+
+
+def _quantize(model, variant: str, calibration_inputs: list[np.ndarray]) -> bytes:
+    import tensorflow as tf
+
+    def representative_dataset():
+        for calibration_input in calibration_inputs:
+            yield [calibration_input[np.newaxis]]
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if variant == "float16":
+        converter.target_spec.supported_types = [tf.float16]
+    elif variant == "int8":
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        converter.inference_input_type = tf.int8
+        converter.inference_output_type = tf.int8
+    return converter.convert()
+
+
+def _predict(backend: InferenceBackend, inputs: list[np.ndarray]) -> np.ndarray:
+    return np.stack([backend.run(model_input[np.newaxis])[0][0] for model_input in inputs])
+
+
+def _latency(backend: InferenceBackend, model_input: np.ndarray, runs: int) -> float:
+    batch = model_input[np.newaxis]
+    backend.run(batch)
+    times = []
+    for _ in range(runs):
+        start_time = time.perf_counter()
+        backend.run(batch)
+        times.append(time.perf_counter() - start_time)
+    return float(np.median(times))
+
+
+def _accuracy(stage: str, predictions: np.ndarray, labels: np.ndarray) -> Optional[float]:
+    if stage == 'eye' or len(labels) == 0:
+        return None
+    values = predictions.reshape(len(predictions), -1)[:, 0]
+    results = values > _CLASSIFIER_THRESHOLD if stage == 'pc' else values <= _CLASSIFIER_THRESHOLD
+    return float(np.mean(results == labels))
+
+
+def main() -> None:
+    args = _parse_args()
+    import tensorflow as tf
+
+    output_folder = Path(args.output_folder)
+    output_folder.mkdir(parents=True, exist_ok=True)
+    with get_resource_path("dbg_casc.jpg") as resource:
+        dbg_img = cv2.imread(str(resource))
+
+    print(f"{'stage':>5} | {'variant':>8} | {'size MB':>8} | {'ms/crop':>8} | {'accuracy':>8} | {'max diff':>8}")
+    with ExitStack() as stack:
+        for stage in args.stages:
+            tf_model_file = Path(stack.enter_context(get_resource_path(KERAS_MODEL_RESOURCES[stage])))
+            calibration_inputs = []
+            if args.calibration_folder is not None:
+                calibration_inputs = _load_crops(stage, Path(args.calibration_folder))
+            evaluation_inputs, labels = [], []
+            if args.evaluation_folder is not None:
+                for label in ['positive', 'negative']:
+                    crops = _load_crops(stage, Path(args.evaluation_folder) / stage / label)
+                    evaluation_inputs.extend(crops)
+                    labels.extend([label == 'positive'] * len(crops))
+            if len(evaluation_inputs) == 0:
+                # Without labelled crops, we can still compare the variants against the original model
+                evaluation_inputs = calibration_inputs or [_preprocess(stage, dbg_img)]
+            labels = np.array(labels)
+
+            original_backend = InferenceBackend.get_instance(
+                InferenceEngine.TENSORFLOW, stage, tf_model_file, str(output_folder)
+            )
+            original_predictions = _predict(original_backend, evaluation_inputs)
+            original_accuracy = _accuracy(stage, original_predictions, labels)
+            original_latency = _latency(original_backend, evaluation_inputs[0], args.runs)
+            print(f"{stage:>5} | {'original':>8} | {tf_model_file.stat().st_size / 2 ** 20:>8.2f} | "
+                  f"{original_latency * 1000:>8.2f} | "
+                  f"{'-' if original_accuracy is None else f'{original_accuracy:.3f}':>8} | {0:>8.4f}")
+
+            model = tf.keras.models.load_model(str(tf_model_file), compile=False)
+            for variant in args.variants:
+                if variant == "int8" and len(calibration_inputs) == 0:
+                    print(f"{stage:>5} | {variant:>8} | skipped: the INT8 variant needs a calibration folder")
+                    continue
+                model_file = converted_model_file(str(output_folder), stage, InferenceEngine.TFLITE, variant)
+                model_file.write_bytes(_quantize(model, variant, calibration_inputs))
+
+                backend = InferenceBackend.get_instance(
+                    InferenceEngine.TFLITE, stage, tf_model_file, str(output_folder), variant=variant
+                )
+                predictions = _predict(backend, evaluation_inputs)
+                accuracy = _accuracy(stage, predictions, labels)
+                latency = _latency(backend, evaluation_inputs[0], args.runs)
+                max_difference = float(np.max(np.abs(predictions - original_predictions)))
+                accuracy_delta = '-' if accuracy is None else f'{accuracy - original_accuracy:+.3f}'
+                print(f"{stage:>5} | {variant:>8} | {model_file.stat().st_size / 2 ** 20:>8.2f} | "
+                      f"{latency * 1000:>8.2f} | {accuracy_delta:>8} | {max_difference:>8.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Benchmark of the startup of the module: the time from the launch of a fresh process until the first frame is processed
+(captured, run through the cascade and aggregated). Each run starts a new python process with the null camera and the
+null telegram interfaces (see the README), so the models are loaded from scratch every time, as after a /hardrestart.
+
+Usage (from the folder with the config.toml file):
+    python -m balrog.tools.startup_benchmark [--runs 3] [--loader-threads 4] [--timeout 600]
+
+The report shows, for each run, the import time of the module, the load time of each model of the cascade (with the
+"thread" executor), and the time to the first processed frame, measured from the supervisor and from the launch of the
+process (which includes the startup of the interpreter).
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from threading import Thread
+
+import numpy as np
+
+# Prefix of the line with the results of a run, printed by the child process
+_RESULT_PREFIX = "STARTUP-BENCHMARK "
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the time to the first processed frame")
+    parser.add_argument("--runs", type=int, default=3, help="number of fresh processes to start")
+    parser.add_argument("--loader-threads", type=int, default=None,
+                        help="threads that load the models (default: model_loader_threads of the config file)")
+    parser.add_argument("--timeout", type=float, default=600.0,
+                        help="maximum time (in seconds) that a run may take to process its first frame")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def _run_child(args: argparse.Namespace) -> None:
+    start_time = time.monotonic()
+    from balrog.config import inference_config, logging_config
+    from balrog.utils.utils import Logging
+    from balrog.supervisor import Supervisor
+    import_time = time.monotonic() - start_time
+
+    if args.loader_threads is not None:
+        inference_config.model_loader_threads = args.loader_threads
+    Logging.init_logger(
+        stdout_logging_level=logging_config.stdout_debug_level,
+        max_log_size=logging_config.max_log_file_size_mb,
+        max_log_files=logging_config.max_log_files_kept
+    )
+    supervisor = Supervisor()
+    base_cascade = supervisor.models.base_cascade
+    Thread(target=supervisor.run, name='supervisor', daemon=True).start()
+    if not supervisor.first_frame_event.wait(args.timeout):
+        print(f"No frame was processed in {args.timeout:.0f}s", file=sys.stderr)
+        os._exit(1)
+
+    result = {
+        "import": import_time,
+        "load_times": {} if base_cascade is None else base_cascade.load_times,
+        "first_frame": supervisor.time_to_first_frame,
+    }
+    print(_RESULT_PREFIX + json.dumps(result), flush=True)
+    # The pipeline keeps running in its threads; we don't need a clean shutdown to measure the next run
+    os._exit(0)
+
+
+def _run_once(args: argparse.Namespace) -> dict:
+    command = [sys.executable, "-m", "balrog.tools.startup_benchmark", "--child", "--timeout", str(args.timeout)]
+    if args.loader_threads is not None:
+        command += ["--loader-threads", str(args.loader_threads)]
+    env = dict(os.environ, BALROG_USE_NULL_CAMERA="1", BALROG_USE_NULL_TELEGRAM="1")
+    env.pop("BALROG_REPLAY_SOURCE", None)
+
+    launch_time = time.monotonic()
+    with subprocess.Popen(command, env=env, stdout=subprocess.PIPE, text=True) as child:
+        for line in child.stdout:
+            if line.startswith(_RESULT_PREFIX):
+                result = json.loads(line[len(_RESULT_PREFIX):])
+                result["process"] = time.monotonic() - launch_time
+                child.wait()
+                return result
+    raise Exception(f"The benchmark process exited with code {child.returncode} before processing a frame")
+
+
+def main() -> None:
+    args = _parse_args()
+    if args.child:
+        _run_child(args)
+        return
+
+    results = []
+    for run in range(args.runs):
+        result = _run_once(args)
+        results.append(result)
+        load_times = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in result["load_times"].items())
+        print(f"Run {run + 1}: import {result['import']:.2f}s, models ({load_times or 'loaded by the workers'}), "
+              f"first frame {result['first_frame']:.2f}s after the start, {result['process']:.2f}s after the launch")
+
+    first_frame = [result["first_frame"] for result in results]
+    process = [result["process"] for result in results]
+    print(f"Time to the first processed frame over {len(results)} runs: "
+          f"median {np.median(first_frame):.2f}s (min {min(first_frame):.2f}s, max {max(first_frame):.2f}s), "
+          f"{np.median(process):.2f}s from the launch of the process")
+
+
+if __name__ == "__main__":
+    main()
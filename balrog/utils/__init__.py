@@ -1 +1,2 @@
-from .utils import logger, Logging, get_resource_path
\ No newline at end of file
+from .utils import logger, Logging, get_resource_path
+from .config_watcher import ConfigWatcher
\ No newline at end of file
@@ -0,0 +1,59 @@
+from threading import Event, Thread
+from typing import Callable, Optional
+
+from balrog.config import balrog_config, config_file_mtime_ns, reload_config
+from .utils import logger
+
+
+class ConfigWatcher:
+    """
+    Polls the modification time of the config file, and reloads it (see reload_config) when it changes. A change is
+    only reloaded once the file stays the same for a whole period, so we don't parse a file that is still being written.
+    """
+    def __init__(self, interval: float, report: Callable[[str], None]):
+        """
+        :param interval: the polling period (in seconds); 0 disables the watcher
+        :param report: function that receives the report of each reload (e.g., to send it to the chat)
+        """
+        self.interval = interval
+        self._report = report
+        self._stop_event = Event()
+        self._thread = Thread(target=self._run, name='config-watcher', daemon=True)
+        # Modification time seen in the last poll, and the one of the last file that could not be reloaded
+        self._pending_mtime_ns: Optional[int] = None
+        self._failed_mtime_ns: Optional[int] = None
+
+    def start(self) -> None:
+        if self.interval > 0:
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        if self._thread.is_alive():
+            self._thread.join(self.interval)
+
+    def _run(self) -> None:
+        while not self._stop_event.wait(self.interval):
+            try:
+                mtime_ns = config_file_mtime_ns()
+            except OSError:
+                # The file may be being replaced; we check it again in the next poll
+                continue
+            if mtime_ns in (balrog_config.file_mtime_ns, self._failed_mtime_ns):
+                self._pending_mtime_ns = None
+                continue
+            if mtime_ns != self._pending_mtime_ns:
+                self._pending_mtime_ns = mtime_ns
+                continue
+
+            self._pending_mtime_ns = None
+            try:
+                report = reload_config()
+            except Exception as e:
+                logger.exception("Exception while reloading the config file")
+                self._failed_mtime_ns = mtime_ns
+                self._report(f"Could not reload the config file: `{e}`")
+                continue
+            logger.info(str(report))
+            if report.applied or report.needs_restart:
+                self._report(str(report))
@@ -5,13 +5,17 @@ from contextlib import AbstractContextManager
 from logging import handlers
 from pathlib import Path
 
-from balrog.config import logging_config
+from balrog.config import logging_config, add_reload_listener
 
 # We declare the logger that we use in this package
 logger = logging.getLogger(__name__)
 
 
 class Logging:
+    # Handlers whose level and rotation follow the config (see apply_config)
+    _stdout_handler: logging.Handler | None = None
+    _file_handler: handlers.RotatingFileHandler | None = None
+
     @staticmethod
     def init_logger(stdout_logging_level: int, max_log_size: int, max_log_files: int) -> None:
         logger_surepy = logging.getLogger("surepy")
@@ -45,6 +49,19 @@ class Logging:
         logger.addHandler(file_handler)
         logger.addHandler(dbg_file_handler)
         logger_surepy.addHandler(dbg_file_handler)
+        Logging._stdout_handler = stdout_handler
+        Logging._file_handler = file_handler
+        add_reload_listener(Logging.apply_config)
+
+    @staticmethod
+    def apply_config() -> None:
+        """
+        Applies the logging level and the rotation of the config to the handlers (e.g., after a reload of the config).
+        """
+        Logging._stdout_handler.setLevel(logging_config.stdout_debug_level)
+        Logging._file_handler.setLevel(logging_config.stdout_debug_level)
+        Logging._file_handler.maxBytes = 1024*1024*logging_config.max_log_file_size_mb
+        Logging._file_handler.backupCount = logging_config.max_log_files_kept
 
     @staticmethod
     def clean_logs() -> list[str]: